@@ -0,0 +1,132 @@
+"""
+テキストアナライザーの一致確認とマイクロベンチマーク
+
+従来の preprocess_text（呼び出しごとにストップワード集合を作り直し、
+word_tokenize で文分割してからトークン化する実装）と TextAnalyzer を比較します。
+
+    python benchmarks/analyzer_bench.py            # 一致確認 + ベンチマーク
+    python benchmarks/analyzer_bench.py --check    # 一致確認のみ（不一致があれば終了コード1）
+
+一致確認: tokenizer="nltk" の TextAnalyzer が従来実装と同じ文字列を返すこと
+（Gutenbergコーパスの全書籍と、記号・短縮形を含むサンプル文で確認）
+"""
+
+import argparse
+import os
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nltk.corpus import gutenberg, stopwords
+from nltk.tokenize import word_tokenize
+
+from text_processing import TOKENIZERS, TextAnalyzer
+
+SAMPLE_TEXTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "I cannot believe it's not butter -- gonna wanna gotta",
+    "“Curiouser and curiouser!” cried Alice (she was so much surprised).",
+    "Mr. Holmes, Dr. Watson & Mrs. Hudson... at 221B Baker St.",
+    "Naïve café façade — über straße… 'tis the season",
+    "whale ship captain",
+    "",
+]
+
+QUERIES = [
+    "whale", "white whale", "captain ahab and the sea", "love and marriage",
+    "the king of denmark", "Alice in Wonderland", "god created the heaven and the earth",
+    "to be or not to be", "emma woodhouse", "persuasion",
+]
+
+
+def legacy_preprocess_text(text: str) -> str:
+    """アナライザー導入前の preprocess_text（比較用にそのまま残したもの）"""
+    text = text.lower()
+    text = text.translate(str.maketrans('', '', string.punctuation))
+    tokens = word_tokenize(text)
+    stop_words = set(stopwords.words('english'))
+    tokens = [token for token in tokens if token not in stop_words and len(token) > 2]
+    return ' '.join(tokens)
+
+
+def check_parity(books) -> int:
+    """従来実装との不一致件数を返す"""
+    analyzer = TextAnalyzer(tokenizer="nltk")
+    mismatches = 0
+    for name, text in [(f"sample[{i}]", text) for i, text in enumerate(SAMPLE_TEXTS)] + books:
+        expected = legacy_preprocess_text(text)
+        actual = analyzer.analyze(text)
+        if actual != expected:
+            mismatches += 1
+            expected_tokens, actual_tokens = expected.split(), actual.split()
+            position = next((i for i, (a, b) in enumerate(zip(expected_tokens, actual_tokens)) if a != b),
+                            min(len(expected_tokens), len(actual_tokens)))
+            print(f"❌ {name}: token {position}: expected={expected_tokens[position:position + 5]} "
+                  f"actual={actual_tokens[position:position + 5]}")
+        else:
+            print(f"✅ {name}: {len(expected.split())} tokens")
+    return mismatches
+
+
+def measure(func, texts, repeat: int) -> float:
+    """texts 全体を repeat 回処理した1回あたりの平均秒数"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmark(books, repeat: int) -> None:
+    book_texts = [text for _, text in books]
+    candidates = [("legacy", legacy_preprocess_text)]
+    candidates += [(f"analyzer[{name}]", TextAnalyzer(tokenizer=name).analyze) for name in TOKENIZERS]
+    candidates.append(("analyzer[nltk+porter]", TextAnalyzer(tokenizer="nltk", stemmer="porter").analyze))
+
+    reference = [set(legacy_preprocess_text(text).split()) for text in book_texts]
+
+    print(f"\n📊 クエリ {len(QUERIES)} 件 × 100 / 書籍 {len(book_texts)} 冊（best of {repeat}）")
+    print(f"{'analyzer':<24}{'query µs/call':>15}{'books s':>10}{'speedup':>9}{'vocab overlap':>15}")
+    baseline_books = None
+    for name, func in candidates:
+        query_seconds = measure(func, QUERIES * 100, repeat) / (len(QUERIES) * 100)
+        book_seconds = measure(func, book_texts, repeat)
+        if baseline_books is None:
+            baseline_books = book_seconds
+        # 従来実装との語彙の一致率（Jaccard、書籍平均）
+        overlaps = []
+        for text, expected in zip(book_texts, reference):
+            actual = set(func(text).split())
+            union = expected | actual
+            overlaps.append(len(expected & actual) / len(union) if union else 1.0)
+        overlap = sum(overlaps) / len(overlaps) if overlaps else 1.0
+        print(f"{name:<24}{query_seconds * 1e6:>15.1f}{book_seconds:>10.3f}"
+              f"{baseline_books / book_seconds:>8.1f}x{overlap:>15.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TextAnalyzer parity check and micro-benchmark")
+    parser.add_argument("--check", action="store_true", help="一致確認のみ実行")
+    parser.add_argument("--books", type=int, default=0, help="使用する書籍数（0 は全書籍）")
+    parser.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数")
+    args = parser.parse_args()
+
+    fileids = gutenberg.fileids()
+    if args.books:
+        fileids = fileids[:args.books]
+    books = [(fileid, gutenberg.raw(fileid)) for fileid in fileids]
+
+    mismatches = check_parity(books)
+    print(f"\n{'✅' if mismatches == 0 else '❌'} 一致確認: 不一致 {mismatches} 件")
+    if mismatches:
+        sys.exit(1)
+    if not args.check:
+        run_benchmark(books, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
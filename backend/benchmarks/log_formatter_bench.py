@@ -0,0 +1,132 @@
+"""
+JsonFormatter のベンチマーク
+
+従来のフォーマッター（レコードごとに __dict__ 全体をリストと照合し、
+datetime.now() と json.dumps(default=str) を使う実装）と、現在の JsonFormatter の
+1秒あたりの処理件数を比較します。検索APIが出すものと同じ形のレコードを使います。
+
+    python benchmarks/log_formatter_bench.py
+    python benchmarks/log_formatter_bench.py --records 200000
+
+出力内容の一致（タイムスタンプを除く全フィールド、タイムスタンプは record.created 由来の値）も確認します。
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_system import JsonFormatter
+
+
+class LegacyJsonFormatter(logging.Formatter):
+    """改修前の JsonFormatter（比較用にそのまま残したもの）"""
+
+    def format(self, record):
+        timestamp = datetime.now(timezone.utc).isoformat()
+        log_record = {
+            "timestamp": timestamp,
+            "level": record.levelname,
+            "event": getattr(record, 'event_type', 'unknown'),
+            "message": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in ['name', 'msg', 'args', 'levelname', 'levelno', 'pathname', 'filename',
+                          'module', 'exc_info', 'exc_text', 'stack_info', 'lineno', 'funcName',
+                          'created', 'msecs', 'relativeCreated', 'thread', 'threadName',
+                          'processName', 'process', 'getMessage', 'event_type']:
+                log_record[key] = value
+        return json.dumps(log_record, ensure_ascii=False, default=str)
+
+
+def make_records(count: int):
+    """検索APIのログと同じ形のレコードを作る"""
+    logger = logging.getLogger("log_formatter_bench")
+    cache_stats = {"hits": 120, "shared_hits": 0, "misses": 30, "evictions": 0, "expirations": 2,
+                   "shared_errors": 0, "size": 150, "hit_rate": 0.8}
+    templates = [
+        ("検索API", {"event_type": "search_complete", "query": "white whale", "results_count": 8,
+                     "duration_ms": 12.345, "cache": cache_stats}),
+        ("BM25検索完了", {"event_type": "bm25_search_complete", "query": "captain ahab", "engine": "okapi",
+                         "results_count": 5, "total_matches": 5, "top_score": 7.25}),
+        ("書籍一覧API", {"event_type": "api_response", "endpoint": "/books", "response_count": 18,
+                       "duration_ms": 0.512}),
+    ]
+    records = []
+    for i in range(count):
+        message, extra = templates[i % len(templates)]
+        records.append(logger.makeRecord(logger.name, logging.INFO, __file__, 0, message, (), None, extra=extra))
+    return records
+
+
+def check_output(records) -> int:
+    """タイムスタンプ以外の内容が従来と同じか、タイムスタンプが発生時刻どおりかを確認"""
+    legacy = LegacyJsonFormatter()
+    mismatches = 0
+    for encoder in ("json", "orjson"):
+        formatter = JsonFormatter(json_encoder=encoder)
+        for record in records[:300]:
+            expected = json.loads(legacy.format(record))
+            actual = json.loads(formatter.format(record))
+            expected_timestamp = datetime.fromtimestamp(record.created, timezone.utc).isoformat()
+            if actual.pop("timestamp") != expected_timestamp:
+                mismatches += 1
+            expected.pop("timestamp")
+            if actual != expected or list(actual) != list(expected):
+                mismatches += 1
+    # 秒の境界・マイクロ秒の丸めを含む時刻
+    formatter = JsonFormatter()
+    for created in (0.0, 1.0, 1.9999995, 1.0000005, 1700000000.123456, 1700000000.9999996, time.time()):
+        if formatter._timestamp(created) != datetime.fromtimestamp(created, timezone.utc).isoformat():
+            mismatches += 1
+            print(f"❌ timestamp mismatch: {created!r}")
+    return mismatches
+
+
+def measure(formatter, records, repeat: int) -> float:
+    """records/sec（best of repeat）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for record in records:
+            formatter.format(record)
+        best = min(best, time.perf_counter() - start)
+    return len(records) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JsonFormatter benchmark")
+    parser.add_argument("--records", type=int, default=100000, help="整形するレコード数")
+    parser.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数")
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    mismatches = check_output(records)
+    print(f"{'✅' if mismatches == 0 else '❌'} 出力の一致確認: 不一致 {mismatches} 件")
+
+    candidates = [("legacy", LegacyJsonFormatter()), ("json", JsonFormatter(json_encoder="json"))]
+    orjson_formatter = JsonFormatter(json_encoder="auto")
+    if orjson_formatter.json_encoder == "orjson":
+        candidates.append(("orjson", orjson_formatter))
+    else:
+        print("⚠️  orjson が無いため orjson の計測は省略します")
+
+    print(f"\n📊 {args.records} records（best of {args.repeat}）")
+    print(f"{'formatter':<10}{'records/sec':>14}{'speedup':>10}")
+    baseline = None
+    for name, formatter in candidates:
+        rate = measure(formatter, records, args.repeat)
+        baseline = baseline or rate
+        print(f"{name:<10}{rate:>14,.0f}{rate / baseline:>9.2f}x")
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+検索バックエンドのベンチマークスイート
+
+ローカルの Gutenberg コーパスだけを使い（ネットワーク不要）、次を計測します。
+
+- micro: preprocess_text / get_snippet / tfidf_search / bm25_search / bm25_sparse / bm25_pruned / batch_search の
+  1回あたりの所要時間（クエリの種類ごとの中央値・p95）。パッセージ単位のインデックスがあれば
+  tfidf_passage / bm25_passage / bm25_pruned_passage（書籍ごとにまとめる）も計測。
+  ブール検索（boolean_search）は上のクエリ（AND）に加えてフレーズ・演算子のクエリでも計測。書籍の追加（ingest_book）と、
+  追加後の世代（ベース + セグメント）での検索（*_search.segmented）も計測
+- startup: startup_event の所要時間（インデックス構築とスナップショット読み込み。ウォームアップは含めない）
+- e2e: プロセス内 ASGI クライアント（httpx.ASGITransport）から /search・/search/compare を
+  同時実行したときのスループットとレイテンシのパーセンタイル
+
+結果は保存済みのベースラインと比較し、閾値を超えて遅くなった項目を表示します。
+ベースラインは計測したマシンとコーパスに依存するので、比較する環境で作成してください。
+
+    python benchmarks/run_benchmarks.py --update-baseline   # ベースラインを作成・更新
+    python benchmarks/run_benchmarks.py                     # 計測してベースラインと比較
+    python benchmarks/run_benchmarks.py --suites micro e2e --threshold 0.3 --output result.json
+
+リクエストごとのログは標準エラーに出るので、結果だけを見る場合は 2>/dev/null を付けてください。
+ベースラインより遅くなった項目があると終了コード1を返します。
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 計測対象はスパンの生成までとし、送信はしない
+os.environ.setdefault("TRACE_EXPORTERS", "none")
+
+import httpx
+
+import main
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# 固定のクエリセット（種類ごとの傾向を見るため、種類は結果に残す）
+QUERY_SET = {
+    "rare": ["ahab", "woodhouse", "wonderland", "elinor"],
+    "common": ["time", "good", "great", "little"],
+    "multi_word": ["white whale", "captain ahab sea", "king of denmark", "love and marriage"],
+    "stopwords_only": ["the and of", "to be or not to be", "it is what it is"],
+    "no_match": ["xyzzyplugh", "qwertyuiopasdf"],
+}
+
+# ブール検索だけで使う構文のクエリ（上のクエリは空白区切りの AND として計測する）
+BOOLEAN_QUERY_SET = {
+    "phrase": ['"white whale"', '"captain ahab"', '"king of denmark"', '"poor little thing"'],
+    "operators": ["whale AND NOT ahab", "(king OR queen) AND denmark", "love OR marriage", '"white whale" OR leviathan'],
+}
+
+MICRO_METHODS = ["tfidf", "bm25", "bm25_sparse", "bm25_pruned"]
+PASSAGE_MICRO_METHODS = ["tfidf_passage", "bm25_passage", "bm25_pruned_passage"]
+E2E_METHODS = ["tfidf", "bm25", "bm25_sparse"]
+
+
+def percentile(values, ratio: float) -> float:
+    """最近順位法のパーセンタイル"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(ratio * len(ordered)) - 1)]
+
+
+def summarize(timings) -> dict:
+    """秒単位の計測値をマイクロ秒の統計量にまとめる"""
+    return {
+        "count": len(timings),
+        "median_us": round(statistics.median(timings) * 1e6, 2),
+        "p95_us": round(percentile(timings, 0.95) * 1e6, 2),
+        "mean_us": round(statistics.fmean(timings) * 1e6, 2),
+    }
+
+
+def time_calls(func, args_list, iterations: int, warmup: int = 3) -> dict:
+    """args_list の各引数で func を iterations 回ずつ呼び、1回あたりの統計量を返す"""
+    for args in args_list[:warmup]:
+        func(*args)
+    timings = []
+    for _ in range(iterations):
+        for args in args_list:
+            start = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def run_micro(iterations: int) -> dict:
+    """関数単位のマイクロベンチマーク（キャッシュを通さず直接呼ぶ）"""
+    results = {}
+    search_functions = {
+        "tfidf": main.tfidf_search,
+        "bm25": main.bm25_search,
+        "bm25_sparse": lambda query: main.bm25_search(query, engine="sparse"),
+        "tfidf_passage": lambda query: main.tfidf_search(query, granularity="passage"),
+        "bm25_passage": lambda query: main.bm25_search(query, engine="sparse", granularity="passage"),
+        "bm25_pruned": lambda query: main.bm25_search(query, engine="pruned"),
+        "bm25_pruned_passage": lambda query: main.bm25_search(query, engine="pruned", granularity="passage"),
+        "boolean": main.boolean_search,
+    }
+    methods = MICRO_METHODS + (PASSAGE_MICRO_METHODS if main.passage_index is not None else [])
+    boolean_enabled = main.positional_index is not None
+    if boolean_enabled:
+        methods = methods + ["boolean"]
+
+    for category, queries in QUERY_SET.items():
+        query_args = [(query,) for query in queries]
+        results[f"preprocess_text.{category}"] = time_calls(main.preprocess_text, query_args, iterations)
+        for method in methods:
+            results[f"{method}_search.{category}"] = time_calls(search_functions[method], query_args, iterations)
+    for category, queries in (BOOLEAN_QUERY_SET.items() if boolean_enabled else []):
+        results[f"boolean_search.{category}"] = time_calls(main.boolean_search, [(query,) for query in queries], iterations)
+
+    # スニペット生成（クエリ語を含む書籍・含まない書籍の両方を含むよう先頭の数冊を使う）
+    snippet_args = [(main.books_data.text_bytes(i), i, query)
+                    for i in range(min(4, len(main.books_data)))
+                    for query in QUERY_SET["rare"] + QUERY_SET["multi_word"]]
+    results["get_snippet"] = time_calls(main.snippet_index.get_snippet, snippet_args, max(1, iterations // 4))
+
+    all_queries = [query for queries in QUERY_SET.values() for query in queries]
+    for method in main.BATCH_SEARCH_METHODS:
+        results[f"batch_search.{method}"] = time_calls(main.batch_search, [(all_queries, method)], iterations)
+
+    # 書籍の追加（1冊ずつ新しいセグメントになる。既存のコーパスの大きさには依存しない）と追加後の検索
+    # 計測後は起動時のインデックスに戻す
+    ingest_text = " ".join(main.books_data.text(0).split()[:2000]) if len(main.books_data) else "benchmark"
+    book_numbers = itertools.count()
+
+    def ingest_book():
+        main.segmented_index.add_books([{"id": f"benchmark-{next(book_numbers)}", "title": "Benchmark",
+                                         "author": "Benchmark", "text": ingest_text}])
+
+    try:
+        results["ingest_book"] = time_calls(ingest_book, [()], iterations)
+        query_args = [(query,) for query in QUERY_SET["multi_word"]]
+        for method in MICRO_METHODS + (["boolean"] if boolean_enabled else []):
+            results[f"{method}_search.segmented"] = time_calls(search_functions[method], query_args, iterations)
+    finally:
+        main.reset_segmented_index()
+    return results
+
+
+async def run_startup() -> dict:
+    """startup_event の所要時間（一時ディレクトリのスナップショットで構築と読み込みを計測）"""
+    results = {}
+    original_dir, original_enabled = main.INDEX_SNAPSHOT_DIR, main.INDEX_SNAPSHOT_ENABLED
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        main.INDEX_SNAPSHOT_DIR = snapshot_dir
+        try:
+            for name, enabled in (("build", False), ("build_and_save", True), ("snapshot_load", True)):
+                main.INDEX_SNAPSHOT_ENABLED = enabled
+                start = time.perf_counter()
+                await main.startup_event()
+                results[f"startup.{name}"] = summarize([time.perf_counter() - start])
+        finally:
+            main.INDEX_SNAPSHOT_DIR, main.INDEX_SNAPSHOT_ENABLED = original_dir, original_enabled
+    return results
+
+
+async def run_e2e(requests_per_method: int, concurrency: int) -> dict:
+    """ASGI クライアントから同時にリクエストを送り、スループットとレイテンシを計測"""
+    all_queries = [query for queries in QUERY_SET.values() for query in queries]
+    workloads = {method: [f"/search?q={query}&method={method}" for query in all_queries] for method in E2E_METHODS}
+    workloads["compare"] = [f"/search/compare?q={query}" for query in all_queries]
+
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for name, paths in workloads.items():
+            pending, timings, errors = list(paths), [], 0
+
+            async def worker():
+                nonlocal errors
+                while pending:
+                    path = pending.pop()
+                    start = time.perf_counter()
+                    response = await client.get(path)
+                    timings.append(time.perf_counter() - start)
+                    # 空クエリ扱いの 400 以外はエラーとして数える
+                    if response.status_code not in (200, 400):
+                        errors += 1
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))  # ウォームアップ（各クエリ1回）
+            pending = [paths[i % len(paths)] for i in range(requests_per_method)]
+            timings.clear()
+            errors = 0
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+
+            results[f"e2e.{name}"] = {
+                "count": len(timings),
+                "errors": errors,
+                "throughput_rps": round(len(timings) / elapsed, 1),
+                "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+                "p95_ms": round(percentile(timings, 0.95) * 1000, 3),
+                "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+            }
+    return results
+
+
+# 比較する指標と、大きい方が良いかどうか（p95 は回数が少ないと揺れが大きいので表示のみ）
+COMPARED_METRICS = {"median_us": False, "p50_ms": False, "throughput_rps": True}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """ベースラインより threshold 以上悪化した (項目, 指標, ベースライン, 今回) のリスト"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in current or metric not in previous or not previous[metric]:
+                continue
+            change = (current[metric] - previous[metric]) / previous[metric]
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((name, metric, previous[metric], current[metric]))
+    return regressions
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "books": len(main.books_data),
+        "executor": main.search_executor.stats()["mode"],
+    }
+
+
+def print_results(results: dict, baseline: dict) -> None:
+    print(f"\n{'benchmark':<36}{'median/p50':>16}{'p95':>16}{'rps':>10}{'vs baseline':>14}")
+    for name, values in results.items():
+        if "median_us" in values:
+            primary, unit, p95, rps = values["median_us"], "µs", values["p95_us"], ""
+            base = baseline.get(name, {}).get("median_us")
+        else:
+            primary, unit, p95, rps = values["p50_ms"], "ms", values["p95_ms"], f"{values['throughput_rps']:.1f}"
+            base = baseline.get(name, {}).get("p50_ms")
+        delta = f"{(primary - base) / base:+.1%}" if base else "-"
+        print(f"{name:<36}{primary:>13,.1f} {unit}{p95:>13,.1f} {unit}{rps:>10}{delta:>14}")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Search backend benchmark suite")
+    parser.add_argument("--suites", nargs="+", default=["micro", "startup", "e2e"], choices=["micro", "startup", "e2e"])
+    parser.add_argument("--iterations", type=int, default=20, help="micro: クエリごとの呼び出し回数")
+    parser.add_argument("--requests", type=int, default=200, help="e2e: 手法ごとのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=8, help="e2e: 同時リクエスト数")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="ベースラインのJSONファイル")
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果でベースラインを上書き")
+    parser.add_argument("--threshold", type=float, default=0.2, help="悪化とみなす変化率（0.2 = 20%%）")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    # 結果キャッシュを通すと2回目以降の計測が検索処理を含まなくなるので無効にする
+    main.search_cache.enabled = False
+    # startup_event でインデックスの準備が終わるまで待つ（startup はウォームアップを含めずに計測）
+    main.INDEX_BUILD_IN_BACKGROUND = False
+    main.WARMUP_ENABLED = False
+
+    results = {}
+    if "startup" in args.suites:
+        results.update(asyncio.run(run_startup()))
+    else:
+        asyncio.run(main.startup_event())
+    if "micro" in args.suites:
+        results.update(run_micro(args.iterations))
+    if "e2e" in args.suites:
+        # /search はリクエストごとにトレースヘッダーの有無を標準出力に書くので、計測中は捨てる
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results.update(asyncio.run(run_e2e(args.requests, args.concurrency)))
+
+    report = {"environment": environment(), "results": results}
+    baseline_report = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline_report = json.load(f)
+    baseline = baseline_report.get("results", {})
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 ベースラインを更新しました: {args.baseline}")
+        return
+
+    if not baseline:
+        print(f"\n⚠️  ベースラインがありません（--update-baseline で作成）: {args.baseline}")
+        return
+    if baseline_report.get("environment") != report["environment"]:
+        print(f"\n⚠️  ベースラインと計測環境が異なります: {baseline_report.get('environment')} -> {report['environment']}")
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n❌ ベースラインより {args.threshold:.0%} 以上悪化: {len(regressions)} 件")
+        for name, metric, previous, current in regressions:
+            print(f"   {name} {metric}: {previous} -> {current}")
+        sys.exit(1)
+    print(f"\n✅ ベースラインからの悪化なし（閾値 {args.threshold:.0%}）")
+
+
+if __name__ == "__main__":
+    main_bench()
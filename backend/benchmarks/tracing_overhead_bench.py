@@ -0,0 +1,98 @@
+"""
+トレースのオーバーヘッド計測
+
+スパンの詳細度（request / stage / document）とサンプリング比率の組み合わせごとに、
+perform_search（tfidf / bm25、結果キャッシュ無効）の1回あたりの所要時間を計測します。
+スパンは BatchSpanProcessor 経由で何もしないエクスポーターに渡すため、
+スパンの生成・属性設定・キュー投入までのコストが含まれ、ネットワーク送信は含まれません。
+
+    python benchmarks/tracing_overhead_bench.py
+    python benchmarks/tracing_overhead_bench.py --iterations 500 --ratios 1.0 0.1 0.0
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("INDEX_SNAPSHOT_ENABLED", "true")
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+import main
+import tracing_system
+
+QUERIES = ["whale", "white whale", "captain ahab sea", "love marriage", "king denmark",
+           "alice wonderland", "heaven earth", "emma woodhouse"]
+
+
+class NullSpanExporter(SpanExporter):
+    """受け取ったスパン数だけを数えるエクスポーター"""
+
+    def __init__(self):
+        self.exported = 0
+
+    def export(self, spans):
+        self.exported += len(spans)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def measure(method: str, iterations: int) -> float:
+    """1回あたりの中央値（マイクロ秒）"""
+    timings = []
+    for i in range(iterations):
+        query = QUERIES[i % len(QUERIES)]
+        start = time.perf_counter()
+        main.perform_search(query, search_method=method)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e6
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Tracing overhead per span level and sampling ratio")
+    parser.add_argument("--iterations", type=int, default=300, help="組み合わせごとの検索回数")
+    parser.add_argument("--ratios", type=float, nargs="+", default=[1.0, 0.1, 0.0], help="サンプリング比率")
+    parser.add_argument("--methods", nargs="+", default=["tfidf", "bm25"], help="検索手法")
+    parser.add_argument("--queries", nargs="+", default=QUERIES, help="検索クエリ")
+    args = parser.parse_args()
+    QUERIES[:] = args.queries
+
+    main.INDEX_BUILD_IN_BACKGROUND = False
+    main.WARMUP_ENABLED = False
+    asyncio.run(main.startup_event())
+    main.search_cache.enabled = False
+
+    print(f"\n📊 perform_search 中央値 µs（{args.iterations} 回）")
+    header = f"{'level':<10}{'ratio':>7}" + "".join(f"{method:>12}" for method in args.methods) + f"{'spans/search':>14}"
+    print(header)
+
+    for level in tracing_system.SPAN_LEVELS:
+        for ratio in args.ratios:
+            exporter = NullSpanExporter()
+            provider = TracerProvider(sampler=ParentBased(root=TraceIdRatioBased(ratio)))
+            provider.add_span_processor(BatchSpanProcessor(exporter))
+            main.tracer = provider.get_tracer("tracing_overhead_bench")
+            tracing_system.set_span_level(level)
+
+            row = f"{level:<10}{ratio:>7.2f}"
+            for method in args.methods:
+                measure(method, 20)  # ウォームアップ
+                micros = measure(method, args.iterations)
+                row += f"{micros:>12.1f}"
+            provider.force_flush()
+            searches = (args.iterations + 20) * len(args.methods)
+            row += f"{exporter.exported / searches:>14.1f}"
+            provider.shutdown()
+            print(row)
+
+
+if __name__ == "__main__":
+    main_bench()
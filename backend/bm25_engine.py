@@ -0,0 +1,245 @@
+"""
+疎行列ベースのBM25スコアリングエンジン
+
+rank_bm25.BM25Okapi.get_scores は文書ごとの辞書を Python でループするため、
+単語×文書のCSR行列（出現回数）を持ち、クエリ単語の行をまとめて取り出して
+ベクトル演算で合計します。IDFと文書長の正規化項は構築時に計算済みです。
+IDF（負値の epsilon 置き換えを含む）は BM25Okapi と同じ式・同じ順序で計算するため、
+スコアは浮動小数点誤差の範囲で一致します。
+文書ごとの単語辞書は持たず、単語は整数IDで扱います。
+"""
+
+import math
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class SparseBM25:
+    """単語×文書のCSR行列によるBM25（Okapi）"""
+
+    def __init__(self, vocabulary: List[str], term_doc_tf: csr_matrix, doc_len: np.ndarray, idf: np.ndarray,
+                 k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25, average_idf: float = 0.0):
+        """
+        Args:
+            vocabulary: 単語ID順の単語リスト
+            term_doc_tf: 単語×文書の出現回数（CSR）
+            doc_len: 文書長（トークン数）
+            idf: 単語ID順のIDF
+            k1, b, epsilon: BM25パラメータ
+            average_idf: 負値置き換え前のIDFの平均（保存・BM25Okapi への変換用）
+        """
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.term_doc_tf = term_doc_tf
+        self.doc_len = np.asarray(doc_len, dtype=np.float64)
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.average_idf = average_idf
+        self.corpus_size = len(self.doc_len)
+        self.avgdl = float(self.doc_len.mean()) if self.corpus_size else 0.0
+        # 文書長による正規化項 k1 * (1 - b + b * dl / avgdl)
+        if self.corpus_size:
+            self.length_norm = self.k1 * (1 - self.b + self.b * self.doc_len / self.avgdl)
+        else:
+            self.length_norm = np.zeros(0, dtype=np.float64)
+        self._weight_matrix = None
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[Sequence[str]], k1: float = 1.5, b: float = 0.75,
+                       epsilon: float = 0.25) -> "SparseBM25":
+        """トークン列の文書から構築（BM25Okapi(documents, k1, b, epsilon) と同じ統計量）
+
+        単語IDは BM25Okapi の語彙と同じく初出順に振ります。
+        """
+        term_ids = {}
+        indptr = [0]
+        indices = []
+        data = []
+        doc_len = []
+        for tokens in documents:
+            counts = Counter(tokens)
+            indices.extend(term_ids.setdefault(term, len(term_ids)) for term in counts)
+            data.extend(counts.values())
+            indptr.append(len(indices))
+            doc_len.append(len(tokens))
+
+        corpus_size = len(doc_len)
+        doc_term_tf = csr_matrix(
+            (np.asarray(data, dtype=np.int32), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+            shape=(corpus_size, len(term_ids)),
+        )
+        del data, indices, indptr
+
+        # BM25Okapi._calc_idf と同じ計算（math.log と逐次加算で値を一致させる）
+        document_frequency = np.bincount(doc_term_tf.indices, minlength=len(term_ids)).tolist()
+        idf = [math.log(corpus_size - freq + 0.5) - math.log(freq + 0.5) for freq in document_frequency]
+        average_idf = sum(idf) / len(idf) if idf else 0.0
+        eps = epsilon * average_idf
+        idf = np.asarray([value if value >= 0 else eps for value in idf], dtype=np.float64)
+
+        return cls(list(term_ids), doc_term_tf.T.tocsr(), np.asarray(doc_len, dtype=np.int64), idf,
+                   k1=k1, b=b, epsilon=epsilon, average_idf=average_idf)
+
+    def to_arrays(self, prefix: str = "bm25") -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """スナップショット保存用の配列（単語×文書の出現回数CSR・文書長・IDF）とメタデータ（名前は prefix 付き）"""
+        arrays = {
+            f"{prefix}_tf_data": self.term_doc_tf.data.astype(np.int32, copy=False),
+            f"{prefix}_tf_indices": self.term_doc_tf.indices,
+            f"{prefix}_tf_indptr": self.term_doc_tf.indptr,
+            f"{prefix}_doc_len": self.doc_len.astype(np.int64),
+            f"{prefix}_idf": self.idf,
+        }
+        metadata = {
+            f"{prefix}_vocabulary": self.vocabulary,
+            f"{prefix}_params": {"k1": self.k1, "b": self.b, "epsilon": self.epsilon},
+            f"{prefix}_average_idf": self.average_idf,
+        }
+        return arrays, metadata
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any], prefix: str = "bm25") -> "SparseBM25":
+        """to_arrays() 形式の配列から復元（配列はコピーしない）"""
+        vocabulary = metadata[f"{prefix}_vocabulary"]
+        doc_len = np.asarray(arrays[f"{prefix}_doc_len"])
+        term_doc_tf = csr_matrix(
+            (arrays[f"{prefix}_tf_data"], arrays[f"{prefix}_tf_indices"], arrays[f"{prefix}_tf_indptr"]),
+            shape=(len(vocabulary), len(doc_len)),
+        )
+        params = metadata[f"{prefix}_params"]
+        return cls(vocabulary, term_doc_tf, doc_len, arrays[f"{prefix}_idf"], k1=params["k1"], b=params["b"],
+                   epsilon=params.get("epsilon", 0.25), average_idf=metadata.get(f"{prefix}_average_idf", 0.0))
+
+    def to_okapi(self):
+        """同じ統計量を持つ rank_bm25.BM25Okapi を作る（比較・検証用）
+
+        文書ごとの単語辞書を作るため、この索引の数倍のメモリを使います。
+        """
+        from rank_bm25 import BM25Okapi
+
+        bm25 = BM25Okapi.__new__(BM25Okapi)
+        bm25.k1 = self.k1
+        bm25.b = self.b
+        bm25.epsilon = self.epsilon
+        bm25.tokenizer = None
+
+        doc_term_tf = self.term_doc_tf.T.tocsr()
+        data = doc_term_tf.data.tolist()
+        indices = doc_term_tf.indices.tolist()
+        indptr = doc_term_tf.indptr.tolist()
+        vocabulary = self.vocabulary
+        bm25.doc_freqs = [
+            {vocabulary[indices[j]]: data[j] for j in range(indptr[i], indptr[i + 1])}
+            for i in range(len(indptr) - 1)
+        ]
+        bm25.doc_len = self.doc_len.astype(np.int64).tolist()
+        bm25.corpus_size = self.corpus_size
+        bm25.avgdl = sum(bm25.doc_len) / bm25.corpus_size if bm25.corpus_size else 0
+        bm25.idf = dict(zip(vocabulary, self.idf.tolist()))
+        bm25.average_idf = self.average_idf
+        return bm25
+
+    def get_scores(self, query_tokens: Sequence[str]) -> np.ndarray:
+        """全文書のBM25スコアを計算（BM25Okapi.get_scores と互換）
+
+        クエリ内で重複した単語は BM25Okapi と同じく回数分加算されます。
+        """
+        scores = np.zeros(self.corpus_size)
+        counts = Counter(self.term_ids[token] for token in query_tokens if token in self.term_ids)
+        if not counts:
+            return scores
+
+        term_ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        query_weights = self.idf[term_ids] * np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+
+        # クエリ単語の行をまとめて取り出し、非ゼロ要素ごとに寄与を計算して文書ごとに合計
+        rows = self.term_doc_tf[term_ids]
+        tf = rows.data.astype(np.float64)
+        doc_ids = rows.indices
+        row_weights = np.repeat(query_weights, np.diff(rows.indptr))
+        contributions = row_weights * (tf * (self.k1 + 1) / (tf + self.length_norm[doc_ids]))
+        scores += np.bincount(doc_ids, weights=contributions, minlength=self.corpus_size)
+        return scores
+
+    def document_frequency(self, term: str) -> int:
+        """単語を含む文書数（索引にない単語は0）"""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return 0
+        return int(self.term_doc_tf.indptr[term_id + 1] - self.term_doc_tf.indptr[term_id])
+
+    def frequent_terms(self, n: int) -> List[str]:
+        """含む文書数の多い順に n 語（同数なら単語ID順）"""
+        document_frequency = np.diff(self.term_doc_tf.indptr)
+        order = np.argsort(-document_frequency, kind="stable")[:n]
+        return [self.vocabulary[term_id] for term_id in order]
+
+    def get_scores_with_stats(self, query_tokens: Sequence[str], idf: Dict[str, float], avgdl: float) -> np.ndarray:
+        """IDFと平均文書長を外から与えて全文書のスコアを計算（セグメントに分けたインデックス用）
+
+        Args:
+            query_tokens: クエリのトークン列
+            idf: クエリの単語 -> コーパス全体のIDF
+            avgdl: コーパス全体の平均文書長
+        """
+        scores = np.zeros(self.corpus_size)
+        counts = Counter(token for token in query_tokens if token in self.term_ids)
+        if not counts:
+            return scores
+
+        term_ids = np.fromiter((self.term_ids[token] for token in counts), dtype=np.int64, count=len(counts))
+        query_weights = np.fromiter((idf[token] * count for token, count in counts.items()), dtype=np.float64, count=len(counts))
+
+        # 正規化項は平均文書長が変わるので、クエリ単語を含む文書の分だけその場で計算する
+        rows = self.term_doc_tf[term_ids]
+        tf = rows.data.astype(np.float64)
+        doc_ids = rows.indices
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_ids] / avgdl)
+        row_weights = np.repeat(query_weights, np.diff(rows.indptr))
+        contributions = row_weights * (tf * (self.k1 + 1) / (tf + length_norm))
+        scores += np.bincount(doc_ids, weights=contributions, minlength=self.corpus_size)
+        return scores
+
+    @property
+    def weight_matrix(self) -> csr_matrix:
+        """単語×文書のBM25重み idf * tf * (k1 + 1) / (tf + 正規化項)（初回アクセス時に計算）
+
+        クエリに依存しないため、複数クエリのスコアは
+        「クエリ×単語の出現回数行列」との積1回で求まります。
+        """
+        if self._weight_matrix is None:
+            tf = self.term_doc_tf
+            data = tf.data.astype(np.float64)
+            term_ids = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+            weights = self.idf[term_ids] * (data * (self.k1 + 1) / (data + self.length_norm[tf.indices]))
+            self._weight_matrix = csr_matrix((weights, tf.indices, tf.indptr), shape=tf.shape)
+        return self._weight_matrix
+
+    def query_matrix(self, queries: Sequence[Sequence[str]]) -> csr_matrix:
+        """クエリ×単語の出現回数行列（未知語は無視）"""
+        indptr = [0]
+        indices = []
+        data = []
+        for query_tokens in queries:
+            counts = Counter(self.term_ids[token] for token in query_tokens if token in self.term_ids)
+            indices.extend(counts.keys())
+            data.extend(counts.values())
+            indptr.append(len(indices))
+        return csr_matrix(
+            (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(queries), len(self.vocabulary)),
+        )
+
+    def get_batch_scores(self, queries: Sequence[Sequence[str]]) -> np.ndarray:
+        """複数クエリのスコアを疎行列の積1回で計算
+
+        Returns:
+            (クエリ数, 文書数) のスコア行列
+        """
+        if not queries:
+            return np.zeros((0, self.corpus_size))
+        return (self.query_matrix(queries) @ self.weight_matrix).toarray()
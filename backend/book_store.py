@@ -0,0 +1,120 @@
+"""
+書籍メタデータと本文のコンパクトな保持
+
+書籍ごとの辞書と本文の str を持つ代わりに、全書籍の本文を1つの UTF-8 バッファ
+（スナップショットから読み込んだ場合はメモリマップ）とオフセット配列にまとめ、
+メタデータも項目ごとのリスト・配列で持ちます。
+本文が必要なとき（スニペットの文の切り出しなど）は該当範囲だけをデコードします。
+"""
+
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+
+class BookStore:
+    """読み取り専用の書籍ストア（位置 = インデックスの行番号）"""
+
+    __slots__ = ("book_ids", "titles", "authors", "word_counts", "text_buffer", "text_offsets", "_positions")
+
+    def __init__(self, book_ids: List[str], titles: List[str], authors: List[str], word_counts: np.ndarray,
+                 text_buffer: np.ndarray, text_offsets: np.ndarray):
+        """
+        Args:
+            book_ids, titles, authors: 書籍順のメタデータ
+            word_counts: 書籍順の単語数
+            text_buffer: 全書籍の本文を連結した UTF-8 バイト列（uint8）
+            text_offsets: 書籍 i の本文が text_buffer[offsets[i]:offsets[i+1]] になるオフセット
+        """
+        self.book_ids = book_ids
+        self.titles = titles
+        self.authors = authors
+        self.word_counts = np.asarray(word_counts, dtype=np.int64)
+        self.text_buffer = text_buffer
+        self.text_offsets = np.asarray(text_offsets, dtype=np.int64)
+        self._positions = {book_id: i for i, book_id in enumerate(book_ids)}
+
+    @classmethod
+    def empty(cls) -> "BookStore":
+        return cls([], [], [], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.book_ids)
+
+    def __contains__(self, book_id: str) -> bool:
+        return book_id in self._positions
+
+    def position(self, book_id: str) -> int:
+        return self._positions[book_id]
+
+    def metadata(self, index: int) -> Dict[str, Any]:
+        """書籍 index の id・title・author・word_count"""
+        return {
+            'id': self.book_ids[index],
+            'title': self.titles[index],
+            'author': self.authors[index],
+            'word_count': int(self.word_counts[index]),
+        }
+
+    def iter_metadata(self) -> Iterator[Dict[str, Any]]:
+        for index in range(len(self.book_ids)):
+            yield self.metadata(index)
+
+    def text_bytes(self, index: int) -> np.ndarray:
+        """書籍 index の本文（UTF-8、バッファのビューでコピーしない）"""
+        return self.text_buffer[self.text_offsets[index]:self.text_offsets[index + 1]]
+
+    def text(self, index: int) -> str:
+        """書籍 index の本文全体をデコードして返す"""
+        return self.text_bytes(index).tobytes().decode("utf-8")
+
+    @property
+    def nbytes(self) -> int:
+        """本文バッファとオフセット・単語数の配列のバイト数"""
+        return int(self.text_buffer.nbytes + self.text_offsets.nbytes + self.word_counts.nbytes)
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """スナップショット保存用の配列とメタデータ"""
+        arrays = {
+            "text_buffer": self.text_buffer,
+            "text_offsets": self.text_offsets,
+            "book_word_counts": self.word_counts,
+        }
+        metadata = {"books": [{'id': book_id, 'title': title, 'author': author}
+                              for book_id, title, author in zip(self.book_ids, self.titles, self.authors)]}
+        return arrays, metadata
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]) -> "BookStore":
+        """スナップショットの配列から復元（本文バッファはメモリマップのまま使う）"""
+        books = metadata["books"]
+        return cls([book['id'] for book in books], [book['title'] for book in books],
+                   [book['author'] for book in books], arrays["book_word_counts"],
+                   arrays["text_buffer"], arrays["text_offsets"])
+
+
+class BookStoreBuilder:
+    """書籍を1冊ずつ追加して BookStore を作る（本文の str は追加後に手放せる）"""
+
+    def __init__(self):
+        self.book_ids = []
+        self.titles = []
+        self.authors = []
+        self.word_counts = []
+        self._buffer = bytearray()
+        self._offsets = [0]
+
+    def add(self, book_id: str, title: str, author: str, word_count: int, raw_text: str) -> None:
+        self.book_ids.append(book_id)
+        self.titles.append(title)
+        self.authors.append(author)
+        self.word_counts.append(word_count)
+        self._buffer += raw_text.encode("utf-8")
+        self._offsets.append(len(self._buffer))
+
+    def build(self) -> BookStore:
+        text_buffer = np.frombuffer(bytes(self._buffer), dtype=np.uint8)
+        self._buffer = bytearray()
+        return BookStore(self.book_ids, self.titles, self.authors,
+                         np.asarray(self.word_counts, dtype=np.int64), text_buffer,
+                         np.asarray(self._offsets, dtype=np.int64))
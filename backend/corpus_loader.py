@@ -0,0 +1,154 @@
+"""
+Gutenbergコーパスの並列読み込み
+
+書籍ごとの読み込み（gutenberg.raw）・前処理（preprocess_text）・
+スニペット用の文インデックス計算・パッセージ分割をプロセスプールに分散し、結果をファイルIDの順序どおりに返します。
+ワーカーはトレースやWebアプリの状態に触れません
+（スパンは親プロセス側で、ワーカーが計測した時刻を使って作成します）。
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from nltk.corpus import gutenberg
+
+from passages import index_book_passages
+from snippets import index_book_sentences
+from text_processing import preprocess_text
+
+
+def parse_book_metadata(fileid: str) -> Tuple[str, str]:
+    """ファイル名からタイトルと著者を推定
+
+    Returns:
+        (タイトル, 著者)
+    """
+    if '-' in fileid:
+        parts = fileid.replace('.txt', '').split('-')
+        author = parts[0].replace('_', ' ').title()
+        title = '-'.join(parts[1:]).replace('_', ' ').title() if len(parts) > 1 else fileid
+    else:
+        title = fileid.replace('.txt', '').replace('_', ' ').title()
+        author = "Unknown"
+    return title, author
+
+
+def load_book(fileid: str, passages: Optional[Tuple[str, int]] = None) -> Dict[str, Any]:
+    """1冊を読み込んで前処理する（ワーカープロセスで実行）
+
+    例外はワーカー内で捕捉し、結果の 'error' に格納して返します。
+
+    Args:
+        fileid: ファイルID
+        passages: パッセージ分割の (方式, 語数)。None なら分割しない
+
+    Returns:
+        book_id, book（メタデータと本文）, processed_text, sentences（文インデックス）,
+        passages（パッセージ境界と前処理済みテキスト）, error,
+        start_ns / end_ns（処理時間、エポックナノ秒）, worker_pid を含む辞書
+    """
+    result = {
+        'book_id': fileid,
+        'book': None,
+        'processed_text': None,
+        'sentences': None,
+        'passages': None,
+        'error': None,
+        'start_ns': time.time_ns(),
+        'end_ns': None,
+        'worker_pid': os.getpid(),
+    }
+    try:
+        raw_text = gutenberg.raw(fileid)
+        title, author = parse_book_metadata(fileid)
+        result['processed_text'] = preprocess_text(raw_text)
+        result['sentences'] = index_book_sentences(raw_text)
+        if passages is not None:
+            result['passages'] = index_book_passages(raw_text, *passages)
+        result['book'] = {
+            'id': fileid,
+            'title': title,
+            'author': author,
+            'raw_text': raw_text,
+            'word_count': len(raw_text.split())
+        }
+    except Exception as e:
+        result['error'] = str(e)
+    result['end_ns'] = time.time_ns()
+    return result
+
+
+def default_workers() -> int:
+    """ワーカー数（CORPUS_LOADER_WORKERS、未指定時はCPUコア数）"""
+    configured = os.getenv("CORPUS_LOADER_WORKERS")
+    if configured:
+        return max(1, int(configured))
+    return os.cpu_count() or 1
+
+
+def start_method() -> str:
+    """ワーカーの起動方式（CORPUS_LOADER_START_METHOD、未指定時は fork が使えれば fork）
+
+    fork はアプリ本体の再 import が不要なため起動が速く、
+    ワーカーは前処理しか行わないので親のスレッド状態の影響を受けません。
+    """
+    configured = os.getenv("CORPUS_LOADER_START_METHOD")
+    if configured:
+        return configured
+    return "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def load_books(fileids: List[str], workers: Optional[int] = None,
+               passages: Optional[Tuple[str, int]] = None) -> Iterator[Dict[str, Any]]:
+    """書籍を並列に読み込み、fileids の順序で結果を返す
+
+    大きいファイルから先に投入して処理時間の偏りを抑えますが、
+    結果の順序は常に fileids と同じです（インデックスの行順を決定的にするため）。
+
+    Args:
+        fileids: 読み込むファイルIDのリスト
+        workers: ワーカープロセス数（1以下なら現在のプロセスで逐次実行）
+        passages: パッセージ分割の (方式, 語数)。None なら分割しない
+
+    Yields:
+        load_book() の結果
+    """
+    if workers is None:
+        workers = default_workers()
+    workers = min(workers, len(fileids))
+
+    if workers <= 1:
+        for fileid in fileids:
+            yield load_book(fileid, passages)
+        return
+
+    def file_size(fileid: str) -> int:
+        try:
+            return gutenberg.abspath(fileid).file_size()
+        except Exception:
+            return 0
+
+    submit_order = sorted(fileids, key=file_size, reverse=True)
+    context = multiprocessing.get_context(start_method())
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {fileid: executor.submit(load_book, fileid, passages) for fileid in submit_order}
+        for fileid in fileids:
+            try:
+                yield futures[fileid].result()
+            except Exception as e:
+                # ワーカープロセス自体の異常終了など
+                now = time.time_ns()
+                yield {
+                    'book_id': fileid,
+                    'book': None,
+                    'processed_text': None,
+                    'sentences': None,
+                    'passages': None,
+                    'error': str(e),
+                    'start_ns': now,
+                    'end_ns': now,
+                    'worker_pid': None,
+                }
@@ -0,0 +1,208 @@
+"""
+検索インデックスのスナップショット
+
+TF-IDF・BM25インデックスと書籍ストアを、バージョン付きの
+ディスク形式で保存・読み込みするモジュールです。
+起動時は保存済みの配列をメモリマップで読み込み、コーパスの再処理を避けます。
+
+ディレクトリ構成:
+    manifest.json   フォーマットバージョン・コーパス指紋・各ファイルのチェックサム
+    metadata.json   書籍メタデータ・語彙などのJSONで表現するデータ
+    <name>.npy      CSR行列・IDF・文書長・本文バッファ・文オフセットなどのnumpy配列
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Iterable, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# 保存形式を変更したら必ず上げる（古いスナップショットは再構築される）
+# 3: 文オフセットをバイト単位に変更、BM25 を単語×文書の行列で保存、書籍の単語数を配列で保存
+SNAPSHOT_FORMAT_VERSION = 3
+
+MANIFEST_FILE = "manifest.json"
+METADATA_FILE = "metadata.json"
+
+
+class SnapshotError(Exception):
+    """スナップショットが存在しない・古い・壊れている場合の例外"""
+
+
+class IndexSnapshot:
+    """読み込まれたスナップショット（配列はメモリマップ）"""
+
+    def __init__(self, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any], manifest: Dict[str, Any]):
+        self.arrays = arrays
+        self.metadata = metadata
+        self.manifest = manifest
+
+
+def compute_fingerprint(files: Iterable[Tuple[str, int]], settings: Dict[str, Any]) -> str:
+    """コーパス（ファイルIDとサイズ）とインデックス設定から指紋を計算
+
+    Args:
+        files: (ファイルID, バイトサイズ) のリスト
+        settings: インデックス構築に影響する設定値
+
+    Returns:
+        SHA-256の16進文字列
+    """
+    payload = {
+        "files": sorted([fileid, int(size)] for fileid, size in files),
+        "settings": settings,
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_snapshot(directory: str, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any], fingerprint: str) -> None:
+    """スナップショットを書き出す
+
+    一時ディレクトリに全ファイルを書いてから置き換えるため、
+    書き込み途中のスナップショットが読まれることはありません。
+
+    Args:
+        directory: 保存先ディレクトリ
+        arrays: 配列名 -> numpy配列
+        metadata: JSONで保存するメタデータ
+        fingerprint: compute_fingerprint() の結果
+    """
+    directory = os.path.abspath(directory)
+    tmp_dir = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    try:
+        checksums = {}
+        for name, array in arrays.items():
+            filename = f"{name}.npy"
+            path = os.path.join(tmp_dir, filename)
+            np.save(path, np.ascontiguousarray(array), allow_pickle=False)
+            checksums[filename] = _file_sha256(path)
+
+        metadata_path = os.path.join(tmp_dir, METADATA_FILE)
+        with open(metadata_path, "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        checksums[METADATA_FILE] = _file_sha256(metadata_path)
+
+        manifest = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "fingerprint": fingerprint,
+            "created_at": time.time(),
+            "files": checksums,
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+
+        old_dir = f"{directory}.old-{os.getpid()}"
+        if os.path.exists(directory):
+            os.rename(directory, old_dir)
+        os.rename(tmp_dir, directory)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_snapshot(directory: str, fingerprint: str, verify_checksums: bool = True) -> IndexSnapshot:
+    """スナップショットを読み込む
+
+    Args:
+        directory: スナップショットのディレクトリ
+        fingerprint: 現在のコーパスと設定の指紋
+        verify_checksums: ファイルのチェックサムを検証するか
+
+    Returns:
+        IndexSnapshot（配列は読み取り専用のメモリマップ）
+
+    Raises:
+        SnapshotError: 存在しない・バージョン違い・指紋不一致・チェックサム不一致の場合
+    """
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise SnapshotError(f"manifest not found: {manifest_path}")
+
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"manifest unreadable: {e}")
+
+    version = manifest.get("format_version")
+    if version != SNAPSHOT_FORMAT_VERSION:
+        raise SnapshotError(f"format version mismatch: {version} != {SNAPSHOT_FORMAT_VERSION}")
+    if manifest.get("fingerprint") != fingerprint:
+        raise SnapshotError("corpus fingerprint mismatch")
+
+    files = manifest.get("files", {})
+    for filename, expected in files.items():
+        path = os.path.join(directory, filename)
+        if not os.path.exists(path):
+            raise SnapshotError(f"missing file: {filename}")
+        if verify_checksums and _file_sha256(path) != expected:
+            raise SnapshotError(f"checksum mismatch: {filename}")
+
+    arrays = {}
+    for filename in files:
+        if filename.endswith(".npy"):
+            arrays[filename[:-len(".npy")]] = np.load(os.path.join(directory, filename), mmap_mode="r", allow_pickle=False)
+
+    with open(os.path.join(directory, METADATA_FILE), encoding="utf-8") as f:
+        metadata = json.load(f)
+
+    return IndexSnapshot(arrays, metadata, manifest)
+
+
+# --- インデックス <-> 配列 変換 ---
+
+def tfidf_to_arrays(vectorizer: TfidfVectorizer, matrix, prefix: str = "tfidf") -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """TF-IDFベクトライザーと文書行列を配列とメタデータに変換（名前は prefix 付き）"""
+    matrix = csr_matrix(matrix)
+    vocabulary = [None] * len(vectorizer.vocabulary_)
+    for term, column in vectorizer.vocabulary_.items():
+        vocabulary[column] = term
+
+    arrays = {
+        f"{prefix}_data": matrix.data,
+        f"{prefix}_indices": matrix.indices,
+        f"{prefix}_indptr": matrix.indptr,
+        f"{prefix}_idf": np.asarray(vectorizer.idf_, dtype=np.float64),
+    }
+    metadata = {
+        f"{prefix}_shape": list(matrix.shape),
+        f"{prefix}_vocabulary": vocabulary,
+    }
+    return arrays, metadata
+
+
+def tfidf_from_arrays(arrays: Dict[str, np.ndarray], metadata: Dict[str, Any], vectorizer_params: Dict[str, Any],
+                      prefix: str = "tfidf"):
+    """配列から学習済みTF-IDFベクトライザーと文書行列を復元
+
+    Returns:
+        (TfidfVectorizer, csr_matrix)
+    """
+    vectorizer = TfidfVectorizer(**vectorizer_params)
+    vectorizer.vocabulary_ = {term: i for i, term in enumerate(metadata[f"{prefix}_vocabulary"])}
+    vectorizer.idf_ = np.asarray(arrays[f"{prefix}_idf"])
+
+    matrix = csr_matrix(
+        (arrays[f"{prefix}_data"], arrays[f"{prefix}_indices"], arrays[f"{prefix}_indptr"]),
+        shape=tuple(metadata[f"{prefix}_shape"]),
+        copy=False,
+    )
+    return vectorizer, matrix
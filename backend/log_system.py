@@ -3,38 +3,442 @@ JSON構造化ログシステム
 
 このモジュールはアプリケーション全体で使用するJSON形式の
 構造化ログ機能を提供します。
+非同期モード（LOG_ASYNC=true）では、ログレコードを上限付きのキューに積むだけで
+リクエスト処理に戻り、JSONへの整形と書き込みはバックグラウンドのスレッドが
+まとめて行います。
+大量に出るイベントは event_type ごとの間引き（LOG_SAMPLING）と、
+一定間隔の集計レコードへの置き換え（LOG_AGGREGATE）でログ量を抑えられます。
 """
 
+import atexit
 import json
 import logging
+import math
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from collections import Counter
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Any, Dict, Iterable, List, Optional
+
+
+# LogRecord の標準属性（追加フィールドとして出力しないキー）
+RESERVED_KEYS = frozenset([
+    'name', 'msg', 'args', 'levelname', 'levelno', 'pathname', 'filename',
+    'module', 'exc_info', 'exc_text', 'stack_info', 'lineno', 'funcName',
+    'created', 'msecs', 'relativeCreated', 'thread', 'threadName',
+    'processName', 'process', 'getMessage', 'event_type',
+])
+
+JSON_ENCODERS = ("auto", "json", "orjson")
+
+
+def _load_orjson():
+    """orjson があれば返す（任意依存）"""
+    try:
+        import orjson
+        return orjson
+    except ImportError:
+        return None
 
 
 class JsonFormatter(logging.Formatter):
-    """JSON形式でログを出力するフォーマッター"""
-    
+    """JSON形式でログを出力するフォーマッター
+
+    ログ量はQPSに比例するため、1件あたりの処理を軽くしています。
+    - 追加フィールドのキー一覧は event_type ごとにキャッシュし、毎回 __dict__ 全体を判定しない
+    - タイムスタンプはレコードの発生時刻から作り、秒までの部分は同じ秒の間使い回す
+    - json_encoder が "auto" で orjson がインストールされていれば orjson で直列化する
+    """
+
+    # event_type ごとのキャッシュの上限（event_type の種類は有限だが念のため）
+    MAX_LAYOUTS = 1024
+
+    def __init__(self, json_encoder: str = "auto"):
+        super().__init__()
+        if json_encoder not in JSON_ENCODERS:
+            raise ValueError(f"Unsupported JSON encoder: {json_encoder}. Available encoders: {JSON_ENCODERS}")
+        self._orjson = _load_orjson() if json_encoder in ("auto", "orjson") else None
+        if json_encoder == "orjson" and self._orjson is None:
+            print("⚠️  orjson がインストールされていないため標準の json でログを出力します")
+        self.json_encoder = "orjson" if self._orjson is not None else "json"
+        # json.dumps にオプションを渡すと毎回エンコーダーが作られるため、一度だけ作って使い回す
+        self._encode = json.JSONEncoder(ensure_ascii=False, default=str).encode
+        self._layouts = {}
+        # (秒, その秒の "YYYY-MM-DDTHH:MM:SS")。スレッド間で食い違わないよう組で差し替える
+        self._second_cache = (None, "")
+
+    def _timestamp(self, created: float) -> str:
+        """datetime.fromtimestamp(created, timezone.utc).isoformat() と同じ文字列を返す"""
+        second = int(created)
+        microsecond = round((created - second) * 1e6)
+        if microsecond >= 1000000:
+            second += 1
+            microsecond -= 1000000
+        cached_second, prefix = self._second_cache
+        if second != cached_second:
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            self._second_cache = (second, prefix)
+        if microsecond:
+            return f"{prefix}.{microsecond:06d}+00:00"
+        return f"{prefix}+00:00"
+
+    def _extra_keys(self, attributes: Dict[str, Any], event_type: str) -> tuple:
+        """レコードの追加フィールドのキー一覧
+
+        同じ event_type・同じ属性数で、前回のキーが全て揃っていれば前回の一覧を使います。
+        """
+        cache_key = (event_type, len(attributes))
+        layout = self._layouts.get(cache_key)
+        if layout is not None and all(key in attributes for key in layout):
+            return layout
+        layout = tuple(key for key in attributes if key not in RESERVED_KEYS)
+        if len(self._layouts) < self.MAX_LAYOUTS:
+            self._layouts[cache_key] = layout
+        return layout
+
+    def _dumps(self, log_record: Dict[str, Any]) -> str:
+        if self._orjson is not None:
+            try:
+                return self._orjson.dumps(log_record, default=str, option=self._orjson.OPT_NON_STR_KEYS).decode("utf-8")
+            except TypeError:
+                # orjson が扱えない値（64bitを超える整数など）は標準の json にまかせる
+                pass
+        return self._encode(log_record)
+
     def format(self, record):
-        # タイムスタンプをISO 8601形式で追加
-        timestamp = datetime.now(timezone.utc).isoformat()
+        attributes = record.__dict__
+        event_type = attributes.get('event_type', 'unknown')
         
-        # 基本構造
+        # 基本構造（タイムスタンプはISO 8601形式。非同期書き込みでも発生時刻になるようレコードの時刻を使う）
         log_record = {
-            "timestamp": timestamp,
+            "timestamp": self._timestamp(record.created),
             "level": record.levelname,
-            "event": getattr(record, 'event_type', 'unknown'),
+            "event": event_type,
             "message": record.getMessage()
         }
         
         # 追加フィールドを追加
-        for key, value in record.__dict__.items():
-            if key not in ['name', 'msg', 'args', 'levelname', 'levelno', 'pathname', 'filename', 
-                          'module', 'exc_info', 'exc_text', 'stack_info', 'lineno', 'funcName', 
-                          'created', 'msecs', 'relativeCreated', 'thread', 'threadName', 
-                          'processName', 'process', 'getMessage', 'event_type']:
-                log_record[key] = value
+        for key in self._extra_keys(attributes, event_type):
+            log_record[key] = attributes[key]
         
-        return json.dumps(log_record, ensure_ascii=False, default=str)
+        return self._dumps(log_record)
+
+
+class AsyncBatchHandler(logging.Handler):
+    """ログレコードをキューに積み、バックグラウンドのスレッドでまとめて書き込むハンドラー
+
+    emit() はキューへの追加だけを行うため、出力先（コンテナの標準出力など）が
+    詰まっても呼び出し側のスレッドは待たされません。
+    キューが満杯のときは overflow に従い、"drop" なら破棄して件数を数え、
+    "block" なら block_timeout 秒まで空きを待ちます（待っても空かなければ破棄）。
+    破棄があった場合は、次の書き込み時に破棄件数を記録したレコードを出力します。
+    """
+
+    def __init__(self, stream=None, queue_size: int = 10000, batch_size: int = 256,
+                 flush_interval: float = 0.2, overflow: str = "drop", block_timeout: float = 1.0):
+        super().__init__()
+        if overflow not in ("drop", "block"):
+            raise ValueError(f"Unsupported overflow mode: {overflow}")
+        self.stream = stream if stream is not None else sys.stderr
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.write_errors = 0
+        self._reported_dropped = 0
+        self._stop = object()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._writer.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == "block":
+                try:
+                    self.queue.put(record, timeout=self.block_timeout)
+                    return
+                except queue.Full:
+                    pass
+            # 件数の更新はロックなし（GILの下で厳密さより速さを優先）
+            self.dropped += 1
+
+    def _drain(self, first) -> list:
+        """最初の1件に続けて、キューにある分を batch_size まで取り出す"""
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, records: list) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+
+        dropped = self.dropped
+        if dropped != self._reported_dropped:
+            lines.append(json.dumps({
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "level": "WARNING",
+                "event": "log_records_dropped",
+                "message": "ログキューが満杯のためレコードを破棄しました",
+                "dropped": dropped - self._reported_dropped,
+                "dropped_total": dropped,
+            }, ensure_ascii=False))
+            self._reported_dropped = dropped
+
+        if not lines:
+            return
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+            self.written += len(records)
+            self.batches += 1
+        except Exception:
+            self.write_errors += 1
+
+    def _run(self) -> None:
+        while True:
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = self._drain(first)
+            stop = any(record is self._stop for record in batch)
+            self._write([record for record in batch if record is not self._stop])
+            if stop:
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+        }
+
+    def close(self) -> None:
+        """キューに残ったレコードを書き出してからスレッドを停止（logging.shutdown からも呼ばれる）"""
+        if not self._closed:
+            self._closed = True
+            # 停止の目印は満杯でも必ず入れる（書き込みスレッドが取り出すまで待つ）
+            self.queue.put(self._stop)
+            self._writer.join(timeout=5.0)
+        super().close()
+
+
+class SamplingRule:
+    """1つの event_type の間引き規則
+
+    rate:  rate の確率で残す（0.0〜1.0）
+    count: interval 秒ごとに最初の limit 件だけ残す
+    """
+
+    def __init__(self, rate: Optional[float] = None, limit: Optional[int] = None, interval: float = 60.0):
+        self.rate = rate
+        self.limit = limit
+        self.interval = interval
+        self._window_start = 0.0
+        self._window_count = 0
+
+    @classmethod
+    def parse(cls, spec: str) -> "SamplingRule":
+        """"0.1"（確率）または "count:10/60"（60秒ごとに10件）を解釈"""
+        if spec.startswith("count:"):
+            limit, _, interval = spec[len("count:"):].partition("/")
+            return cls(limit=int(limit), interval=float(interval or 60))
+        rate = float(spec)
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError(f"sampling rate must be between 0 and 1: {spec}")
+        return cls(rate=rate)
+
+    def keep(self, now: float) -> bool:
+        """呼び出し元（LogPolicyFilter）のロック内で呼ばれる"""
+        if self.rate is not None:
+            return self.rate >= 1.0 or random.random() < self.rate
+        if now - self._window_start >= self.interval:
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+        return self._window_count <= self.limit
+
+
+class EventAggregate:
+    """集計期間中の1つの event_type の件数・所要時間・クエリ"""
+
+    def __init__(self):
+        self.count = 0
+        self.durations = []
+        self.queries = Counter()
+
+    def add(self, record: logging.LogRecord) -> None:
+        self.count += 1
+        duration = getattr(record, 'duration_ms', None)
+        if isinstance(duration, (int, float)):
+            self.durations.append(duration)
+        query = getattr(record, 'query', None)
+        if query is not None:
+            self.queries[query] += 1
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    """最近傍順位法によるパーセンタイル"""
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class LogPolicyFilter(logging.Filter):
+    """event_type ごとの間引きと集計を行うフィルター
+
+    - WARNING 以上のレコードは常に残す
+    - aggregate_events のレコードは件数・duration_ms の p50/p95・上位クエリに集計し、
+      interval 秒ごとに event="log_summary" のレコードとして出力する
+      （個々のレコードを残すかどうかは sampling の規則に従う）
+    - 間引いた件数は event="log_sampling_summary" として同じ間隔で出力する
+    """
+
+    def __init__(self, logger: logging.Logger, sampling: Optional[Dict[str, SamplingRule]] = None,
+                 aggregate_events: Iterable[str] = (), interval: float = 60.0, top_queries: int = 5):
+        super().__init__()
+        self.logger = logger
+        self.sampling = dict(sampling or {})
+        self.aggregate_events = frozenset(aggregate_events)
+        self.interval = interval
+        self.top_queries = top_queries
+        self._aggregates = {}
+        self._sampled = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+        if self.aggregate_events or self.sampling:
+            self._flusher = threading.Thread(target=self._run, name="log-summary", daemon=True)
+            self._flusher.start()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        event_type = getattr(record, 'event_type', None)
+        aggregate = event_type in self.aggregate_events
+        rule = self.sampling.get(event_type)
+        if not aggregate and rule is None:
+            return True
+
+        with self._lock:
+            if aggregate:
+                self._aggregates.setdefault(event_type, EventAggregate()).add(record)
+            if rule is None:
+                return True
+            keep = rule.keep(record.created)
+            counts = self._sampled.setdefault(event_type, [0, 0])
+            counts[0 if keep else 1] += 1
+            return keep
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self) -> None:
+        """集計期間を締めて集計レコードを出力"""
+        with self._lock:
+            aggregates, self._aggregates = self._aggregates, {}
+            sampled, self._sampled = self._sampled, {}
+
+        for event_type, aggregate in aggregates.items():
+            extra = {
+                "event_type": "log_summary",
+                "summarized_event": event_type,
+                "interval_seconds": self.interval,
+                "count": aggregate.count,
+            }
+            if aggregate.durations:
+                durations = sorted(aggregate.durations)
+                extra["duration_ms_p50"] = _percentile(durations, 0.50)
+                extra["duration_ms_p95"] = _percentile(durations, 0.95)
+                extra["duration_ms_max"] = durations[-1]
+            if aggregate.queries:
+                extra["top_queries"] = aggregate.queries.most_common(self.top_queries)
+            self.logger.info("ログ集計", extra=extra)
+
+        dropped = {event_type: {"kept": kept, "dropped": dropped}
+                   for event_type, (kept, dropped) in sampled.items() if dropped}
+        if dropped:
+            self.logger.info("ログ間引き", extra={"event_type": "log_sampling_summary", "interval_seconds": self.interval, "events": dropped})
+
+    def close(self) -> None:
+        """集計スレッドを止め、残っている集計を出力"""
+        self._stop.set()
+        if self._flusher is not None and self._flusher.is_alive():
+            self._flusher.join(timeout=1.0)
+        self.flush()
+
+
+def create_log_policy(logger: logging.Logger) -> Optional[LogPolicyFilter]:
+    """環境変数から間引き・集計のフィルターを作成（どちらも未設定なら None）
+
+    LOG_SAMPLING                    event_type=規則 のカンマ区切り
+                                    規則は確率（例: search_complete=0.1）または
+                                    期間ごとの件数（例: bm25_search_complete=count:10/60）
+    LOG_AGGREGATE                   集計する event_type のカンマ区切り（例: search_complete,bm25_search_complete）
+    LOG_AGGREGATE_INTERVAL_SECONDS  集計レコードの出力間隔（default: 60）
+    LOG_AGGREGATE_TOP_QUERIES       集計レコードに含める上位クエリ数（default: 5）
+    """
+    sampling = {}
+    for entry in filter(None, (part.strip() for part in os.getenv("LOG_SAMPLING", "").split(","))):
+        event_type, _, spec = entry.partition("=")
+        try:
+            sampling[event_type.strip()] = SamplingRule.parse(spec.strip())
+        except ValueError as e:
+            print(f"⚠️  LOG_SAMPLING の設定を無視します: {entry} ({e})")
+    aggregate_events = [part.strip() for part in os.getenv("LOG_AGGREGATE", "").split(",") if part.strip()]
+
+    if not sampling and not aggregate_events:
+        return None
+    return LogPolicyFilter(
+        logger,
+        sampling=sampling,
+        aggregate_events=aggregate_events,
+        interval=float(os.getenv("LOG_AGGREGATE_INTERVAL_SECONDS", "60")),
+        top_queries=int(os.getenv("LOG_AGGREGATE_TOP_QUERIES", "5")),
+    )
+
+
+def create_log_handler() -> logging.Handler:
+    """環境変数からログハンドラーを作成
+
+    LOG_ASYNC              true で非同期バッチ書き込み（default: false）
+    LOG_QUEUE_SIZE         キューの上限件数（default: 10000）
+    LOG_BATCH_SIZE         1回にまとめて書き込む最大件数（default: 256）
+    LOG_FLUSH_INTERVAL_MS  書き込みスレッドがキューを待つ間隔（default: 200）
+    LOG_OVERFLOW           キュー満杯時の動作 drop / block（default: drop）
+    LOG_BLOCK_TIMEOUT_MS   block 時に空きを待つ最大時間（default: 1000）
+
+    フォーマッターのJSONエンコーダーは LOG_JSON_ENCODER（auto / json / orjson、default: auto）で選びます。
+    """
+    if os.getenv("LOG_ASYNC", "false").lower() != "true":
+        return logging.StreamHandler()
+    return AsyncBatchHandler(
+        queue_size=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+        batch_size=int(os.getenv("LOG_BATCH_SIZE", "256")),
+        flush_interval=int(os.getenv("LOG_FLUSH_INTERVAL_MS", "200")) / 1000,
+        overflow=os.getenv("LOG_OVERFLOW", "drop").lower(),
+        block_timeout=int(os.getenv("LOG_BLOCK_TIMEOUT_MS", "1000")) / 1000,
+    )
 
 
 def setup_logger(name: str, level: int = logging.INFO) -> logging.Logger:
@@ -51,14 +455,26 @@ def setup_logger(name: str, level: int = logging.INFO) -> logging.Logger:
     logger = logging.getLogger(name)
     logger.setLevel(level)
     
-    # 既存のハンドラーをクリア（重複を避けるため）
+    # 既存のハンドラーを閉じてクリア（重複を避けるため。非同期ハンドラーは書き込みスレッドも止める）
+    for handler in logger.handlers:
+        handler.close()
     logger.handlers.clear()
     
     # ハンドラーの設定
-    handler = logging.StreamHandler()
-    handler.setFormatter(JsonFormatter())
+    handler = create_log_handler()
+    handler.setFormatter(JsonFormatter(json_encoder=os.getenv("LOG_JSON_ENCODER", "auto").lower()))
     logger.addHandler(handler)
     
+    # 間引き・集計のフィルター（環境変数で設定された場合のみ）
+    for old_policy in [f for f in logger.filters if isinstance(f, LogPolicyFilter)]:
+        old_policy.close()
+        logger.removeFilter(old_policy)
+    policy = create_log_policy(logger)
+    if policy is not None:
+        logger.addFilter(policy)
+        # 終了時に残りの集計を出力（logging.shutdown より先に実行される）
+        atexit.register(policy.close)
+    
     # 親ロガーへの伝播を無効化（重複を避けるため）
     logger.propagate = False
     
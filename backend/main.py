@@ -1,24 +1,28 @@
+import asyncio
 import json
-import string
+import os
+import sys
 import time
-from typing import List, Dict, Any
+import uuid
+from typing import List, Dict, Any, Optional
 
+import numpy as np
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 
 # BM25 search algorithm
-from rank_bm25 import BM25Okapi
+from bm25_engine import SparseBM25
+from pruned_bm25 import BlockMaxBM25
+from positional_index import BooleanQueryError, PositionalIndex, describe_query, parse_boolean_query, positive_phrases
 
 # OpenTelemetry imports
 from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.sdk.resources import Resource
 from opentelemetry import propagate
 import logging
 
@@ -39,110 +43,44 @@ try:
 except LookupError:
     nltk.download('gutenberg')
 
-from nltk.corpus import gutenberg, stopwords
-from nltk.tokenize import word_tokenize, sent_tokenize
+from nltk.corpus import gutenberg
+from nltk.tokenize import sent_tokenize
+
+# テキスト前処理とコーパス並列読み込み
+from text_processing import get_analyzer, preprocess_text
+from corpus_loader import load_books, default_workers, parse_book_metadata
+from book_store import BookStore, BookStoreBuilder
+from snippets import SnippetIndex, split_terms
+from passages import PASSAGE_MODES, PassageIndex
+from ranking import select_top_k
+from search_cache import create_search_cache
+from search_executor import SearchOverloadedError, create_search_executor
+from segments import DuplicateBookError, IngestUnavailableError, Segment, create_admin_access, create_segmented_index
 
 # JSON構造化ログシステムをインポート
 from log_system import setup_logger
 
-# OpenTelemetryの初期化
-class SimpleConsoleSpanExporter:
-    """簡易的なコンソール出力エクスポーター"""
-    def export(self, spans):
-        for span in spans:
-            print(f"🔍 Span: {span.name}")
-            print(f"   Service: {span.resource.attributes.get('service.name', 'unknown')}")
-            print(f"   Trace ID: {format(span.context.trace_id, '032x')}")
-            print(f"   Span ID: {format(span.context.span_id, '016x')}")
-            print(f"   Duration: {(span.end_time - span.start_time) / 1_000_000:.2f} ms")
-            
-            # 分散トレース情報の表示
-            distributed_received = span.attributes.get('distributed.trace.received', False)
-            if distributed_received:
-                traceparent = span.attributes.get('distributed.trace.traceparent', '')
-                print(f"   🔗 Distributed Trace: Connected from Frontend")
-                print(f"   📡 Traceparent: {traceparent}")
-            
-            if span.attributes:
-                print(f"   Attributes: {dict(span.attributes)}")
-            print()
-        return 0
-    
-    def shutdown(self):
-        """エクスポーターのシャットダウン"""
-        print("🔍 Console Span Exporter shutdown")
-        return True
-
-def setup_tracing():
-    """OpenTelemetryトレースの初期化"""
-    import os
-    
-    # 環境に応じたサービス名とリソース設定
-    service_name = os.getenv("OTEL_SERVICE_NAME", "gutenberg-search-api")
-    service_version = os.getenv("DD_VERSION", "1.0.0")
-    environment = os.getenv("DD_ENV", "development")
-    
-    # リソースの設定
-    resource = Resource.create({
-        "service.name": service_name,
-        "service.version": service_version,
-        "deployment.environment": environment
-    })
-    
-    # TracerProviderの設定
-    tracer_provider = TracerProvider(resource=resource)
-    trace.set_tracer_provider(tracer_provider)
-    
-    # エクスポーターの設定
-    # 簡易コンソール出力（開発・デバッグ用）
-    console_exporter = SimpleConsoleSpanExporter()
-    tracer_provider.add_span_processor(BatchSpanProcessor(console_exporter))
-    
-    # Kubernetes環境での分散トレース設定
-    dd_trace_agent_url = os.getenv("DD_TRACE_AGENT_URL")
-    otlp_endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")
-    
-    print(f"🔧 OpenTelemetry Setup:")
-    print(f"   Service Name: {service_name}")
-    print(f"   Environment: {environment}")
-    print(f"   DD_TRACE_AGENT_URL: {dd_trace_agent_url}")
-    print(f"   OTEL_EXPORTER_OTLP_ENDPOINT: {otlp_endpoint}")
-    
-    # Datadog環境でのOTLP設定
-    if dd_trace_agent_url:
-        try:
-            # Datadog Agent経由でのトレース送信
-            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter as HTTPOTLPSpanExporter
-            
-            # 環境変数で指定されたOTLPエンドポイントを直接使用
-            otlp_exporter = HTTPOTLPSpanExporter(
-                endpoint=f"{otlp_endpoint}/v1/traces",
-                headers={}
-            )
-            tracer_provider.add_span_processor(BatchSpanProcessor(otlp_exporter))
-            print(f"✅ Datadog OTLP Exporter configured: {otlp_endpoint}/v1/traces")
-            
-        except Exception as e:
-            print(f"❌ Datadog OTLP Exporter setup failed: {e}")
-            print(f"   Continuing with console output only...")
-    else:
-        # ローカル環境用の設定
-        try:
-            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter as HTTPOTLPSpanExporter
-            otlp_exporter = HTTPOTLPSpanExporter(
-                endpoint=f"{otlp_endpoint}/v1/traces",
-                headers={}
-            )
-            tracer_provider.add_span_processor(BatchSpanProcessor(otlp_exporter))
-            print(f"✅ Local OTLP Exporter configured: {otlp_endpoint}/v1/traces")
-        except Exception as e:
-            print(f"❌ Local OTLP Exporter setup failed: {e}")
-            print(f"   Continuing with console output only...")
-    
-    return trace.get_tracer(__name__)
+# トレース設定（サンプリングとスパンの詳細度）
+from tracing_system import setup_tracing, start_span, span_enabled, export_stats, SPAN_LEVEL_DOCUMENT
+
+# Prometheus形式のメトリクス
+import metrics
+from metrics import stage_timer, startup_phase
+
+# デバッグ用（プロファイラーと低速クエリの記録）
+from profiler import ProfilerBusyError, create_debug_access, create_profiler, create_slow_query_log
+
+# インデックススナップショット
+from index_snapshot import (
+    SnapshotError, compute_fingerprint, save_snapshot, load_snapshot, tfidf_to_arrays, tfidf_from_arrays,
+)
+# 複数ワーカーで配信するときのインデックスの共有
+from shared_index import SHARED_MEMORY_ENV, SharedIndex, SharedIndexError
+# 起動ジョブの進捗（/ready）
+from readiness import StartupProgress
 
 # トレーサーの初期化
-tracer = setup_tracing()
+tracer = setup_tracing(__name__)
 
 # ロガーの設定
 logger = setup_logger("search_app")
@@ -162,24 +100,132 @@ app.add_middleware(
 )
 
 # グローバル変数
-books_data = {}
+# 書籍のメタデータと本文（本文は1つの UTF-8 バッファ。前処理済みテキストはインデックス構築後に破棄する）
+books_data = BookStore.empty()
 tfidf_vectorizer = None
 tfidf_matrix = None
-processed_texts = {}
+# BM25 は疎行列版を常に持ち、rank_bm25 版は BM25_OKAPI_ENABLED のときだけ作る（比較用）
 bm25_index = None
+bm25_sparse_index = None
+# 枝刈り用のブロック単位の転置インデックス（BM25_BLOCK_MAX_ENABLED のときのみ。パッセージ単位は passage_block_max）
+bm25_block_max = None
+passage_block_max = None
+snippet_index = None
+# パッセージ単位のインデックス（PASSAGE_INDEX_ENABLED のときのみ）
+passage_index = None
+# ブール検索用の位置インデックス（POSITIONAL_INDEX_ENABLED のときのみ。転置リストは bm25_sparse_index と共有）
+positional_index = None
+# 親プロセスが公開した共有メモリのインデックス（複数ワーカーで配信するときのワーカーのみ）
+shared_index = None
+
+# 検索結果キャッシュ（インデックス更新時に invalidate する）
+search_cache = create_search_cache()
+
+# 検索処理用ワーカープール（イベントループをブロックしないため）
+search_executor = create_search_executor()
+
+# /debug/* のアクセス設定・プロファイラー・低速クエリの記録
+debug_access = create_debug_access()
+profiler = create_profiler()
+slow_query_log = create_slow_query_log()
+
+# 起動ジョブ（インデックスの構築・読み込みとウォームアップ）の進捗と、実行中のタスク
+startup_progress = StartupProgress()
+metrics.add_phase_listener(startup_progress.on_phase)
+index_job = None
+
+# 起動時のインデックスの指紋（検索結果キャッシュのバージョンの元）とこのプロセスの識別子
+index_fingerprint = None
+INSTANCE_ID = uuid.uuid4().hex
+
+def on_index_generation_change(generation, reason: str):
+    """インデックスの世代が変わったら検索結果キャッシュを無効化
+    
+    起動直後の世代（ベースのみ）は指紋をそのままバージョンにするので、共有キャッシュを他のプロセスと共有できます。
+    書籍の追加・削除はこのプロセスだけのものなので、以降の世代はプロセスの識別子を含めます。
+    """
+    if generation.number == 0:
+        version = index_fingerprint
+    else:
+        version = f"{index_fingerprint}:{INSTANCE_ID}:{generation.number}"
+    search_cache.invalidate(version)
+    logger.info("インデックス世代更新", extra={"event_type": "index_generation_change", "reason": reason, "generation": generation.number,
+                                           "segments_count": len(generation.segments), "books_count": generation.document_count})
+
+# /admin/books で追加・削除する書籍（ベースのインデックスの後ろに足すセグメント）
+segmented_index = create_segmented_index(on_change=on_index_generation_change)
+admin_access = create_admin_access()
+
+def trace_export_collector():
+    """トレース送信パイプラインごとの送信・失敗・破棄件数（/metrics 用）"""
+    stats = export_stats()
+    samples = []
+    for key, type_name in (("exported", "counter"), ("failed", "counter"), ("dropped", "counter"), ("queued", "gauge")):
+        name = f"trace_spans_{key}_total" if type_name == "counter" else f"trace_spans_{key}"
+        samples.append((name, type_name, f"Spans {key} per export pipeline",
+                        [({"exporter": exporter}, values.get(key, 0)) for exporter, values in stats.items()]))
+    return samples
 
-def preprocess_text(text: str) -> str:
-    """テキストの前処理"""
-    # 小文字化
-    text = text.lower()
-    # 句読点の除去
-    text = text.translate(str.maketrans('', '', string.punctuation))
-    # トークン化
-    tokens = word_tokenize(text)
-    # ストップワード除去
-    stop_words = set(stopwords.words('english'))
-    tokens = [token for token in tokens if token not in stop_words and len(token) > 2]
-    return ' '.join(tokens)
+# スクレイプ時にキャッシュ・ワーカープール・トレース送信の状態を読み出す
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    "search_cache", search_cache.stats, documentation="Search result cache",
+    counters=("hits", "shared_hits", "misses", "evictions", "expirations", "shared_errors"), gauges=("size", "hit_rate")))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    "search_executor", search_executor.stats, documentation="Search worker pool",
+    counters=("rejected", "completed"), gauges=("in_flight", "max_workers", "max_queue")))
+metrics.REGISTRY.add_collector(trace_export_collector)
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    "slow_queries", slow_query_log.stats, documentation="Slow query log", counters=("recorded",)))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    "index_segments", segmented_index.stats, documentation="Incremental index",
+    counters=("ingested", "removed", "merges"), gauges=("generation", "segments", "documents", "deleted")))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    "startup", startup_progress.stats, documentation="Startup job", gauges=("ready", "index_ready")))
+
+# インデックス設定
+# 文書はアナライザーで正規化済みなので、ベクトライザーは空白で分割するだけにする
+TFIDF_PARAMS = {"max_features": 5000, "ngram_range": (1, 2), "tokenizer": str.split, "token_pattern": None, "lowercase": False}
+BM25_PARAMS = {"k1": 1.5, "b": 0.75, "epsilon": 0.25}
+INDEX_SNAPSHOT_DIR = os.getenv("INDEX_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "index_snapshot"))
+INDEX_SNAPSHOT_ENABLED = os.getenv("INDEX_SNAPSHOT_ENABLED", "true").lower() == "true"
+INDEX_SNAPSHOT_VERIFY = os.getenv("INDEX_SNAPSHOT_VERIFY", "true").lower() == "true"
+# バッチ検索で1リクエストに含められるクエリ数の上限
+SEARCH_BATCH_MAX_QUERIES = int(os.getenv("SEARCH_BATCH_MAX_QUERIES", "100"))
+# rank_bm25 の BM25Okapi も持つか（文書ごとの単語辞書を持つためメモリを多く使う。method=bm25 の比較用）
+BM25_OKAPI_ENABLED = os.getenv("BM25_OKAPI_ENABLED", "false").lower() == "true"
+# method=bm25_pruned 用のブロック単位の転置インデックスを作るか（BM25_BLOCK_SIZE 件ずつのブロック）
+BM25_BLOCK_MAX_ENABLED = os.getenv("BM25_BLOCK_MAX_ENABLED", "true").lower() == "true"
+BM25_BLOCK_SIZE = int(os.getenv("BM25_BLOCK_SIZE", "128"))
+# /debug/profile で1回に採取できる秒数の上限
+DEBUG_PROFILE_MAX_SECONDS = float(os.getenv("DEBUG_PROFILE_MAX_SECONDS", "60"))
+# パッセージ単位のインデックス（granularity=passage）。分割方式は paragraph / fixed、大きさは語数
+PASSAGE_INDEX_ENABLED = os.getenv("PASSAGE_INDEX_ENABLED", "true").lower() == "true"
+PASSAGE_MODE = os.getenv("PASSAGE_MODE", "paragraph").lower()
+PASSAGE_SIZE = int(os.getenv("PASSAGE_SIZE", "150"))
+# 分割はワーカーで書籍ごとに行うので、設定の誤りは起動時に検出する
+if PASSAGE_MODE not in PASSAGE_MODES:
+    raise ValueError(f"Unsupported passage mode: {PASSAGE_MODE}. Available modes: {PASSAGE_MODES}")
+# method=boolean 用の位置インデックスを作るか（前処理後の総トークン数 × 4バイト）
+POSITIONAL_INDEX_ENABLED = os.getenv("POSITIONAL_INDEX_ENABLED", "true").lower() == "true"
+# ブール検索の結果の並べ方（bm25: NOT でない語の BM25 スコア順, none: コーパス順でスコアは1）
+BOOLEAN_RANKING = os.getenv("BOOLEAN_RANKING", "bm25").lower()
+BOOLEAN_RANKINGS = ("bm25", "none")
+if BOOLEAN_RANKING not in BOOLEAN_RANKINGS:
+    raise ValueError(f"Unsupported boolean ranking: {BOOLEAN_RANKING}. Available rankings: {BOOLEAN_RANKINGS}")
+# POST /admin/books で1リクエストに含められる書籍数の上限
+INGEST_MAX_BOOKS = int(os.getenv("INGEST_MAX_BOOKS", "100"))
+# uvicorn のワーカープロセス数。2以上なら親プロセスがインデックスを1回だけ用意して共有メモリに公開し、
+# 各ワーカーはコピーせずに接続する（共有メモリは /dev/shm に置かれるので、コンテナではその大きさに注意）
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+# 親プロセスが公開した共有メモリのブロック名（ワーカーのプロセスにだけ設定される）
+INDEX_SHARED_MEMORY = os.getenv(SHARED_MEMORY_ENV, "")
+# インデックスの準備をバックグラウンドで行うか（false なら startup_event で完了まで待つ）
+INDEX_BUILD_IN_BACKGROUND = os.getenv("INDEX_BUILD_IN_BACKGROUND", "true").lower() == "true"
+# 準備完了の前に検索を一度ずつ実行して、結果キャッシュと遅延構築する構造を用意する
+# WARMUP_QUERIES はカンマ区切り。空なら含む文書数の多い語を WARMUP_AUTO_QUERIES 件使う
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_QUERIES = [query.strip() for query in os.getenv("WARMUP_QUERIES", "").split(",") if query.strip()]
+WARMUP_AUTO_QUERIES = int(os.getenv("WARMUP_AUTO_QUERIES", "10"))
 
 def get_snippet(text: str, query: str, context_length: int = 25) -> str:
     """検索クエリを含むスニペットを取得"""
@@ -208,122 +254,491 @@ def get_snippet(text: str, query: str, context_length: int = 25) -> str:
         return ' '.join(words[:context_length]) + "..."
     return first_sentence
 
-@app.on_event("startup")
-async def startup_event():
-    """アプリ起動時にデータの読み込みとTF-IDFベクトル化を実行"""
-    global books_data, tfidf_vectorizer, tfidf_matrix, processed_texts, bm25_index
+def corpus_fingerprint() -> str:
+    """現在のコーパスとインデックス設定の指紋を計算"""
+    files = [(fileid, gutenberg.abspath(fileid).file_size()) for fileid in gutenberg.fileids()]
+    settings = {
+        "tfidf": {"max_features": TFIDF_PARAMS["max_features"], "ngram_range": list(TFIDF_PARAMS["ngram_range"]), "tokenizer": "analyzer"},
+        "bm25": BM25_PARAMS,
+        "analyzer": get_analyzer().config(),
+        "passages": {"mode": PASSAGE_MODE, "size": PASSAGE_SIZE} if PASSAGE_INDEX_ENABLED else None,
+        "positional": POSITIONAL_INDEX_ENABLED,
+    }
+    return compute_fingerprint(files, settings)
+
+def build_search_index():
+    """コーパスを読み込み、TF-IDF・BM25インデックス（有効ならパッセージ単位・位置インデックスも）を構築"""
+    global books_data, tfidf_vectorizer, tfidf_matrix, bm25_index, bm25_sparse_index, snippet_index, passage_index
+    global positional_index
+
+    # Gutenbergコーパスから書籍を取得（プロセスプールで並列に前処理）
+    with startup_phase("load_gutenberg_corpus"), tracer.start_as_current_span("load_gutenberg_corpus") as load_span:
+        fileids = gutenberg.fileids()
+        workers = min(default_workers(), len(fileids))
+        load_span.set_attribute("corpus.total_files", len(fileids))
+        load_span.set_attribute("corpus.loader_workers", workers)
+        
+        # 結果はファイルID順に届くので、追加順（=インデックスの行順）は逐次処理と同じ
+        # 本文は届いた順にバッファへ詰め、前処理済みテキストはインデックス構築の間だけ持つ
+        store_builder = BookStoreBuilder()
+        processed_texts = []
+        book_sentences = []
+        book_passages = []
+        passage_config = (PASSAGE_MODE, PASSAGE_SIZE) if PASSAGE_INDEX_ENABLED else None
+        for loaded, result in enumerate(load_books(fileids, workers=workers, passages=passage_config), start=1):
+            fileid = result['book_id']
+            # ワーカーで計測した処理時間をそのまま書籍ごとのスパンにする
+            book_span = tracer.start_span("process_book", attributes={"book.id": fileid}, start_time=result['start_ns'])
+            if result['worker_pid'] is not None:
+                book_span.set_attribute("book.worker_pid", result['worker_pid'])
+            if result['error'] is None:
+                book = result['book']
+                store_builder.add(fileid, book['title'], book['author'], book['word_count'], book['raw_text'])
+                processed_texts.append(result['processed_text'])
+                book_sentences.append(result['sentences'])
+                book_passages.append(result['passages'])
+            else:
+                book_span.set_status(trace.Status(trace.StatusCode.ERROR, result['error']))
+                logger.error("書籍処理エラー", extra={"event_type": "book_processing_error", "book_id": fileid, "error": result['error']})
+            book_span.end(end_time=result['end_ns'])
+            startup_progress.advance("load_gutenberg_corpus", loaded, len(fileids))
+        books_data = store_builder.build()
+        load_span.set_attribute("corpus.text_bytes", books_data.nbytes)
+    # インデックスの構築中も /books で書籍一覧を返せるようにする
+    startup_progress.mark_metadata_ready()
+    
+    # スニペット用の文インデックス（文境界は各ワーカーで計算済み）
+    with startup_phase("snippet_indexing"), tracer.start_as_current_span("snippet_indexing") as snippet_span:
+        snippet_index = SnippetIndex.from_books(book_sentences)
+        del book_sentences
+        snippet_span.set_attribute("snippet.sentences_count", len(snippet_index.sentence_starts))
+        snippet_span.set_attribute("snippet.vocabulary_size", len(snippet_index.vocabulary))
+    
+    # TF-IDFベクトル化
+    with startup_phase("tfidf_vectorization"), tracer.start_as_current_span("tfidf_vectorization") as tfidf_span:
+        tfidf_vectorizer = TfidfVectorizer(**TFIDF_PARAMS)
+        tfidf_matrix = tfidf_vectorizer.fit_transform(processed_texts)
+        # max_features で落とした語の集合（検索には使わない）。語数が多いと大きいので手放す
+        tfidf_vectorizer.stop_words_ = None
+        
+        tfidf_span.set_attribute("tfidf.max_features", 5000)
+        tfidf_span.set_attribute("tfidf.ngram_range", "1,2")
+        tfidf_span.set_attribute("tfidf.texts_count", len(processed_texts))
+        tfidf_span.set_attribute("tfidf.matrix_shape", str(tfidf_matrix.shape))
+
+    # BM25インデックス構築（単語IDの疎行列。文書ごとのトークン列は1冊ずつ作って捨てる）
+    with startup_phase("bm25_indexing"), tracer.start_as_current_span("bm25_indexing") as bm25_span:
+        print(f"📊 BM25インデックス構築を開始...")
+        bm25_start = time.time()
+        
+        bm25_sparse_index = SparseBM25.from_documents((text.split() for text in processed_texts), **BM25_PARAMS)
+        
+        bm25_time = time.time() - bm25_start
+        print(f"📊 BM25インデックス構築完了: {bm25_time:.2f}秒")
+        print(f"   平均文書長: {bm25_sparse_index.avgdl:.1f}トークン")
+        print(f"   総文書数: {bm25_sparse_index.corpus_size}件")
+        
+        bm25_span.set_attribute("bm25.duration_seconds", round(bm25_time, 2))
+        bm25_span.set_attribute("bm25.documents_count", bm25_sparse_index.corpus_size)
+        bm25_span.set_attribute("bm25.average_doc_length", round(bm25_sparse_index.avgdl, 2))
+        bm25_span.set_attribute("bm25.total_tokens", int(bm25_sparse_index.doc_len.sum()))
+        bm25_span.set_attribute("bm25.vocabulary_size", len(bm25_sparse_index.vocabulary))
+        bm25_span.set_attribute("bm25.postings_count", int(bm25_sparse_index.term_doc_tf.nnz))
+
+    # ブール検索用の位置インデックス（BM25 と同じトークン列から作り、転置リストは BM25 のものを使う）
+    if POSITIONAL_INDEX_ENABLED:
+        with startup_phase("positional_indexing"), tracer.start_as_current_span("positional_indexing") as positional_span:
+            positional_index = PositionalIndex.from_documents(bm25_sparse_index, (text.split() for text in processed_texts))
+            positional_span.set_attribute("positional.positions_count", len(positional_index.positions))
+            positional_span.set_attribute("positional.bytes", positional_index.nbytes)
+    else:
+        positional_index = None
+    del processed_texts
+
+    # rank_bm25 版（有効な場合のみ。疎行列版の統計量から作る）
+    if BM25_OKAPI_ENABLED:
+        with startup_phase("bm25_okapi_indexing"), tracer.start_as_current_span("bm25_okapi_indexing"):
+            bm25_index = bm25_sparse_index.to_okapi()
+    else:
+        bm25_index = None
+
+    # パッセージ単位のインデックス（分割と前処理は各ワーカーで済んでいる）
+    if PASSAGE_INDEX_ENABLED:
+        with startup_phase("passage_indexing"), tracer.start_as_current_span("passage_indexing") as passage_span:
+            passage_index = PassageIndex.from_books(book_passages, TFIDF_PARAMS, BM25_PARAMS, PASSAGE_MODE, PASSAGE_SIZE)
+            passage_span.set_attribute("passage.mode", PASSAGE_MODE)
+            passage_span.set_attribute("passage.size", PASSAGE_SIZE)
+            passage_span.set_attribute("passage.count", len(passage_index))
+            passage_span.set_attribute("passage.tfidf_matrix_shape", str(passage_index.tfidf_matrix.shape))
+            print(f"📊 パッセージインデックス構築完了: {len(passage_index)}件（{PASSAGE_MODE}, {PASSAGE_SIZE}語）")
+    else:
+        passage_index = None
+    del book_passages
+    build_block_max_indexes()
+
+def build_block_max_indexes():
+    """疎行列版の BM25 から枝刈り用のブロック単位の転置インデックスを作る（スナップショットには含めない）"""
+    global bm25_block_max, passage_block_max
+    if not BM25_BLOCK_MAX_ENABLED:
+        bm25_block_max = passage_block_max = None
+        return
+    with startup_phase("bm25_block_max_indexing"), tracer.start_as_current_span("bm25_block_max_indexing") as span:
+        bm25_block_max = BlockMaxBM25(bm25_sparse_index, BM25_BLOCK_SIZE)
+        passage_block_max = BlockMaxBM25(passage_index.bm25, BM25_BLOCK_SIZE) if passage_index is not None else None
+        span.set_attribute("bm25.block_size", BM25_BLOCK_SIZE)
+        span.set_attribute("bm25.blocks_count", bm25_block_max.block_count)
+        span.set_attribute("bm25.block_max_bytes", bm25_block_max.nbytes)
+        if passage_block_max is not None:
+            span.set_attribute("passage.bm25.blocks_count", passage_block_max.block_count)
+            span.set_attribute("passage.bm25.block_max_bytes", passage_block_max.nbytes)
+
+def search_index_to_arrays():
+    """構築済みインデックスを配列とメタデータに変換（スナップショット・共有メモリ共通の形式）"""
+    arrays, metadata = {}, {}
+    parts = [books_data.to_arrays(), tfidf_to_arrays(tfidf_vectorizer, tfidf_matrix),
+             bm25_sparse_index.to_arrays(), snippet_index.to_arrays()]
+    if passage_index is not None:
+        parts.append(passage_index.to_arrays())
+    if positional_index is not None:
+        parts.append(positional_index.to_arrays())
+    for part_arrays, part_metadata in parts:
+        arrays.update(part_arrays)
+        metadata.update(part_metadata)
+    return arrays, metadata
+
+def restore_search_index(arrays, metadata):
+    """配列とメタデータからインデックスを復元（配列はコピーせずにそのまま使う）"""
+    global books_data, tfidf_vectorizer, tfidf_matrix, bm25_index, bm25_sparse_index, snippet_index, passage_index
+    global positional_index
+    books_data = BookStore.from_arrays(arrays, metadata)
+    tfidf_vectorizer, tfidf_matrix = tfidf_from_arrays(arrays, metadata, TFIDF_PARAMS)
+    bm25_sparse_index = SparseBM25.from_arrays(arrays, metadata)
+    bm25_index = bm25_sparse_index.to_okapi() if BM25_OKAPI_ENABLED else None
+    snippet_index = SnippetIndex.from_arrays(arrays, metadata)
+    passage_index = PassageIndex.from_arrays(arrays, metadata, TFIDF_PARAMS) if PASSAGE_INDEX_ENABLED else None
+    positional_index = PositionalIndex.from_arrays(bm25_sparse_index, arrays) if POSITIONAL_INDEX_ENABLED else None
+    startup_progress.mark_metadata_ready()
+    build_block_max_indexes()
+
+def save_search_index(fingerprint: str):
+    """構築済みインデックスをスナップショットとして保存"""
+    with startup_phase("save_index_snapshot"), tracer.start_as_current_span("save_index_snapshot") as span:
+        arrays, metadata = search_index_to_arrays()
+        save_snapshot(INDEX_SNAPSHOT_DIR, arrays, metadata, fingerprint)
+        span.set_attribute("snapshot.dir", INDEX_SNAPSHOT_DIR)
+        span.set_attribute("snapshot.books_count", len(books_data))
+        print(f"💾 インデックススナップショット保存: {INDEX_SNAPSHOT_DIR}")
+
+def load_search_index(fingerprint: str):
+    """スナップショットからインデックスを復元（失敗時はSnapshotError）
+
+    本文バッファ・CSR行列などの配列はメモリマップのまま使い、コピーしません。
+    パッセージ単位のインデックスの有無は指紋に含まれるので、設定と一致するものだけが読まれます。
+    """
+    with startup_phase("load_index_snapshot"), tracer.start_as_current_span("load_index_snapshot") as span:
+        span.set_attribute("snapshot.dir", INDEX_SNAPSHOT_DIR)
+        snapshot = load_snapshot(INDEX_SNAPSHOT_DIR, fingerprint, verify_checksums=INDEX_SNAPSHOT_VERIFY)
+        restore_search_index(snapshot.arrays, snapshot.metadata)
+
+        span.set_attribute("snapshot.books_count", len(books_data))
+        span.set_attribute("tfidf.matrix_shape", str(tfidf_matrix.shape))
+        print(f"💾 インデックススナップショット読み込み: {INDEX_SNAPSHOT_DIR}")
+
+def attach_search_index(name: str) -> str:
+    """親プロセスが共有メモリに公開したインデックスに接続（失敗時はSharedIndexError）
+    
+    配列は共有メモリを指す読み取り専用のビューで、ワーカーごとのコピーは作りません。
+    
+    Returns:
+        親プロセスで計算したコーパス指紋
+    """
+    global shared_index
+    with startup_phase("attach_shared_index"), tracer.start_as_current_span("attach_shared_index") as span:
+        span.set_attribute("shared_index.name", name)
+        shared_index = SharedIndex.attach(name)
+        restore_search_index(shared_index.arrays, shared_index.metadata)
+        span.set_attribute("shared_index.bytes", shared_index.nbytes)
+        span.set_attribute("snapshot.books_count", len(books_data))
+        print(f"🔗 共有メモリのインデックスに接続: {name}（{shared_index.nbytes / 2**20:.1f}MB）")
+    return shared_index.fingerprint
+
+def prepare_search_index():
+    """インデックスを用意する（共有メモリ → スナップショット → 構築 の順に試す）
+    
+    Returns:
+        (コーパス指紋。スナップショット無効で構築した場合は None, 取得元 "shared_memory" / "snapshot" / "build")
+    """
+    if INDEX_SHARED_MEMORY:
+        try:
+            return attach_search_index(INDEX_SHARED_MEMORY), "shared_memory"
+        except SharedIndexError as e:
+            logger.warning("共有メモリのインデックスに接続できません", extra={"event_type": "shared_index_unavailable", "reason": str(e)})
+    
+    # スナップショットがあればメモリマップで読み込み、なければ構築して保存
+    fingerprint = corpus_fingerprint() if INDEX_SNAPSHOT_ENABLED else None
+    if INDEX_SNAPSHOT_ENABLED:
+        try:
+            load_search_index(fingerprint)
+            return fingerprint, "snapshot"
+        except SnapshotError as e:
+            logger.warning("スナップショット利用不可、インデックスを再構築", extra={"event_type": "index_snapshot_unavailable", "reason": str(e)})
+    
+    build_search_index()
+    if INDEX_SNAPSHOT_ENABLED:
+        try:
+            save_search_index(fingerprint)
+        except Exception as e:
+            logger.warning("スナップショット保存エラー", extra={"event_type": "index_snapshot_save_error", "error": str(e)})
+    return fingerprint, "build"
+
+def reset_segmented_index():
+    """構築・読み込みしたインデックスをベースにして、追加・削除した書籍を破棄する"""
+    segmented_index.reset(Segment.base(books_data, tfidf_matrix, bm25_sparse_index, snippet_index, positional_index),
+                          tfidf_vectorizer, BM25_PARAMS, bm25_sparse_index.average_idf)
+
+def warmup_queries() -> List[str]:
+    """ウォームアップに使うクエリ（WARMUP_QUERIES、なければ含む文書数の多い語）"""
+    if WARMUP_QUERIES:
+        return WARMUP_QUERIES
+    return bm25_sparse_index.frequent_terms(WARMUP_AUTO_QUERIES)
+
+def warm_up_search():
+    """よく使われるクエリで検索を一度ずつ実行する
     
+    結果キャッシュに載せるほか、初回の検索で作られる構造（BM25 の重み行列・前処理のキャッシュなど）と、
+    スナップショットからメモリマップした配列のページを用意し、最初の利用者が初回の遅さを負わないようにします。
+    プロセスモード（SEARCH_EXECUTOR_MODE=process）では、ワーカーは最初の検索のときにこのプロセスからフォークされ、
+    ここで用意した状態を引き継ぎます。
+    """
+    with startup_phase("warmup"), tracer.start_as_current_span("warmup") as span:
+        queries = warmup_queries()
+        granularities = ["book", "passage"] if passage_index is not None else ["book"]
+        total = len(granularities) * (len(queries) * 2 + 1)
+        done = 0
+        for granularity in granularities:
+            for method in ("tfidf", "bm25"):
+                for query in queries:
+                    perform_search(query, search_method=method, **granularity_kwargs(granularity, True))
+                    done += 1
+                    startup_progress.advance("warmup", done, total)
+            # バッチ検索の重み行列（BM25）は初回に作られる
+            batch_search(queries, search_method="bm25", granularity=granularity)
+            done += 1
+            startup_progress.advance("warmup", done, total)
+        span.set_attribute("warmup.queries_count", len(queries))
+        span.set_attribute("warmup.searches_count", done)
+        print(f"🔥 ウォームアップ完了: {len(queries)}クエリ（{done}回）")
+
+def run_index_job():
+    """起動ジョブ: インデックスを用意し、ウォームアップして準備完了にする（進捗は startup_progress）"""
+    global index_fingerprint
+    startup_progress.start()
     with tracer.start_as_current_span("app_startup") as span:
         try:
             start_time = time.time()
-            logger.info("アプリケーション起動開始", extra={"event_type": "startup"})
+            rss_before = metrics.process_rss_bytes()
+            logger.info("アプリケーション起動開始", extra={"event_type": "startup", "rss_mb": round(rss_before / 2**20, 1)})
             
-            # Gutenbergコーパスから書籍を取得
-            with tracer.start_as_current_span("load_gutenberg_corpus") as load_span:
-                fileids = gutenberg.fileids()
-                load_span.set_attribute("corpus.total_files", len(fileids))
-                
-                for i, fileid in enumerate(fileids):
-                    try:
-                        with tracer.start_as_current_span("process_book", attributes={"book.id": fileid}):
-                            raw_text = gutenberg.raw(fileid)
-                            processed_text = preprocess_text(raw_text)
-                            
-                            # 著者とタイトルを推定（ファイル名から）
-                            if '-' in fileid:
-                                parts = fileid.replace('.txt', '').split('-')
-                                author = parts[0].replace('_', ' ').title()
-                                title = '-'.join(parts[1:]).replace('_', ' ').title() if len(parts) > 1 else fileid
-                            else:
-                                title = fileid.replace('.txt', '').replace('_', ' ').title()
-                                author = "Unknown"
-                            
-                            books_data[fileid] = {
-                                'id': fileid,
-                                'title': title,
-                                'author': author,
-                                'raw_text': raw_text,
-                                'word_count': len(raw_text.split())
-                            }
-                            processed_texts[fileid] = processed_text
-                            
-                    except Exception as e:
-                        logger.error("書籍処理エラー", extra={"event_type": "book_processing_error", "book_id": fileid, "error": str(e)})
-            
-            # TF-IDFベクトル化
-            with tracer.start_as_current_span("tfidf_vectorization") as tfidf_span:
-                texts_list = list(processed_texts.values())
-                tfidf_vectorizer = TfidfVectorizer(max_features=5000, ngram_range=(1, 2))
-                tfidf_matrix = tfidf_vectorizer.fit_transform(texts_list)
-                
-                tfidf_span.set_attribute("tfidf.max_features", 5000)
-                tfidf_span.set_attribute("tfidf.ngram_range", "1,2")
-                tfidf_span.set_attribute("tfidf.texts_count", len(texts_list))
-                tfidf_span.set_attribute("tfidf.matrix_shape", str(tfidf_matrix.shape))
-
-            # BM25インデックス構築
-            with tracer.start_as_current_span("bm25_indexing") as bm25_span:
-                print(f"📊 BM25インデックス構築を開始...")
-                bm25_start = time.time()
-                
-                # BM25用のトークン化されたテキスト準備
-                tokenized_texts = []
-                for text in processed_texts.values():
-                    tokenized_texts.append(text.split())
-                
-                # BM25インデックス構築
-                bm25_index = BM25Okapi(tokenized_texts)
-                
-                bm25_time = time.time() - bm25_start
-                print(f"📊 BM25インデックス構築完了: {bm25_time:.2f}秒")
-                print(f"   平均文書長: {bm25_index.avgdl:.1f}トークン")
-                print(f"   総文書数: {len(tokenized_texts)}件")
-                
-                bm25_span.set_attribute("bm25.duration_seconds", round(bm25_time, 2))
-                bm25_span.set_attribute("bm25.documents_count", len(tokenized_texts))
-                bm25_span.set_attribute("bm25.average_doc_length", round(bm25_index.avgdl, 2))
-                bm25_span.set_attribute("bm25.total_tokens", sum(len(doc) for doc in tokenized_texts))
+            fingerprint, index_source = prepare_search_index()
+            snapshot_loaded = index_source == "snapshot"
+            
+            # 構築・読み込みしたインデックスをベースに世代をやり直す（キャッシュもここで無効化される）
+            index_fingerprint = fingerprint or str(time.time_ns())
+            reset_segmented_index()
+            startup_progress.mark_index_ready()
             
             total_time = time.time() - start_time
+            metrics.STARTUP_PHASE_SECONDS.labels("total").set(total_time)
+            # インデックス構築前後の常駐メモリ（スナップショット読み込み時はメモリマップした分のうち触れたページのみ）
+            rss_after = metrics.process_rss_bytes()
             span.set_attribute("startup.duration_seconds", round(total_time, 2))
             span.set_attribute("startup.books_loaded", len(books_data))
+            span.set_attribute("startup.snapshot_loaded", snapshot_loaded)
+            span.set_attribute("startup.index_source", index_source)
+            span.set_attribute("startup.rss_before_mb", round(rss_before / 2**20, 1))
+            span.set_attribute("startup.rss_after_mb", round(rss_after / 2**20, 1))
             
-            logger.info("アプリケーション起動完了", extra={"event_type": "startup_complete", "duration_seconds": round(total_time, 2), "books_count": len(books_data)})
+            logger.info("アプリケーション起動完了", extra={"event_type": "startup_complete", "duration_seconds": round(total_time, 2), "books_count": len(books_data), "snapshot_loaded": snapshot_loaded, "index_source": index_source,
+                                                     "rss_before_mb": round(rss_before / 2**20, 1), "rss_after_mb": round(rss_after / 2**20, 1), "corpus_text_mb": round(books_data.nbytes / 2**20, 1)})
         except Exception as e:
             span.record_exception(e)
             span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
             logger.error("起動エラー", extra={"event_type": "startup_error", "error": str(e)})
+            startup_progress.finish(error=str(e))
+            return
+        
+        # ウォームアップの失敗は検索そのものには影響しないので、記録だけして準備完了にする
+        if WARMUP_ENABLED:
+            try:
+                warm_up_search()
+            except Exception as e:
+                span.record_exception(e)
+                logger.warning("ウォームアップエラー", extra={"event_type": "warmup_error", "error": str(e)})
+        startup_progress.finish()
+        logger.info("準備完了", extra={"event_type": "ready", "duration_seconds": round(time.time() - start_time, 2)})
+
+@app.on_event("startup")
+async def startup_event():
+    """インデックスの構築・読み込みとウォームアップを起動ジョブとして始める
+    
+    INDEX_BUILD_IN_BACKGROUND=true（既定）ではジョブをスレッドで進め、アプリはすぐにリクエストを受け付けます。
+    進捗は /ready で確認でき、/books は書籍の読み込み後、検索はインデックスの用意ができてから受け付けます。
+    """
+    global index_job
+    index_job = asyncio.create_task(asyncio.to_thread(run_index_job))
+    if not INDEX_BUILD_IN_BACKGROUND:
+        await index_job
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """ワーカープールの停止とトレース送信状況の記録"""
+    search_executor.shutdown()
+    logger.info("トレース送信状況", extra={"event_type": "trace_export_stats", "exporters": export_stats()})
+
+def check_search_ready():
+    """検索を受け付けられる状態か確認（インデックスの用意ができるまでは 503）"""
+    # プロセスモードのワーカーは最初の検索でフォークされるので、ウォームアップ中のフォークを避けて準備完了まで待つ
+    ready = startup_progress.ready if search_executor.mode == "process" else startup_progress.index_ready
+    if not ready:
+        raise HTTPException(status_code=503, detail="インデックスの準備中です", headers={"Retry-After": "5"})
+
+def reject_overloaded_search(span, error: SearchOverloadedError, query: str, start_time: float) -> HTTPException:
+    """ワーカープール飽和時のスパン記録・ログ出力と、返却するHTTPエラーの作成"""
+    error_time = time.time() - start_time
+    status_code = search_executor.overload_status
+    span.set_attribute("error.type", "overloaded")
+    span.set_attribute("error.message", str(error))
+    span.set_attribute("search.executor.rejected_total", search_executor.rejected)
+    span.set_attribute("http.status_code", status_code)
+    logger.warning("検索リクエスト拒否（ワーカープール飽和）", extra={"event_type": "search_rejected", "query": query, "executor": search_executor.stats(), "duration_ms": round(error_time * 1000, 3)})
+    return HTTPException(status_code=status_code, detail="検索処理が混み合っています。しばらくしてから再試行してください", headers={"Retry-After": "1"})
+
+def set_execution_attributes(span, execution: Dict[str, Any]):
+    """ワーカープールでの待ち行列の深さ・待ち時間をスパン属性に記録"""
+    span.set_attribute("search.executor.mode", search_executor.mode)
+    span.set_attribute("search.executor.queue_depth", execution["queue_depth"])
+    span.set_attribute("search.executor.in_flight", execution["in_flight"])
+    span.set_attribute("search.executor.queue_wait_ms", execution["wait_ms"])
 
 @app.get("/")
 async def root():
     return {"message": "全文検索API"}
 
+@app.get("/ready")
+async def ready():
+    """準備状況（起動ジョブのフェーズごとの進捗）。ウォームアップまで終わったら 200、それまでと失敗時は 503"""
+    return JSONResponse(startup_progress.snapshot(), status_code=200 if startup_progress.ready else 503)
+
 @app.get("/books")
 async def get_books():
-    """全書籍の情報を返す"""
+    """全書籍の情報を返す（インデックスの構築中も、書籍の読み込みが済んでいれば返す）"""
     start_time = time.time()
     
-    books_list = []
-    for book_id, book_info in books_data.items():
-        books_list.append({
-            'id': book_id,
-            'title': book_info['title'],
-            'author': book_info['author'],
-            'word_count': book_info['word_count']
-        })
+    # 追加した書籍を含み、削除した書籍を除く
+    generation = segmented_index.current
+    if generation is not None:
+        books_list = list(generation.iter_metadata())
+    elif startup_progress.metadata_ready:
+        books_list = list(books_data.iter_metadata())
+    else:
+        raise HTTPException(status_code=503, detail="書籍を読み込み中です", headers={"Retry-After": "5"})
     
     response_time = time.time() - start_time
     logger.info("書籍一覧API", extra={"event_type": "api_response", "endpoint": "/books", "response_count": len(books_list), "duration_ms": round(response_time * 1000, 3)})
     
     return {"books": books_list}
 
-def tfidf_search(query: str, max_results: int = 20, similarity_threshold: float = 0.01) -> List[Dict[str, Any]]:
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus形式のメトリクス"""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+def materialize_results(indices, scores, query: str, generation, snippet_memo: Optional[Dict[str, str]] = None) -> List[Dict[str, Any]]:
+    """選択済みの文書インデックスから検索結果（メタデータとスニペット）を生成
+    
+    Args:
+        indices: 返却する文書インデックス（表示順。generation の通し番号）
+        scores: 文書ごとのスコア
+        query: 検索クエリ（スニペット用）
+        generation: 採点に使ったインデックスの世代
+        snippet_memo: 同じクエリの複数エンジン間で共有する 書籍ID -> スニペット
+        
+    Returns:
+        検索結果のリスト
+    """
+    results = []
+    # クエリの単語IDはセグメントごとの語彙で引く（結果の出たセグメントの分だけ）
+    snippet_terms = {}
+    
+    for i in map(int, indices):
+        segment, local = generation.locate(i)
+        store = segment.store
+        book_id = store.book_ids[local]
+        
+        snippet = snippet_memo.get(book_id) if snippet_memo is not None else None
+        if snippet is None:
+            if segment.segment_id not in snippet_terms:
+                snippet_terms[segment.segment_id] = segment.snippets.query_term_ids(query)
+            # スニペット生成もトレース（本文バッファから該当する文だけをデコードする）
+            with start_span(tracer, "generate_snippet", SPAN_LEVEL_DOCUMENT, attributes={"book.id": book_id}):
+                snippet = segment.snippets.get_snippet(store.text_bytes(local), local, query, term_ids=snippet_terms[segment.segment_id])
+            if snippet_memo is not None:
+                snippet_memo[book_id] = snippet
+        
+        results.append({
+            'id': book_id,
+            'title': store.titles[local],
+            'author': store.authors[local],
+            'score': float(scores[i]),
+            'snippet': snippet
+        })
+    return results
+
+def materialize_passage_results(passage_ids, scores, query: str) -> List[Dict[str, Any]]:
+    """選択済みのパッセージから検索結果を生成（一致したパッセージ自体をスニペットにする）
+    
+    Args:
+        passage_ids: 返却するパッセージID（表示順）
+        scores: パッセージごとのスコア
+        query: 検索クエリ（スニペット用）
+        
+    Returns:
+        検索結果のリスト（'passage' は書籍内でのパッセージの番号）
+    """
+    results = []
+    query_terms = passage_index.query_terms(query)
+    
+    for passage_id in map(int, passage_ids):
+        i = int(passage_index.passage_books[passage_id])
+        book_id = books_data.book_ids[i]
+        
+        # 本文の走査は不要で、パッセージの範囲だけをデコードする
+        with start_span(tracer, "generate_snippet", SPAN_LEVEL_DOCUMENT, attributes={"book.id": book_id, "passage.id": passage_id}):
+            passage = passage_index.passage_text(books_data.text_bytes(i), passage_id)
+            snippet = passage_index.snippet(passage, query_terms)
+        
+        results.append({
+            'id': book_id,
+            'title': books_data.titles[i],
+            'author': books_data.authors[i],
+            'score': float(scores[passage_id]),
+            'snippet': snippet,
+            'passage': passage_index.local_position(passage_id)
+        })
+    return results
+
+def tfidf_search(query: str, max_results: int = 20, similarity_threshold: float = 0.01, processed_query: Optional[str] = None, snippet_memo: Optional[Dict[str, str]] = None,
+                 granularity: str = "book", group_by_book: bool = True) -> List[Dict[str, Any]]:
     """TF-IDFベースの検索を実行
     
     Args:
         query: 検索クエリ
         max_results: 最大結果件数
         similarity_threshold: 類似度の閾値
+        processed_query: 前処理済みクエリ（呼び出し側で計算済みの場合）
+        snippet_memo: エンジン間で共有するスニペット（/search/compare 用）
+        granularity: 採点の単位 ("book": 書籍, "passage": パッセージ)
+        group_by_book: パッセージ単位のとき、書籍ごとに最高スコアのパッセージ1件にまとめるか
         
     Returns:
         検索結果のリスト
@@ -332,10 +747,21 @@ def tfidf_search(query: str, max_results: int = 20, similarity_threshold: float
         span.set_attribute("search.query", query)
         span.set_attribute("search.max_results", max_results)
         span.set_attribute("search.similarity_threshold", similarity_threshold)
+        span.set_attribute("search.granularity", granularity)
+        by_passage = granularity == "passage"
+        if by_passage:
+            vectorizer, matrix, metric_method = passage_index.tfidf_vectorizer, passage_index.tfidf_matrix, "tfidf_passage"
+        else:
+            vectorizer, matrix, metric_method = tfidf_vectorizer, tfidf_matrix, "tfidf"
+        # 検索中に書籍の追加・削除があっても、開始時点の世代で最後まで処理する
+        generation = segmented_index.current
+        segmented = generation.changed and not by_passage
+        span.set_attribute("search.index_generation", generation.number)
         
         # クエリの前処理
-        with tracer.start_as_current_span("preprocess_query") as preprocess_span:
-            processed_query = preprocess_text(query)
+        with start_span(tracer, "preprocess_query") as preprocess_span, stage_timer(metric_method, "preprocess"):
+            if processed_query is None:
+                processed_query = preprocess_text(query)
             preprocess_span.set_attribute("query.original", query)
             preprocess_span.set_attribute("query.processed", processed_query)
             
@@ -344,42 +770,39 @@ def tfidf_search(query: str, max_results: int = 20, similarity_threshold: float
                 return []
         
         # TF-IDFベクトル化
-        with tracer.start_as_current_span("vectorize_query") as vector_span:
-            query_vector = tfidf_vectorizer.transform([processed_query])
+        with start_span(tracer, "vectorize_query") as vector_span, stage_timer(metric_method, "vectorize"):
+            if segmented:
+                # 追加・削除後はセグメントを合わせたコーパスの IDF で重み付けする
+                query_vector = generation.tfidf_query_vectors([processed_query])
+            else:
+                query_vector = vectorizer.transform([processed_query])
             vector_span.set_attribute("vector.shape", str(query_vector.shape))
         
         # コサイン類似度計算
-        with tracer.start_as_current_span("compute_similarity") as similarity_span:
-            similarities = cosine_similarity(query_vector, tfidf_matrix).flatten()
+        with start_span(tracer, "compute_similarity") as similarity_span, stage_timer(metric_method, "score"):
+            if segmented:
+                similarities = generation.tfidf_scores(query_vector)[0]
+            else:
+                similarities = cosine_similarity(query_vector, matrix).flatten()
+                if by_passage:
+                    passage_index.clear_books(similarities, generation.deleted_base_positions())
             similarity_span.set_attribute("similarity.matrix_size", len(similarities))
         
         # 結果の整理
-        with tracer.start_as_current_span("process_results") as results_span:
-            results = []
-            book_ids = list(books_data.keys())
-            
-            for i, similarity in enumerate(similarities):
-                if similarity > similarity_threshold:
-                    book_id = book_ids[i]
-                    book_info = books_data[book_id]
-                    
-                    # スニペット生成もトレース
-                    with tracer.start_as_current_span("generate_snippet", attributes={"book.id": book_id}):
-                        snippet = get_snippet(book_info['raw_text'], query)
-                    
-                    results.append({
-                        'id': book_id,
-                        'title': book_info['title'],
-                        'author': book_info['author'],
-                        'score': float(similarity),
-                        'snippet': snippet
-                    })
+        with start_span(tracer, "process_results") as results_span:
+            # 上位k件を先に選び、スニペットとメタデータは返す分だけ生成する
+            with stage_timer(metric_method, "select"):
+                if by_passage:
+                    top_indices, total_matches = passage_index.select(similarities, max_results, similarity_threshold, group_by_book)
+                else:
+                    top_indices, total_matches = select_top_k(similarities, max_results, similarity_threshold)
+            with stage_timer(metric_method, "snippet"):
+                if by_passage:
+                    final_results = materialize_passage_results(top_indices, similarities, query)
+                else:
+                    final_results = materialize_results(top_indices, similarities, query, generation, snippet_memo)
             
-            # スコア順にソートして上位結果を返す
-            results.sort(key=lambda x: x['score'], reverse=True)
-            final_results = results[:max_results]
-            
-            results_span.set_attribute("results.total_matches", len(results))
+            results_span.set_attribute("results.total_matches", total_matches)
             results_span.set_attribute("results.returned", len(final_results))
             span.set_attribute("search.results_count", len(final_results))
             
@@ -389,13 +812,21 @@ def tfidf_search(query: str, max_results: int = 20, similarity_threshold: float
             
             return final_results
 
-def bm25_search(query: str, max_results: int = 20, score_threshold: float = 0.0) -> List[Dict[str, Any]]:
+def bm25_search(query: str, max_results: int = 20, score_threshold: float = 0.0, engine: str = "okapi", processed_query: Optional[str] = None, snippet_memo: Optional[Dict[str, str]] = None,
+                granularity: str = "book", group_by_book: bool = True) -> List[Dict[str, Any]]:
     """BM25ベースの検索を実行（TF-IDFより高精度）
     
     Args:
         query: 検索クエリ
         max_results: 最大結果件数
         score_threshold: スコアの閾値
+        engine: スコア計算エンジン ("okapi": rank_bm25, "sparse": 疎行列版, "pruned": ブロック単位の上限で枝刈りする上位k件検索)
+                rank_bm25 版は BM25_OKAPI_ENABLED のときだけ構築され、無効なら疎行列版で計算します
+                枝刈り版は結果が疎行列版と同じで、使えない場合（無効・追加削除後・負の閾値）は疎行列版で計算します
+        processed_query: 前処理済みクエリ（呼び出し側で計算済みの場合）
+        snippet_memo: エンジン間で共有するスニペット（/search/compare 用）
+        granularity: 採点の単位 ("book": 書籍, "passage": パッセージ。パッセージは疎行列版か枝刈り版で計算)
+        group_by_book: パッセージ単位のとき、書籍ごとに最高スコアのパッセージ1件にまとめるか
         
     Returns:
         検索結果のリスト
@@ -405,10 +836,33 @@ def bm25_search(query: str, max_results: int = 20, score_threshold: float = 0.0)
         span.set_attribute("search.max_results", max_results)
         span.set_attribute("search.score_threshold", score_threshold)
         span.set_attribute("search.algorithm", "BM25")
+        span.set_attribute("search.granularity", granularity)
+        metric_method = {"sparse": "bm25_sparse", "pruned": "bm25_pruned"}.get(engine, "bm25")
+        by_passage = granularity == "passage"
+        if by_passage:
+            metric_method += "_passage"
+            sparse_index = passage_index.bm25
+            block_max_index = passage_block_max
+        else:
+            sparse_index = bm25_sparse_index
+            block_max_index = bm25_block_max
+        generation = segmented_index.current
+        segmented = generation.changed and not by_passage
+        span.set_attribute("search.index_generation", generation.number)
+        if engine == "pruned":
+            # 枝刈り版は構築時のコーパスだけを対象にする（削除された書籍のパッセージを除けないので疎行列版で計算）
+            if (block_max_index is None or segmented or score_threshold < 0
+                    or (by_passage and len(generation.deleted_base_positions()))):
+                engine = "sparse"
+        # 追加・削除後はセグメントごとの疎行列版で、合わせたコーパスの統計を使って計算する
+        elif bm25_index is None or by_passage or segmented:
+            engine = "sparse"
+        span.set_attribute("search.engine", engine)
         
         # クエリの前処理
-        with tracer.start_as_current_span("preprocess_query") as preprocess_span:
-            processed_query = preprocess_text(query)
+        with start_span(tracer, "preprocess_query") as preprocess_span, stage_timer(metric_method, "preprocess"):
+            if processed_query is None:
+                processed_query = preprocess_text(query)
             preprocess_span.set_attribute("query.original", query)
             preprocess_span.set_attribute("query.processed", processed_query)
             
@@ -418,43 +872,52 @@ def bm25_search(query: str, max_results: int = 20, score_threshold: float = 0.0)
             
             # BM25用にトークン化
             query_tokens = processed_query.split()
-            preprocess_span.set_attribute("query.tokens", query_tokens)
             preprocess_span.set_attribute("query.token_count", len(query_tokens))
+            # トークン一覧は大きくなりうるので書籍単位の詳細度のときだけ記録する
+            if span_enabled(SPAN_LEVEL_DOCUMENT):
+                preprocess_span.set_attribute("query.tokens", query_tokens)
         
         # BM25スコア計算
-        with tracer.start_as_current_span("compute_bm25_scores") as bm25_span:
-            scores = bm25_index.get_scores(query_tokens)
-            bm25_span.set_attribute("bm25.scores_count", len(scores))
-            bm25_span.set_attribute("bm25.max_score", float(max(scores)) if len(scores) > 0 else 0.0)
-            bm25_span.set_attribute("bm25.min_score", float(min(scores)) if len(scores) > 0 else 0.0)
+        with start_span(tracer, "compute_bm25_scores") as bm25_span, stage_timer(metric_method, "score"):
+            if engine == "pruned":
+                groups = passage_index.passage_books if by_passage and group_by_book else None
+                top_indices, top_scores, prune_stats = block_max_index.top_k(query_tokens, max_results, score_threshold, groups=groups)
+                # 返す文書の分だけのスコア（materialize_* は scores[i] で引く）
+                scores = dict(zip(top_indices.tolist(), top_scores.tolist()))
+                for key, value in prune_stats.items():
+                    bm25_span.set_attribute(f"bm25.{key}", value)
+            elif segmented:
+                scores = generation.bm25_scores(query_tokens)
+            elif engine == "sparse":
+                scores = sparse_index.get_scores(query_tokens)
+                if by_passage:
+                    passage_index.clear_books(scores, generation.deleted_base_positions())
+            else:
+                scores = bm25_index.get_scores(query_tokens)
+            if engine != "pruned":
+                bm25_span.set_attribute("bm25.scores_count", len(scores))
+                bm25_span.set_attribute("bm25.max_score", float(max(scores)) if len(scores) > 0 else 0.0)
+                bm25_span.set_attribute("bm25.min_score", float(min(scores)) if len(scores) > 0 else 0.0)
         
         # 結果の整理
-        with tracer.start_as_current_span("process_results") as results_span:
-            results = []
-            book_ids = list(books_data.keys())
-            
-            for i, score in enumerate(scores):
-                if score > score_threshold:
-                    book_id = book_ids[i]
-                    book_info = books_data[book_id]
-                    
-                    # スニペット生成もトレース
-                    with tracer.start_as_current_span("generate_snippet", attributes={"book.id": book_id}):
-                        snippet = get_snippet(book_info['raw_text'], query)
-                    
-                    results.append({
-                        'id': book_id,
-                        'title': book_info['title'],
-                        'author': book_info['author'],
-                        'score': float(score),
-                        'snippet': snippet
-                    })
-            
-            # スコア順にソートして上位結果を返す
-            results.sort(key=lambda x: x['score'], reverse=True)
-            final_results = results[:max_results]
+        with start_span(tracer, "process_results") as results_span:
+            # 上位k件を先に選び、スニペットとメタデータは返す分だけ生成する
+            # 枝刈り版は上位k件を選んだ状態で返すので、一致件数は数えない
+            total_matches = None
+            if engine != "pruned":
+                with stage_timer(metric_method, "select"):
+                    if by_passage:
+                        top_indices, total_matches = passage_index.select(scores, max_results, score_threshold, group_by_book)
+                    else:
+                        top_indices, total_matches = select_top_k(scores, max_results, score_threshold)
+            with stage_timer(metric_method, "snippet"):
+                if by_passage:
+                    final_results = materialize_passage_results(top_indices, scores, query)
+                else:
+                    final_results = materialize_results(top_indices, scores, query, generation, snippet_memo)
             
-            results_span.set_attribute("results.total_matches", len(results))
+            if total_matches is not None:
+                results_span.set_attribute("results.total_matches", total_matches)
             results_span.set_attribute("results.returned", len(final_results))
             span.set_attribute("search.results_count", len(final_results))
             
@@ -465,13 +928,91 @@ def bm25_search(query: str, max_results: int = 20, score_threshold: float = 0.0)
             logger.info("BM25検索完了", extra={
                 "event_type": "bm25_search_complete", 
                 "query": query,
+                "engine": engine,
+                "granularity": granularity,
                 "results_count": len(final_results),
-                "total_matches": len(results),
+                "total_matches": total_matches,
                 "top_score": final_results[0]['score'] if final_results else 0.0
             })
             
             return final_results
 
+def boolean_search(query: str, max_results: int = 20, ranking: str = BOOLEAN_RANKING) -> List[Dict[str, Any]]:
+    """AND / OR / NOT・フレーズのブール検索（構文は positional_index を参照）
+    
+    Args:
+        query: 検索クエリ（例: '"white whale" AND NOT ahab'）
+        max_results: 最大結果件数
+        ranking: 一致した書籍の並べ方 ("bm25": NOT でない語の BM25 スコア順, "none": コーパス順でスコアは1)
+        
+    Returns:
+        検索結果のリスト
+        
+    Raises:
+        BooleanQueryError: クエリの構文が正しくない場合
+    """
+    if ranking not in BOOLEAN_RANKINGS:
+        raise ValueError(f"Unsupported boolean ranking: {ranking}. Available rankings: {BOOLEAN_RANKINGS}")
+    with tracer.start_as_current_span("boolean_search") as span:
+        span.set_attribute("search.query", query)
+        span.set_attribute("search.max_results", max_results)
+        span.set_attribute("search.algorithm", "BOOLEAN")
+        span.set_attribute("search.ranking", ranking)
+        generation = segmented_index.current
+        span.set_attribute("search.index_generation", generation.number)
+        
+        # クエリの構文解析（語・フレーズはインデックスと同じアナライザーで前処理）
+        with start_span(tracer, "parse_query") as parse_span, stage_timer("boolean", "preprocess"):
+            node = parse_boolean_query(query)
+            parse_span.set_attribute("query.original", query)
+            parse_span.set_attribute("query.parsed", describe_query(node))
+            if node is None:
+                span.set_attribute("search.results_count", 0)
+                return []
+            phrases = positive_phrases(node)
+        
+        # 位置インデックスで一致する書籍の集合を求める（追加・削除後はセグメントごとに求めて合わせる）
+        with start_span(tracer, "match_documents") as match_span, stage_timer("boolean", "match"):
+            matches = generation.boolean_matches(node)
+            if matches is None:
+                raise ValueError("positional index is not available")
+            match_span.set_attribute("boolean.matches", len(matches))
+        
+        with start_span(tracer, "process_results") as results_span:
+            with stage_timer("boolean", "select"):
+                if ranking == "bm25" and len(matches):
+                    # 一致した書籍だけを NOT でない語の BM25 で順位付けする（同点はコーパス順）
+                    query_tokens = [token for phrase in phrases for token in phrase[1]]
+                    if generation.changed:
+                        scores = generation.bm25_scores(query_tokens)
+                    else:
+                        scores = bm25_sparse_index.get_scores(query_tokens)
+                    order, _ = select_top_k(scores[matches], max_results, -np.inf)
+                    top_indices = matches[order]
+                    top_scores = scores[top_indices]
+                else:
+                    top_indices = matches[:max(max_results, 0)]
+                    top_scores = np.ones(len(top_indices))
+            with stage_timer("boolean", "snippet"):
+                # スニペットは NOT でない語で探す（演算子や除外した語を含めない）
+                snippet_query = " ".join(phrase[2] for phrase in phrases)
+                final_results = materialize_results(top_indices, dict(zip(top_indices.tolist(), top_scores.tolist())),
+                                                    snippet_query, generation)
+            
+            results_span.set_attribute("results.total_matches", len(matches))
+            results_span.set_attribute("results.returned", len(final_results))
+            span.set_attribute("search.results_count", len(final_results))
+            
+            logger.info("ブール検索完了", extra={
+                "event_type": "boolean_search_complete",
+                "query": query,
+                "parsed_query": describe_query(node),
+                "results_count": len(final_results),
+                "total_matches": len(matches),
+            })
+            
+            return final_results
+
 def slow_tfidf_search(query: str, max_results: int = 20, similarity_threshold: float = 0.01) -> List[Dict[str, Any]]:
     """意図的に遅いTF-IDFベースの検索（オブザーバビリティー研修用）
     
@@ -490,7 +1031,7 @@ def slow_tfidf_search(query: str, max_results: int = 20, similarity_threshold: f
         span.set_attribute("search.algorithm", "SLOW_TFIDF")
         
         # ボトルネック1: 前処理で無駄な処理
-        with tracer.start_as_current_span("slow_preprocess_query") as preprocess_span:
+        with tracer.start_as_current_span("slow_preprocess_query") as preprocess_span, stage_timer("slow_tfidf", "preprocess"):
             processed_query = preprocess_text(query)
             preprocess_span.set_attribute("query.original", query)
             preprocess_span.set_attribute("query.processed", processed_query)
@@ -509,7 +1050,7 @@ def slow_tfidf_search(query: str, max_results: int = 20, similarity_threshold: f
             time.sleep(0.2)  # 200ms の意図的な遅延
         
         # ボトルネック2: ベクトル化で重複処理
-        with tracer.start_as_current_span("slow_vectorize_query") as vector_span:
+        with tracer.start_as_current_span("slow_vectorize_query") as vector_span, stage_timer("slow_tfidf", "vectorize"):
             # 通常のベクトル化
             query_vector = tfidf_vectorizer.transform([processed_query])
             vector_span.set_attribute("vector.shape", str(query_vector.shape))
@@ -522,7 +1063,7 @@ def slow_tfidf_search(query: str, max_results: int = 20, similarity_threshold: f
             vector_span.set_attribute("bottleneck.duplicate_vectorizations", 10)
         
         # ボトルネック3: 類似度計算で非効率な処理
-        with tracer.start_as_current_span("slow_compute_similarity") as similarity_span:
+        with tracer.start_as_current_span("slow_compute_similarity") as similarity_span, stage_timer("slow_tfidf", "score"):
             # 通常の類似度計算
             similarities = cosine_similarity(query_vector, tfidf_matrix).flatten()
             similarity_span.set_attribute("similarity.matrix_size", len(similarities))
@@ -539,16 +1080,15 @@ def slow_tfidf_search(query: str, max_results: int = 20, similarity_threshold: f
         # ボトルネック4: 結果処理で非効率なソート
         with tracer.start_as_current_span("slow_process_results") as results_span:
             results = []
-            book_ids = list(books_data.keys())
             
             for i, similarity in enumerate(similarities):
                 if similarity > similarity_threshold:
-                    book_id = book_ids[i]
-                    book_info = books_data[book_id]
+                    book_id = books_data.book_ids[i]
+                    book_info = books_data.metadata(i)
                     
                     # スニペット生成（通常処理）
-                    with tracer.start_as_current_span("slow_generate_snippet", attributes={"book.id": book_id}):
-                        snippet = get_snippet(book_info['raw_text'], query)
+                    with tracer.start_as_current_span("slow_generate_snippet", attributes={"book.id": book_id}), stage_timer("slow_tfidf", "snippet"):
+                        snippet = get_snippet(books_data.text(i), query)
                         # 各スニペット生成後に遅延
                         time.sleep(0.03)  # 30ms遅延
                     
@@ -561,7 +1101,7 @@ def slow_tfidf_search(query: str, max_results: int = 20, similarity_threshold: f
                     })
             
             # 非効率なバブルソート（ボトルネック）
-            with tracer.start_as_current_span("inefficient_bubble_sort") as sort_span:
+            with tracer.start_as_current_span("inefficient_bubble_sort") as sort_span, stage_timer("slow_tfidf", "select"):
                 # まず通常のソート（これは隠す）
                 results.sort(key=lambda x: x['score'], reverse=True)
                 
@@ -597,13 +1137,43 @@ def slow_tfidf_search(query: str, max_results: int = 20, similarity_threshold: f
             
             return final_results
 
-def perform_search(query: str, search_method: str = "tfidf", **kwargs) -> List[Dict[str, Any]]:
+SEARCH_METHODS = ["tfidf", "bm25", "bm25_sparse", "bm25_pruned", "boolean", "slow_tfidf"]
+# slow_tfidf は研修用に毎回遅い処理を見せたいのでキャッシュしない
+# boolean は前処理済みクエリに演算子・引用符が残らずキーが衝突するのでキャッシュしない（評価は位置インデックスで数ミリ秒）
+CACHEABLE_METHODS = {"tfidf", "bm25", "bm25_sparse", "bm25_pruned"}
+# 採点の単位（パッセージ単位は PASSAGE_INDEX_ENABLED のときのみ）
+GRANULARITIES = ["book", "passage"]
+PASSAGE_SEARCH_METHODS = ["tfidf", "bm25", "bm25_sparse", "bm25_pruned"]
+
+def granularity_error(search_method: str, granularity: str) -> Optional[str]:
+    """採点の単位・手法が現在のインデックスで使えない場合の理由（使える場合は None）"""
+    if search_method == "boolean" and positional_index is None:
+        return "ブール検索の位置インデックスが無効です（POSITIONAL_INDEX_ENABLED）"
+    if granularity not in GRANULARITIES:
+        return f"未対応の採点単位: {granularity}（{GRANULARITIES}）"
+    if granularity == "passage":
+        if passage_index is None:
+            return "パッセージ単位のインデックスが無効です（PASSAGE_INDEX_ENABLED）"
+        if search_method not in PASSAGE_SEARCH_METHODS:
+            return f"パッセージ単位で使える検索手法: {PASSAGE_SEARCH_METHODS}"
+    return None
+
+def granularity_kwargs(granularity: str, group_by_book: bool) -> Dict[str, Any]:
+    """検索関数に渡す採点単位のパラメータ（書籍単位は既定値なので渡さず、キャッシュキーも従来どおりにする）"""
+    if granularity == "book":
+        return {}
+    return {"granularity": granularity, "group_by_book": group_by_book}
+
+def perform_search(query: str, search_method: str = "tfidf", processed_query: Optional[str] = None,
+                   snippet_memo: Optional[Dict[int, str]] = None, **kwargs) -> List[Dict[str, Any]]:
     """検索を実行する統合インターフェース
     
     Args:
         query: 検索クエリ
-        search_method: 検索手法 ("tfidf", "bm25", "boolean", "fuzzy" など)
-        **kwargs: 各検索手法固有のパラメータ
+        search_method: 検索手法 ("tfidf", "bm25", "bm25_sparse", "bm25_pruned", "boolean", "fuzzy" など)
+        processed_query: 前処理済みクエリ（呼び出し側で計算済みの場合）
+        snippet_memo: 複数エンジン間で共有するスニペット（キャッシュ対象の手法のみ使用）
+        **kwargs: 各検索手法固有のパラメータ（granularity・group_by_book を含む）
         
     Returns:
         検索結果のリスト
@@ -612,30 +1182,151 @@ def perform_search(query: str, search_method: str = "tfidf", **kwargs) -> List[D
         span.set_attribute("search.method", search_method)
         span.set_attribute("search.query", query)
         
+        if search_method not in SEARCH_METHODS:
+            span.set_status(trace.Status(trace.StatusCode.ERROR, f"Unsupported search method: {search_method}"))
+            raise ValueError(f"Unsupported search method: {search_method}. Available methods: {SEARCH_METHODS}")
+        error = granularity_error(search_method, kwargs.get("granularity", "book"))
+        if error:
+            span.set_status(trace.Status(trace.StatusCode.ERROR, error))
+            raise ValueError(error)
+        
+        # 結果キャッシュ（前処理済みクエリ・手法・パラメータがキー）
+        cache_key = None
+        if search_method in CACHEABLE_METHODS:
+            if processed_query is None:
+                processed_query = preprocess_text(query)
+            cache_key = search_cache.make_key(search_method, processed_query, split_terms(query), kwargs)
+            cached_results = search_cache.get(cache_key)
+            span.set_attribute("cache.hit", cached_results is not None)
+            for name, value in search_cache.stats().items():
+                span.set_attribute(f"cache.{name}", value)
+            if cached_results is not None:
+                return list(cached_results)
+            kwargs = dict(kwargs, processed_query=processed_query, snippet_memo=snippet_memo)
+        
         if search_method == "tfidf":
-            return tfidf_search(query, **kwargs)
+            results = tfidf_search(query, **kwargs)
         elif search_method == "bm25":
-            return bm25_search(query, **kwargs)
+            results = bm25_search(query, **kwargs)
+        elif search_method == "bm25_sparse":
+            results = bm25_search(query, engine="sparse", **kwargs)
+        elif search_method == "bm25_pruned":
+            results = bm25_search(query, engine="pruned", **kwargs)
         elif search_method == "slow_tfidf":
-            return slow_tfidf_search(query, **kwargs)
-        # elif search_method == "boolean":
-        #     return boolean_search(query, **kwargs)
+            results = slow_tfidf_search(query, **kwargs)
+        elif search_method == "boolean":
+            results = boolean_search(query, **kwargs)
         # elif search_method == "fuzzy":
         #     return fuzzy_search(query, **kwargs)
+        
+        if cache_key is not None:
+            search_cache.put(cache_key, results)
+        return results
+
+BATCH_SEARCH_METHODS = ["tfidf", "bm25", "bm25_sparse"]
+
+def batch_search(queries: List[str], search_method: str = "tfidf", max_results: int = 20,
+                 granularity: str = "book", group_by_book: bool = True) -> List[Dict[str, Any]]:
+    """複数クエリをまとめて検索（スコア計算は全クエリで1回の疎行列演算）
+    
+    TF-IDFは全クエリを1回の transform でベクトル化して文書行列との類似度を一括計算し、
+    BM25は「クエリ×単語」の出現回数行列と単語×文書の重み行列の積で一括計算します
+    （bm25 / bm25_sparse とも疎行列版エンジンで計算。スコアは単体検索と一致します）。
+    上位k件の選択とスニペット生成はクエリごとに行います。
+    
+    Args:
+        queries: 検索クエリのリスト
+        search_method: 検索手法 ("tfidf", "bm25" or "bm25_sparse")
+        max_results: クエリごとの最大結果件数
+        granularity: 採点の単位 ("book" or "passage")
+        group_by_book: パッセージ単位のとき、書籍ごとに最高スコアのパッセージ1件にまとめるか
+        
+    Returns:
+        クエリごとの {query, total_results, total_matches, results} のリスト
+    """
+    with tracer.start_as_current_span("batch_search") as span:
+        span.set_attribute("search.method", search_method)
+        span.set_attribute("search.batch_size", len(queries))
+        span.set_attribute("search.max_results", max_results)
+        
+        if search_method not in BATCH_SEARCH_METHODS:
+            span.set_status(trace.Status(trace.StatusCode.ERROR, f"Unsupported batch search method: {search_method}"))
+            raise ValueError(f"Unsupported batch search method: {search_method}. Available methods: {BATCH_SEARCH_METHODS}")
+        error = granularity_error(search_method, granularity)
+        if error:
+            span.set_status(trace.Status(trace.StatusCode.ERROR, error))
+            raise ValueError(error)
+        span.set_attribute("search.granularity", granularity)
+        by_passage = granularity == "passage"
+        if by_passage:
+            vectorizer, matrix, sparse_index = passage_index.tfidf_vectorizer, passage_index.tfidf_matrix, passage_index.bm25
         else:
-            available_methods = ["tfidf", "bm25", "slow_tfidf"]
-            span.set_status(trace.Status(trace.StatusCode.ERROR, f"Unsupported search method: {search_method}"))
-            raise ValueError(f"Unsupported search method: {search_method}. Available methods: {available_methods}")
+            vectorizer, matrix, sparse_index = tfidf_vectorizer, tfidf_matrix, bm25_sparse_index
+        generation = segmented_index.current
+        segmented = generation.changed and not by_passage
+        span.set_attribute("search.index_generation", generation.number)
+        
+        with start_span(tracer, "preprocess_queries") as preprocess_span:
+            processed_queries = [preprocess_text(query) for query in queries]
+            # 前処理で空になったクエリはスコア計算から外す
+            active = [i for i, processed in enumerate(processed_queries) if processed]
+            preprocess_span.set_attribute("query.active_count", len(active))
+        
+        with start_span(tracer, "compute_batch_scores") as scores_span:
+            if not active:
+                scores = None
+            elif segmented and search_method == "tfidf":
+                scores = generation.tfidf_scores(generation.tfidf_query_vectors([processed_queries[i] for i in active]))
+            elif segmented:
+                # BM25 の重み行列は平均文書長に依存するので、追加・削除後はクエリごとに計算する
+                scores = np.vstack([generation.bm25_scores(processed_queries[i].split()) for i in active])
+            elif search_method == "tfidf":
+                query_vectors = vectorizer.transform([processed_queries[i] for i in active])
+                scores = cosine_similarity(query_vectors, matrix)
+            else:
+                scores = sparse_index.get_batch_scores([processed_queries[i].split() for i in active])
+            if by_passage and scores is not None:
+                passage_index.clear_books(scores, generation.deleted_base_positions())
+            scores_span.set_attribute("scores.shape", str(scores.shape) if scores is not None else "(0, 0)")
+        
+        threshold = 0.01 if search_method == "tfidf" else 0.0
+        rows = {query_index: row for row, query_index in enumerate(active)}
+        batch_results = []
+        with start_span(tracer, "process_results") as results_span:
+            for query_index, query in enumerate(queries):
+                results = []
+                total_matches = 0
+                if query_index in rows:
+                    query_scores = scores[rows[query_index]]
+                    if by_passage:
+                        top_indices, total_matches = passage_index.select(query_scores, max_results, threshold, group_by_book)
+                        results = materialize_passage_results(top_indices, query_scores, query)
+                    else:
+                        top_indices, total_matches = select_top_k(query_scores, max_results, threshold)
+                        results = materialize_results(top_indices, query_scores, query, generation)
+                batch_results.append({
+                    'query': query,
+                    'total_results': len(results),
+                    'total_matches': total_matches,
+                    'results': results
+                })
+            results_span.set_attribute("results.returned", sum(len(r['results']) for r in batch_results))
+        
+        return batch_results
 
 @app.get("/search")
-async def search_books(q: str, method: str = "tfidf", request: Request = None):
+async def search_books(q: str, method: str = "tfidf", granularity: str = "book", group_by_book: bool = True, request: Request = None):
     """検索クエリに基づいて書籍を検索
     
     Args:
         q: 検索クエリ
-        method: 検索手法 ("tfidf" or "bm25")
+        method: 検索手法 ("tfidf", "bm25", "bm25_sparse", "bm25_pruned", "boolean" or "slow_tfidf")
+                boolean は AND / OR / NOT・"フレーズ"・括弧の構文（構文の誤りは 400）
+        granularity: 採点の単位 ("book": 書籍, "passage": パッセージ。slow_tfidf・boolean は書籍のみ)
+        group_by_book: パッセージ単位のとき、書籍ごとに最高スコアのパッセージ1件にまとめるか
         request: HTTPリクエスト
     """
+    check_search_ready()
     
     # HTTPヘッダーからトレースコンテキストを抽出
     context = propagate.extract(dict(request.headers))
@@ -645,6 +1336,9 @@ async def search_books(q: str, method: str = "tfidf", request: Request = None):
         span.set_attribute("http.route", "/search")
         span.set_attribute("search.query", q)
         span.set_attribute("search.method", method)
+        span.set_attribute("search.granularity", granularity)
+        # 未知の手法名をそのままラベルにすると系列数が際限なく増えるのでまとめる
+        metric_method = method if method in SEARCH_METHODS else "unknown"
         
         # 分散トレース情報をログ出力
         traceparent = request.headers.get('traceparent')
@@ -667,30 +1361,53 @@ async def search_books(q: str, method: str = "tfidf", request: Request = None):
             span.set_attribute("error.message", "空の検索クエリ")
             logger.warning("空の検索クエリ", extra={"event_type": "search_validation_error", "query": q})
             raise HTTPException(status_code=400, detail="検索クエリが空です")
+        # 未知の手法は従来どおり検索処理側で扱い、採点単位の誤りだけをここで弾く
+        error = granularity_error(method, granularity) if method in SEARCH_METHODS else None
+        if error:
+            span.set_attribute("error.type", "validation_error")
+            span.set_attribute("error.message", error)
+            raise HTTPException(status_code=400, detail=error)
         
         try:
-            # 検索実行
-            with tracer.start_as_current_span("perform_search") as search_span:
+            # 検索実行（ワーカープールで実行し、イベントループは他のリクエストを処理し続ける）
+            with tracer.start_as_current_span("perform_search") as search_span, metrics.collect_stages() as stages:
                 search_span.set_attribute("search.method", method)
-                results = perform_search(q, search_method=method)
+                results, execution = await search_executor.run(perform_search, q, search_method=method, **granularity_kwargs(granularity, group_by_book))
+                set_execution_attributes(search_span, execution)
             
             response_time = time.time() - start_time
+            slow_query_log.record("/search", q, method, response_time * 1000, stages,
+                                  trace_id=format(span.get_span_context().trace_id, "032x"),
+                                  queue_wait_ms=execution["wait_ms"], results_count=len(results))
             
             # スパンに属性を追加
             span.set_attribute("search.results_count", len(results))
             span.set_attribute("search.response_time_ms", round(response_time * 1000, 3))
             span.set_attribute("http.status_code", 200)
+            metrics.observe_request("/search", metric_method, 200, response_time)
+            metrics.RESULT_COUNT.labels(metric_method).observe(len(results))
             
-            logger.info("検索API", extra={"event_type": "search_complete", "query": q, "results_count": len(results), "duration_ms": round(response_time * 1000, 3)})
+            logger.info("検索API", extra={"event_type": "search_complete", "query": q, "results_count": len(results), "duration_ms": round(response_time * 1000, 3), "cache": search_cache.stats()})
             
             return {
                 'query': q,
                 'method': method,
+                'granularity': granularity,
                 'total_results': len(results),
                 'results': results
             }
+        except SearchOverloadedError as e:
+            metrics.observe_request("/search", metric_method, search_executor.overload_status, time.time() - start_time)
+            raise reject_overloaded_search(span, e, q, start_time)
+        except BooleanQueryError as e:
+            metrics.observe_request("/search", metric_method, 400, time.time() - start_time)
+            span.set_attribute("error.type", "validation_error")
+            span.set_attribute("error.message", str(e))
+            logger.warning("ブール検索の構文エラー", extra={"event_type": "search_validation_error", "query": q, "error": str(e)})
+            raise HTTPException(status_code=400, detail=f"クエリの構文エラー: {e}")
         except Exception as e:
             error_time = time.time() - start_time
+            metrics.observe_request("/search", metric_method, 500, error_time)
             
             # エラー情報をスパンに記録
             span.record_exception(e)
@@ -704,13 +1421,16 @@ async def search_books(q: str, method: str = "tfidf", request: Request = None):
             raise HTTPException(status_code=500, detail=f"検索エラー: {str(e)}")
 
 @app.get("/search/compare")
-async def compare_search_methods(q: str, request: Request = None):
+async def compare_search_methods(q: str, granularity: str = "book", group_by_book: bool = True, request: Request = None):
     """TF-IDFとBM25の検索結果を比較
     
     Args:
         q: 検索クエリ
+        granularity: 採点の単位 ("book" or "passage")
+        group_by_book: パッセージ単位のとき、書籍ごとに最高スコアのパッセージ1件にまとめるか
         request: HTTPリクエスト
     """
+    check_search_ready()
     
     # HTTPヘッダーからトレースコンテキストを抽出
     context = propagate.extract(dict(request.headers)) if request else {}
@@ -725,22 +1445,37 @@ async def compare_search_methods(q: str, request: Request = None):
             span.set_attribute("error.type", "validation_error")
             span.set_attribute("error.message", "空の検索クエリ")
             raise HTTPException(status_code=400, detail="検索クエリが空です")
+        error = granularity_error("tfidf", granularity)
+        if error:
+            span.set_attribute("error.type", "validation_error")
+            span.set_attribute("error.message", error)
+            raise HTTPException(status_code=400, detail=error)
+        span.set_attribute("search.granularity", granularity)
+        search_kwargs = granularity_kwargs(granularity, group_by_book)
         
         try:
-            # 並列で両方の検索を実行
-            with tracer.start_as_current_span("compare_searches") as compare_span:
-                
-                # TF-IDF検索
-                with tracer.start_as_current_span("tfidf_comparison"):
-                    tfidf_start = time.time()
-                    tfidf_results = perform_search(q, search_method="tfidf")
-                    tfidf_time = time.time() - tfidf_start
-                
-                # BM25検索
-                with tracer.start_as_current_span("bm25_comparison"):
-                    bm25_start = time.time()
-                    bm25_results = perform_search(q, search_method="bm25")
-                    bm25_time = time.time() - bm25_start
+            # クエリの前処理は両エンジンで共通なので1回だけ行う
+            with start_span(tracer, "preprocess_query") as preprocess_span:
+                processed_query = preprocess_text(q)
+                preprocess_span.set_attribute("query.processed", processed_query)
+            
+            # 同じ書籍のスニペットは両エンジンで同じなので共有する
+            # （スレッドモードのみ有効。プロセスモードでは各ワーカーがコピーを持つ）
+            snippet_memo = {}
+            
+            async def run_comparison(span_name: str, search_method: str):
+                with start_span(tracer, span_name) as method_span:
+                    method_start = time.time()
+                    results, execution = await search_executor.run(perform_search, q, search_method=search_method, processed_query=processed_query, snippet_memo=snippet_memo, **search_kwargs)
+                    set_execution_attributes(method_span, execution)
+                    return results, time.time() - method_start
+            
+            # 並列で両方の検索を実行（所要時間は遅い方のエンジンにほぼ等しくなる）
+            with start_span(tracer, "compare_searches") as compare_span, metrics.collect_stages() as stages:
+                (tfidf_results, tfidf_time), (bm25_results, bm25_time) = await asyncio.gather(
+                    run_comparison("tfidf_comparison", "tfidf"),
+                    run_comparison("bm25_comparison", "bm25"),
+                )
                 
                 compare_span.set_attribute("tfidf.results_count", len(tfidf_results))
                 compare_span.set_attribute("tfidf.duration_ms", round(tfidf_time * 1000, 3))
@@ -751,6 +1486,9 @@ async def compare_search_methods(q: str, request: Request = None):
             
             span.set_attribute("search.total_time_ms", round(response_time * 1000, 3))
             span.set_attribute("http.status_code", 200)
+            metrics.observe_request("/search/compare", "compare", 200, response_time)
+            slow_query_log.record("/search/compare", q, "compare", response_time * 1000, stages,
+                                  trace_id=format(span.get_span_context().trace_id, "032x"))
             
             logger.info("検索比較API", extra={
                 "event_type": "search_compare_complete", 
@@ -762,6 +1500,7 @@ async def compare_search_methods(q: str, request: Request = None):
             
             return {
                 'query': q,
+                'granularity': granularity,
                 'comparison': {
                     'tfidf': {
                         'method': 'tfidf',
@@ -782,8 +1521,12 @@ async def compare_search_methods(q: str, request: Request = None):
                 }
             }
             
+        except SearchOverloadedError as e:
+            metrics.observe_request("/search/compare", "compare", search_executor.overload_status, time.time() - start_time)
+            raise reject_overloaded_search(span, e, q, start_time)
         except Exception as e:
             error_time = time.time() - start_time
+            metrics.observe_request("/search/compare", "compare", 500, error_time)
             
             span.record_exception(e)
             span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
@@ -795,5 +1538,267 @@ async def compare_search_methods(q: str, request: Request = None):
             logger.error("検索比較エラー", extra={"event_type": "search_compare_error", "query": q, "error": str(e), "duration_ms": round(error_time * 1000, 3)})
             raise HTTPException(status_code=500, detail=f"検索比較エラー: {str(e)}")
 
+def check_debug_access(request: Request):
+    """/debug/* の公開設定とトークンを確認（非公開なら 404、トークン不一致なら 403）"""
+    if not debug_access.enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not debug_access.authorized(request.headers.get("x-debug-token")):
+        raise HTTPException(status_code=403, detail="デバッグ用トークンが正しくありません")
+
+@app.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10.0, interval_ms: Optional[float] = None):
+    """指定秒数のサンプリングプロファイルを collapsed stack 形式で返す
+    
+    Args:
+        seconds: 採取する秒数（DEBUG_PROFILE_MAX_SECONDS まで）
+        interval_ms: 採取間隔（省略時は DEBUG_PROFILE_INTERVAL_MS）
+    """
+    check_debug_access(request)
+    if not 0 < seconds <= DEBUG_PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds は 0 より大きく {DEBUG_PROFILE_MAX_SECONDS} 以下にしてください")
+    if interval_ms is not None and interval_ms <= 0:
+        raise HTTPException(status_code=400, detail="interval_ms は 0 より大きくしてください")
+    
+    try:
+        # 採取中もイベントループは他のリクエストを処理し続ける（検索用ワーカープールは使わない）
+        profile = await asyncio.to_thread(profiler.profile, seconds, interval_ms / 1000 if interval_ms else None)
+    except ProfilerBusyError:
+        raise HTTPException(status_code=409, detail="別のプロファイル採取が実行中です")
+    
+    logger.info("プロファイル採取", extra={"event_type": "debug_profile", "seconds": seconds, "samples": profile["samples"], "stacks_count": len(profile["stacks"])})
+    return PlainTextResponse(profiler.collapse(profile["stacks"]), headers={
+        "X-Profile-Samples": str(profile["samples"]),
+        "X-Profile-Duration-Seconds": f"{profile['duration_seconds']:.3f}",
+    })
+
+@app.get("/debug/slow")
+async def debug_slow_queries(request: Request):
+    """閾値（SLOW_QUERY_THRESHOLD_MS）を超えた検索を新しい順に返す"""
+    check_debug_access(request)
+    return dict(slow_query_log.stats(), slow_queries=slow_query_log.entries())
+
+def check_admin_access(request: Request):
+    """/admin/* の公開設定とトークンを確認（非公開なら 404、トークン不一致なら 403）"""
+    if not admin_access.enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not admin_access.authorized(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=403, detail="管理用トークンが正しくありません")
+
+def check_ingest_available():
+    """書籍の追加・削除ができる状態か確認（インデックス未構築なら 503、プロセスモードなら 409）"""
+    if segmented_index.current is None:
+        raise HTTPException(status_code=503, detail="インデックスの準備ができていません")
+    # プロセスモードのワーカーは起動時にフォークしたインデックスを持つので、追加・削除が反映されない
+    if search_executor.mode == "process":
+        raise HTTPException(status_code=409, detail="SEARCH_EXECUTOR_MODE=process では書籍を追加・削除できません")
+    # 複数ワーカーで配信しているときは、受け付けたワーカーにしか反映されない
+    if shared_index is not None:
+        raise HTTPException(status_code=409, detail="複数ワーカーで配信中（UVICORN_WORKERS）は書籍を追加・削除できません")
+
+class IngestBook(BaseModel):
+    """追加する書籍（タイトル・著者を省略した場合はIDから推定する）"""
+    id: str
+    text: str
+    title: Optional[str] = None
+    author: Optional[str] = None
+
+class IngestBooksRequest(BaseModel):
+    """書籍追加のリクエストボディ"""
+    books: List[IngestBook]
+
+@app.post("/admin/books")
+async def ingest_books(body: IngestBooksRequest, request: Request):
+    """書籍をインデックスに追加（再構築せず、新しいセグメントとして追加する）
+    
+    Args:
+        body: 追加する書籍のリスト（INGEST_MAX_BOOKS 件まで）
+    """
+    check_admin_access(request)
+    check_ingest_available()
+    if not body.books:
+        raise HTTPException(status_code=400, detail="追加する書籍がありません")
+    if len(body.books) > INGEST_MAX_BOOKS:
+        raise HTTPException(status_code=400, detail=f"書籍数は {INGEST_MAX_BOOKS} 件以下にしてください")
+    if any(not book.id.strip() or not book.text.strip() for book in body.books):
+        raise HTTPException(status_code=400, detail="書籍のIDと本文は空にできません")
+    
+    books = []
+    for book in body.books:
+        title, author = parse_book_metadata(book.id)
+        books.append({'id': book.id, 'title': book.title or title, 'author': book.author or author, 'text': book.text})
+    
+    with tracer.start_as_current_span("ingest_books") as span:
+        span.set_attribute("ingest.books_count", len(books))
+        start_time = time.time()
+        try:
+            # 解析とセグメント作成はイベントループの外で行う（検索は現在の世代で処理され続ける）
+            generation, segment = await asyncio.to_thread(segmented_index.add_books, books)
+        except DuplicateBookError as e:
+            raise HTTPException(status_code=409, detail=f"同じIDの書籍があります: {e}")
+        except IngestUnavailableError:
+            raise HTTPException(status_code=503, detail="インデックスの準備ができていません")
+        
+        response_time = time.time() - start_time
+        span.set_attribute("ingest.segment_id", segment.segment_id)
+        span.set_attribute("ingest.generation", generation.number)
+        span.set_attribute("ingest.duration_ms", round(response_time * 1000, 3))
+        logger.info("書籍追加API", extra={"event_type": "books_ingested", "book_ids": [book['id'] for book in books], "segment_id": segment.segment_id,
+                                      "generation": generation.number, "duration_ms": round(response_time * 1000, 3)})
+    
+    return {
+        'added': [book['id'] for book in books],
+        'segment': segment.segment_id,
+        'generation': generation.number,
+        'total_books': generation.document_count,
+        'duration_ms': round(response_time * 1000, 3)
+    }
+
+@app.delete("/admin/books/{book_id}")
+async def delete_book(book_id: str, request: Request):
+    """書籍をインデックスから削除（削除済みの印を付け、セグメントのマージ時に取り除く）"""
+    check_admin_access(request)
+    check_ingest_available()
+    
+    # ベースの書籍を初めて削除するときは文書×単語の行列を作るのでイベントループの外で行う
+    generation = await asyncio.to_thread(segmented_index.remove_book, book_id)
+    if generation is None:
+        raise HTTPException(status_code=404, detail=f"書籍が見つかりません: {book_id}")
+    
+    logger.info("書籍削除API", extra={"event_type": "book_removed", "book_id": book_id, "generation": generation.number})
+    return {'removed': book_id, 'generation': generation.number, 'total_books': generation.document_count}
+
+@app.get("/admin/segments")
+async def get_segments(request: Request):
+    """インデックスの世代とセグメントごとの書籍数"""
+    check_admin_access(request)
+    return dict(segmented_index.stats(), segment_list=segmented_index.describe())
+
+class BatchSearchRequest(BaseModel):
+    """バッチ検索のリクエストボディ"""
+    queries: List[str]
+    method: str = "tfidf"
+    max_results: int = 20
+    granularity: str = "book"
+    group_by_book: bool = True
+
+@app.post("/search/batch")
+async def batch_search_books(body: BatchSearchRequest, request: Request = None):
+    """複数クエリをまとめて検索
+    
+    Args:
+        body: クエリのリスト・検索手法・クエリごとの最大結果件数・採点の単位
+        request: HTTPリクエスト
+    """
+    check_search_ready()
+    
+    # HTTPヘッダーからトレースコンテキストを抽出
+    context = propagate.extract(dict(request.headers)) if request else {}
+    
+    with tracer.start_as_current_span("search_batch_api", context=context) as span:
+        span.set_attribute("http.route", "/search/batch")
+        span.set_attribute("search.method", body.method)
+        span.set_attribute("search.batch_size", len(body.queries))
+        
+        start_time = time.time()
+        
+        if not body.queries:
+            span.set_attribute("error.type", "validation_error")
+            span.set_attribute("error.message", "空のクエリリスト")
+            raise HTTPException(status_code=400, detail="検索クエリが空です")
+        if len(body.queries) > SEARCH_BATCH_MAX_QUERIES:
+            span.set_attribute("error.type", "validation_error")
+            span.set_attribute("error.message", "クエリ数が上限を超えています")
+            raise HTTPException(status_code=400, detail=f"クエリ数は {SEARCH_BATCH_MAX_QUERIES} 件以下にしてください")
+        if body.method not in BATCH_SEARCH_METHODS:
+            span.set_attribute("error.type", "validation_error")
+            span.set_attribute("error.message", f"未対応の検索手法: {body.method}")
+            raise HTTPException(status_code=400, detail=f"バッチ検索で使える検索手法: {BATCH_SEARCH_METHODS}")
+        error = granularity_error(body.method, body.granularity)
+        if error:
+            span.set_attribute("error.type", "validation_error")
+            span.set_attribute("error.message", error)
+            raise HTTPException(status_code=400, detail=error)
+        span.set_attribute("search.granularity", body.granularity)
+        
+        batch_label = f"batch[{len(body.queries)}]"
+        try:
+            with tracer.start_as_current_span("perform_batch_search") as search_span:
+                batch_results, execution = await search_executor.run(batch_search, body.queries, search_method=body.method, max_results=body.max_results,
+                                                                 granularity=body.granularity, group_by_book=body.group_by_book)
+                set_execution_attributes(search_span, execution)
+            
+            response_time = time.time() - start_time
+            
+            span.set_attribute("search.results_count", sum(r['total_results'] for r in batch_results))
+            span.set_attribute("search.response_time_ms", round(response_time * 1000, 3))
+            span.set_attribute("http.status_code", 200)
+            metrics.observe_request("/search/batch", body.method, 200, response_time)
+            result_count = metrics.RESULT_COUNT.labels(body.method)
+            for batch_result in batch_results:
+                result_count.observe(batch_result['total_results'])
+            
+            logger.info("バッチ検索API", extra={"event_type": "search_batch_complete", "query": batch_label, "batch_size": len(body.queries), "method": body.method, "duration_ms": round(response_time * 1000, 3)})
+            
+            return {
+                'method': body.method,
+                'granularity': body.granularity,
+                'total_queries': len(batch_results),
+                'duration_ms': round(response_time * 1000, 3),
+                'results': batch_results
+            }
+        except SearchOverloadedError as e:
+            metrics.observe_request("/search/batch", body.method, search_executor.overload_status, time.time() - start_time)
+            raise reject_overloaded_search(span, e, batch_label, start_time)
+        except Exception as e:
+            error_time = time.time() - start_time
+            metrics.observe_request("/search/batch", body.method, 500, error_time)
+            
+            span.record_exception(e)
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
+            span.set_attribute("error.type", type(e).__name__)
+            span.set_attribute("error.message", str(e))
+            span.set_attribute("search.error_time_ms", round(error_time * 1000, 3))
+            span.set_attribute("http.status_code", 500)
+            
+            logger.error("バッチ検索エラー", extra={"event_type": "search_batch_error", "query": batch_label, "error": str(e), "duration_ms": round(error_time * 1000, 3)})
+            raise HTTPException(status_code=500, detail=f"バッチ検索エラー: {str(e)}")
+
+def serve_with_shared_index(workers: int):
+    """インデックスを1回だけ用意して共有メモリに公開し、複数の uvicorn ワーカープロセスで配信
+    
+    ワーカーは環境変数でブロック名を受け取り、startup_event で接続します。
+    親プロセスはリクエストを処理しないので、公開した後は自分のインデックスを手放します。
+    """
+    global books_data, tfidf_vectorizer, tfidf_matrix, bm25_index, bm25_sparse_index, snippet_index, passage_index
+    global bm25_block_max, passage_block_max, positional_index
+    
+    fingerprint, index_source = prepare_search_index()
+    arrays, metadata = search_index_to_arrays()
+    with startup_phase("publish_shared_index"), tracer.start_as_current_span("publish_shared_index") as span:
+        shared = SharedIndex.publish(arrays, metadata, fingerprint or str(time.time_ns()))
+        span.set_attribute("shared_index.name", shared.name)
+        span.set_attribute("shared_index.bytes", shared.nbytes)
+    del arrays, metadata
+    books_data = BookStore.empty()
+    tfidf_vectorizer = tfidf_matrix = bm25_index = bm25_sparse_index = snippet_index = passage_index = None
+    bm25_block_max = passage_block_max = positional_index = None
+    
+    try:
+        os.environ[SHARED_MEMORY_ENV] = shared.name
+        print(f"🔗 インデックスを共有メモリに公開: {shared.name}（{shared.nbytes / 2**20:.1f}MB, {index_source}）, ワーカー数: {workers}")
+        logger.info("共有メモリにインデックスを公開", extra={"event_type": "shared_index_published", "shared_memory_name": shared.name, "bytes": shared.nbytes,
+                                                    "index_source": index_source, "workers": workers})
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
+    finally:
+        shared.close()
+        shared.unlink()
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
+    if "--build-index" in sys.argv:
+        # イメージビルド時などにスナップショットだけを事前構築する
+        build_search_index()
+        save_search_index(corpus_fingerprint())
+    elif UVICORN_WORKERS > 1:
+        serve_with_shared_index(UVICORN_WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
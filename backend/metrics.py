@@ -0,0 +1,359 @@
+"""
+Prometheus形式のメトリクス
+
+検索のレイテンシ（手法別・段階別）・結果件数・起動フェーズの所要時間などを
+プロセス内で集計し、/metrics で Prometheus のテキスト形式として返します。
+
+本番で常時有効にできるよう、記録は軽量にしています。
+- ヒストグラムのバケット境界は固定で、観測値はバケットの件数と合計だけを持つ（値を溜めない）
+- ラベルの組み合わせごとの子メトリクスは初回だけ作り、以降は辞書引きで再利用する
+- ロックはメトリクスごとの短いクリティカルセクションのみ
+キャッシュやワーカープールの状態のように既に別の場所で数えているものは、
+コレクター関数でスクレイプ時に読み出します。
+"""
+
+import bisect
+import contextlib
+import contextvars
+import math
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# レイテンシ用のバケット（秒）。0.5ms〜10s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 結果件数用のバケット
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # 最後の要素は +Inf バケット
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class _Metric:
+    """ラベルの組み合わせごとに子メトリクスを持つメトリクスの基底クラス"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._unlabeled = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """ラベル値に対応する子メトリクス（2回目以降は作成済みのものを返す）"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name}: expected labels {self.label_names}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._unlabeled.inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}"
+                for values, child in list(self._children.items())]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self._unlabeled.set(value)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}"
+                for values, child in list(self._children.items())]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._unlabeled.observe(value)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, values, le)} {cumulative}")
+            labels = _format_labels(self.label_names, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# リクエスト単位で段階ごとの所要時間を集める辞書（collect_stages() の中でのみ設定される）
+_stage_breakdown = contextvars.ContextVar("stage_breakdown", default=None)
+
+
+@contextlib.contextmanager
+def collect_stages():
+    """with ブロック内の stage_timer の所要時間（秒）を 名前 -> 合計 の辞書に集める
+
+    ワーカープール（スレッドモード）はコンテキストを引き継ぐので、
+    ワーカー上で実行された段階も同じ辞書に入ります。
+    """
+    breakdown = {}
+    token = _stage_breakdown.set(breakdown)
+    try:
+        yield breakdown
+    finally:
+        _stage_breakdown.reset(token)
+
+
+class Timer:
+    """with ブロックの所要時間をヒストグラムに記録するコンテキストマネージャー"""
+
+    __slots__ = ("histogram", "name", "start")
+
+    def __init__(self, histogram: _HistogramChild, name: str = ""):
+        self.histogram = histogram
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed)
+        breakdown = _stage_breakdown.get()
+        if breakdown is not None and self.name:
+            breakdown[self.name] = breakdown.get(self.name, 0.0) + elapsed
+        return False
+
+
+# コレクター: スクレイプ時に呼ばれ、(メトリクス名, 型, 説明, [(ラベル辞書, 値)]) を返す
+CollectorSample = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[CollectorSample]]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Prometheus テキスト形式（version 0.0.4）"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, type_name, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {type_name}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# --- アプリケーションのメトリクス ---
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "search_request_duration_seconds", "Search API request latency",
+    ["endpoint", "method", "status"]))
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    "search_stage_duration_seconds", "Search stage latency (preprocess, vectorize, score, select, snippet)",
+    ["method", "stage"]))
+RESULT_COUNT = REGISTRY.register(Histogram(
+    "search_results_count", "Number of results returned per search",
+    ["method"], buckets=COUNT_BUCKETS))
+STARTUP_PHASE_SECONDS = REGISTRY.register(Gauge(
+    "startup_phase_duration_seconds", "Duration of each startup phase in the last startup",
+    ["phase"]))
+
+
+def stage_timer(method: str, stage: str) -> Timer:
+    """検索の段階ごとの所要時間を記録するタイマー（collect_stages() の中では "method.stage" としても記録）"""
+    return Timer(STAGE_LATENCY.labels(method, stage), f"{method}.{stage}")
+
+
+# 起動フェーズの開始・終了の通知先（listener(phase, event, seconds)。event は "start" / "end" / "error"）
+_phase_listeners: List[Callable[[str, str, float], None]] = []
+
+
+def add_phase_listener(listener: Callable[[str, str, float], None]) -> None:
+    """起動フェーズの開始・終了を受け取る関数を登録（/ready の進捗表示用）"""
+    _phase_listeners.append(listener)
+
+
+class startup_phase:
+    """起動フェーズの所要時間をゲージに記録するコンテキストマネージャー"""
+
+    __slots__ = ("phase", "gauge", "start")
+
+    def __init__(self, phase: str):
+        self.phase = phase
+        self.gauge = STARTUP_PHASE_SECONDS.labels(phase)
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        for listener in _phase_listeners:
+            listener(self.phase, "start", 0.0)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        self.gauge.set(seconds)
+        for listener in _phase_listeners:
+            listener(self.phase, "end" if exc_type is None else "error", seconds)
+        return False
+
+
+def process_rss_bytes() -> int:
+    """このプロセスの常駐メモリ（RSS）のバイト数（/proc が無い環境ではピーク値）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux は KiB、macOS はバイト
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def process_collector() -> List[CollectorSample]:
+    return [("process_resident_memory_bytes", "gauge", "Resident memory size in bytes", [({}, process_rss_bytes())])]
+
+
+def observe_request(endpoint: str, method: str, status: int, seconds: float) -> None:
+    REQUEST_LATENCY.labels(endpoint, method, str(status)).observe(seconds)
+
+
+def stats_collector(prefix: str, stats_func: Callable[[], Dict[str, float]], counters: Iterable[str] = (),
+                    gauges: Iterable[str] = (), documentation: str = "") -> Callable[[], List[CollectorSample]]:
+    """stats() 形式の辞書を返す関数からコレクターを作る
+
+    Args:
+        prefix: メトリクス名の接頭辞
+        stats_func: 数値の辞書を返す関数（例: search_cache.stats）
+        counters: 単調増加する値のキー（<prefix>_<key>_total として出力）
+        gauges: 現在値のキー（<prefix>_<key> として出力）
+    """
+    counters, gauges = tuple(counters), tuple(gauges)
+
+    def collect() -> List[CollectorSample]:
+        stats = stats_func()
+        samples = []
+        for key in counters:
+            samples.append((f"{prefix}_{key}_total", "counter", f"{documentation} {key}".strip(), [({}, stats.get(key, 0))]))
+        for key in gauges:
+            samples.append((f"{prefix}_{key}", "gauge", f"{documentation} {key}".strip(), [({}, stats.get(key, 0))]))
+        return samples
+
+    return collect
+
+
+REGISTRY.add_collector(process_collector)
@@ -0,0 +1,259 @@
+"""
+パッセージ（段落・固定長）単位のインデックス
+
+書籍全体を1文書とすると長い書籍ほどスコアが有利になり、スニペットも
+結果ごとに書籍の中から探し直す必要があります。
+取り込み時に各書籍をパッセージに分割し、パッセージを1文書として
+書籍単位と同じ TF-IDF・BM25 で採点します。一致したパッセージがそのままスニペットになります。
+書籍単位にまとめる場合は、書籍ごとに最もスコアの高いパッセージを採用します。
+
+分割方式:
+    paragraph  空行区切りの段落を size 語まで詰めて1パッセージにする（size を超える段落は固定長で分割）
+    fixed      size 語ごとに区切る
+
+パッセージの境界は書籍本文内の UTF-8 バイトオフセットで持ち、
+本文は BookStore のバッファから該当範囲だけをデコードします。
+"""
+
+import re
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from bm25_engine import SparseBM25
+from index_snapshot import tfidf_from_arrays, tfidf_to_arrays
+from ranking import select_top_k
+from snippets import split_terms
+from text_processing import get_analyzer, preprocess_text
+
+PASSAGE_MODES = ("paragraph", "fixed")
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+WORD_SPAN = re.compile(r"\S+")
+
+
+def _fixed_spans(text: str, start: int, end: int, size: int) -> List[Tuple[int, int]]:
+    """text[start:end] を size 語ごとに区切った文字オフセットの範囲"""
+    spans = []
+    span_start = span_end = 0
+    count = 0
+    for match in WORD_SPAN.finditer(text, start, end):
+        if count == 0:
+            span_start = match.start()
+        span_end = match.end()
+        count += 1
+        if count == size:
+            spans.append((span_start, span_end))
+            count = 0
+    if count:
+        spans.append((span_start, span_end))
+    return spans
+
+
+def _paragraph_spans(text: str, size: int) -> List[Tuple[int, int]]:
+    """段落を size 語まで詰めた文字オフセットの範囲"""
+    spans = []
+    current_start = current_end = 0
+    current_words = 0
+    paragraph_start = 0
+    boundaries = [(match.start(), match.end()) for match in PARAGRAPH_BREAK.finditer(text)] + [(len(text), len(text))]
+    for paragraph_end, next_start in boundaries:
+        words = WORD_SPAN.findall(text, paragraph_start, paragraph_end)
+        if words:
+            if len(words) > size:
+                if current_words:
+                    spans.append((current_start, current_end))
+                    current_words = 0
+                spans.extend(_fixed_spans(text, paragraph_start, paragraph_end, size))
+            else:
+                if current_words and current_words + len(words) > size:
+                    spans.append((current_start, current_end))
+                    current_words = 0
+                if not current_words:
+                    current_start = paragraph_start
+                current_end = paragraph_end
+                current_words += len(words)
+        paragraph_start = next_start
+    if current_words:
+        spans.append((current_start, current_end))
+    return spans
+
+
+def passage_spans(text: str, mode: str = "paragraph", size: int = 150) -> List[Tuple[int, int]]:
+    """本文をパッセージに分割した文字オフセットの (開始, 終了) のリスト"""
+    if mode not in PASSAGE_MODES:
+        raise ValueError(f"Unsupported passage mode: {mode}. Available modes: {PASSAGE_MODES}")
+    if size <= 0:
+        raise ValueError("passage size must be positive")
+    if mode == "fixed":
+        return _fixed_spans(text, 0, len(text), size)
+    return _paragraph_spans(text, size)
+
+
+def index_book_passages(text: str, mode: str = "paragraph", size: int = 150) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """1冊分のパッセージ境界と前処理済みテキストを計算
+
+    コーパス読み込みのワーカープロセスから呼ばれます。
+
+    Returns:
+        (開始バイトオフセット, 終了バイトオフセット, パッセージごとの前処理済みテキスト)
+    """
+    spans = passage_spans(text, mode, size)
+    starts = np.empty(len(spans), dtype=np.int64)
+    ends = np.empty(len(spans), dtype=np.int64)
+    processed = []
+
+    # 範囲は重ならず昇順なので、直前の位置からの差分だけをエンコードしてバイト位置を求める
+    position = 0
+    byte_position = 0
+    for passage_id, (start, end) in enumerate(spans):
+        byte_position += len(text[position:start].encode("utf-8"))
+        starts[passage_id] = byte_position
+        byte_position += len(text[start:end].encode("utf-8"))
+        ends[passage_id] = byte_position
+        position = end
+        processed.append(preprocess_text(text[start:end]))
+
+    return starts, ends, processed
+
+
+class PassageIndex:
+    """全書籍のパッセージ境界と、パッセージを文書とする TF-IDF・BM25 インデックス
+
+    パッセージは書籍順に並び、book_indptr[b]:book_indptr[b+1] が書籍 b のパッセージです。
+    """
+
+    def __init__(self, passage_books: np.ndarray, passage_starts: np.ndarray, passage_ends: np.ndarray,
+                 book_indptr: np.ndarray, tfidf_vectorizer: TfidfVectorizer, tfidf_matrix: csr_matrix,
+                 bm25: SparseBM25, mode: str, size: int):
+        self.passage_books = passage_books
+        self.passage_starts = passage_starts
+        self.passage_ends = passage_ends
+        self.book_indptr = book_indptr
+        self.tfidf_vectorizer = tfidf_vectorizer
+        self.tfidf_matrix = tfidf_matrix
+        self.bm25 = bm25
+        self.mode = mode
+        self.size = size
+        # パッセージを持つ書籍（書籍単位の最大値を np.maximum.reduceat で求めるため）
+        self._nonempty_books = np.flatnonzero(np.diff(book_indptr) > 0)
+
+    @classmethod
+    def from_books(cls, books: Sequence[Tuple[np.ndarray, np.ndarray, List[str]]], tfidf_params: Dict[str, Any],
+                   bm25_params: Dict[str, Any], mode: str, size: int) -> "PassageIndex":
+        """index_book_passages() の結果（書籍順）からインデックスを構築"""
+        book_indptr = np.zeros(len(books) + 1, dtype=np.int64)
+        book_indptr[1:] = np.cumsum([len(starts) for starts, _, _ in books])
+        passage_books = np.repeat(np.arange(len(books), dtype=np.int32), np.diff(book_indptr))
+        if books:
+            passage_starts = np.concatenate([starts for starts, _, _ in books])
+            passage_ends = np.concatenate([ends for _, ends, _ in books])
+        else:
+            passage_starts = np.empty(0, dtype=np.int64)
+            passage_ends = np.empty(0, dtype=np.int64)
+
+        processed = [text for _, _, texts in books for text in texts]
+        tfidf_vectorizer = TfidfVectorizer(**tfidf_params)
+        tfidf_matrix = tfidf_vectorizer.fit_transform(processed)
+        tfidf_vectorizer.stop_words_ = None
+        bm25 = SparseBM25.from_documents((text.split() for text in processed), **bm25_params)
+
+        return cls(passage_books, passage_starts, passage_ends, book_indptr,
+                   tfidf_vectorizer, tfidf_matrix, bm25, mode, size)
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """スナップショット保存用の配列とメタデータ（TF-IDF・BM25 は passage_ 接頭辞付き）"""
+        arrays = {
+            "passage_books": self.passage_books,
+            "passage_starts": self.passage_starts,
+            "passage_ends": self.passage_ends,
+            "passage_book_indptr": self.book_indptr,
+        }
+        metadata = {"passage_mode": self.mode, "passage_size": self.size}
+        for part_arrays, part_metadata in (tfidf_to_arrays(self.tfidf_vectorizer, self.tfidf_matrix, prefix="passage_tfidf"),
+                                           self.bm25.to_arrays(prefix="passage_bm25")):
+            arrays.update(part_arrays)
+            metadata.update(part_metadata)
+        return arrays, metadata
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any],
+                    tfidf_params: Dict[str, Any]) -> "PassageIndex":
+        """スナップショットの配列から復元（配列はコピーしない）"""
+        tfidf_vectorizer, tfidf_matrix = tfidf_from_arrays(arrays, metadata, tfidf_params, prefix="passage_tfidf")
+        return cls(
+            arrays["passage_books"],
+            arrays["passage_starts"],
+            arrays["passage_ends"],
+            arrays["passage_book_indptr"],
+            tfidf_vectorizer,
+            tfidf_matrix,
+            SparseBM25.from_arrays(arrays, metadata, prefix="passage_bm25"),
+            metadata["passage_mode"],
+            metadata["passage_size"],
+        )
+
+    def __len__(self) -> int:
+        return len(self.passage_books)
+
+    def book_scores(self, scores: np.ndarray) -> np.ndarray:
+        """書籍ごとのパッセージの最大スコア（パッセージのない書籍は -inf）"""
+        book_scores = np.full(len(self.book_indptr) - 1, -np.inf)
+        if len(self._nonempty_books):
+            book_scores[self._nonempty_books] = np.maximum.reduceat(scores, self.book_indptr[self._nonempty_books])
+        return book_scores
+
+    def clear_books(self, scores: np.ndarray, books: Sequence[int]) -> np.ndarray:
+        """指定した書籍（削除済みなど）のパッセージのスコアを0にする"""
+        for book in books:
+            scores[..., self.book_indptr[book]:self.book_indptr[book + 1]] = 0.0
+        return scores
+
+    def select(self, scores: np.ndarray, k: int, threshold: float, group_by_book: bool = True) -> Tuple[np.ndarray, int]:
+        """閾値を超えるパッセージのうち上位k件を選択
+
+        group_by_book の場合は書籍ごとの最高スコアのパッセージで書籍を順位付けし、
+        1書籍につき1パッセージを返します（同点なら書籍内で先のパッセージ）。
+
+        Returns:
+            (上位k件のパッセージID, 閾値を超えたパッセージ数（まとめる場合は書籍数）)
+        """
+        if not group_by_book:
+            return select_top_k(scores, k, threshold)
+        top_books, total_matches = select_top_k(self.book_scores(scores), k, threshold)
+        passages = np.fromiter(
+            (self.book_indptr[book] + int(np.argmax(scores[self.book_indptr[book]:self.book_indptr[book + 1]]))
+             for book in top_books),
+            dtype=np.int64, count=len(top_books))
+        return passages, total_matches
+
+    def local_position(self, passage_id: int) -> int:
+        """書籍内でのパッセージの番号"""
+        return int(passage_id - self.book_indptr[self.passage_books[passage_id]])
+
+    def passage_text(self, book_text: bytes, passage_id: int) -> str:
+        """書籍の本文（UTF-8 のバイト列）からパッセージを切り出してデコードする"""
+        return bytes(book_text[self.passage_starts[passage_id]:self.passage_ends[passage_id]]).decode("utf-8", errors="replace")
+
+    @staticmethod
+    def query_terms(query: str) -> frozenset:
+        """スニペット照合用に正規化したクエリの単語"""
+        normalize_term = get_analyzer().normalize_term
+        return frozenset(normalize_term(word) for word in split_terms(query))
+
+    @staticmethod
+    def snippet(passage: str, query_terms: frozenset, context_length: int = 25) -> str:
+        """パッセージからスニペットを作る（長い場合は最初に一致した単語の前後 context_length 語）"""
+        words = passage.split()
+        if len(words) <= context_length * 2:
+            return ' '.join(words)
+
+        normalize_term = get_analyzer().normalize_term
+        for i, word in enumerate(words):
+            if any(normalize_term(term) in query_terms for term in split_terms(word)):
+                start = max(0, i - context_length)
+                end = min(len(words), i + context_length)
+                return ' '.join(words[start:end])
+        return ' '.join(words[:context_length * 2]) + "..."
@@ -0,0 +1,330 @@
+"""
+位置情報付きの転置インデックスによるブール検索（AND / OR / NOT・フレーズ）
+
+TF-IDF・BM25 はスコアの順位付けだけで、「両方の語を含む」「この語を含まない」
+「この順に並ぶ」といった条件は表せません。BM25 の単語×文書の出現回数CSR（文書IDの昇順の転置リスト）に、
+posting ごとの出現位置（前処理後のトークン列での番号）を1本の配列として足し、
+条件に一致する文書の集合を求めます。
+
+クエリ構文:
+    whale ahab                   空白区切りは AND
+    whale AND ahab               大文字の AND / OR / NOT が演算子（小文字はただの単語）
+    whale OR leviathan
+    whale NOT ahab               NOT は直前までの条件から除く（先頭の NOT は全文書から除く）
+    "white whale"                フレーズ（前処理後の単語がこの順に連続して並ぶ）
+    (whale OR sea) AND captain   括弧でまとめる
+    優先順位は NOT > AND > OR
+
+語とフレーズはインデックスと同じアナライザーで前処理します。ストップワードや短い語は位置を持たないので、
+フレーズ "king of denmark" は前処理後の "king denmark" の連続として照合されます。
+前処理で語が残らない項（"the" など）は条件から外します。
+
+集合演算:
+    AND  短い転置リストから順に、各文書IDを長い方のリストで二分探索する（np.searchsorted）。
+         計算量は galloping と同じ O(m log n) で、長いリストを先頭から読むことはしない
+    OR   連結してソートし重複を除く
+    NOT  含む文書の集合との差
+    フレーズ  まず全単語の文書集合を AND で絞り、候補の文書の出現位置だけを取り出して
+              (文書, 位置 - フレーズ内の番号) の組を単語ごとに絞り込む
+"""
+
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from bm25_engine import SparseBM25
+from text_processing import get_analyzer
+
+_QUERY_TOKEN = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+_OPERATORS = ("AND", "OR", "NOT")
+
+
+class BooleanQueryError(ValueError):
+    """ブール検索のクエリが構文として正しくない場合の例外"""
+
+
+# --- クエリの構文解析 ---
+# 式はタプルで表す: ("phrase", 前処理後の単語のタプル, 元の文字列) / ("and", 子のリスト) / ("or", 子のリスト) / ("not", 子)
+
+
+def _lex(query: str) -> List[str]:
+    if query.count('"') % 2:
+        raise BooleanQueryError("unbalanced quotes")
+    return _QUERY_TOKEN.findall(query)
+
+
+def _phrase(text: str) -> Optional[tuple]:
+    tokens = tuple(get_analyzer().tokenize(text))
+    return ("phrase", tokens, text) if tokens else None
+
+
+def _combine(operator: str, children: List[Optional[tuple]]) -> Optional[tuple]:
+    """前処理で空になった項（None）を除いてまとめる"""
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return (operator, children)
+
+
+class _Parser:
+    """再帰下降の構文解析（or := and (OR and)*, and := not (AND? not)*, not := NOT not | primary）"""
+
+    def __init__(self, tokens: List[str]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self) -> str:
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self) -> Optional[tuple]:
+        if not self.tokens:
+            return None
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise BooleanQueryError(f"unexpected token: {self.peek()}")
+        return node
+
+    def parse_or(self) -> Optional[tuple]:
+        children = [self.parse_and()]
+        while self.peek() == "OR":
+            self.take()
+            children.append(self.parse_and())
+        return _combine("or", children)
+
+    def parse_and(self) -> Optional[tuple]:
+        children = [self.parse_not()]
+        while self.peek() not in (None, "OR", ")"):
+            if self.peek() == "AND":
+                self.take()
+            children.append(self.parse_not())
+        return _combine("and", children)
+
+    def parse_not(self) -> Optional[tuple]:
+        if self.peek() == "NOT":
+            self.take()
+            child = self.parse_not()
+            return ("not", child) if child is not None else None
+        return self.parse_primary()
+
+    def parse_primary(self) -> Optional[tuple]:
+        token = self.peek()
+        if token is None:
+            raise BooleanQueryError("unexpected end of query")
+        if token in _OPERATORS or token == ")":
+            raise BooleanQueryError(f"unexpected token: {token}")
+        self.take()
+        if token == "(":
+            node = self.parse_or()
+            if self.peek() != ")":
+                raise BooleanQueryError("unbalanced parentheses")
+            self.take()
+            return node
+        if token.startswith('"'):
+            return _phrase(token[1:-1])
+        return _phrase(token)
+
+
+def parse_boolean_query(query: str) -> Optional[tuple]:
+    """クエリを式に変換（前処理で条件が何も残らなければ None）
+
+    Raises:
+        BooleanQueryError: 括弧・引用符の対応や演算子の位置が正しくない場合
+    """
+    return _Parser(_lex(query)).parse()
+
+
+def describe_query(node: Optional[tuple]) -> str:
+    """式を読める文字列にする（トレース・ログ用）"""
+    if node is None:
+        return ""
+    kind = node[0]
+    if kind == "phrase":
+        return " ".join(node[1]) if len(node[1]) == 1 else '"' + " ".join(node[1]) + '"'
+    if kind == "not":
+        return f"NOT {describe_query(node[1])}"
+    return "(" + f" {kind.upper()} ".join(describe_query(child) for child in node[1]) + ")"
+
+
+def positive_phrases(node: Optional[tuple]) -> List[tuple]:
+    """NOT の下にない語・フレーズ（順位付けとスニペットに使う）"""
+    if node is None:
+        return []
+    kind = node[0]
+    if kind == "phrase":
+        return [node]
+    if kind == "not":
+        return []
+    return [phrase for child in node[1] for phrase in positive_phrases(child)]
+
+
+# --- 整列済みの文書IDの集合演算 ---
+
+
+def _sorted_unique(values: np.ndarray) -> np.ndarray:
+    if len(values) < 2:
+        return values
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+
+def _contains(haystack: np.ndarray, needles: np.ndarray) -> np.ndarray:
+    """needles の各値が haystack（昇順）に含まれるか"""
+    if not len(haystack):
+        return np.zeros(len(needles), dtype=bool)
+    found = np.searchsorted(haystack, needles)
+    np.minimum(found, len(haystack) - 1, out=found)
+    return haystack[found] == needles
+
+
+def intersect(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """昇順の集合の積（短い方の各要素を、長い方の該当範囲で二分探索する）"""
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a
+    b = b[np.searchsorted(b, a[0]):np.searchsorted(b, a[-1], side="right")]
+    return a[_contains(b, a)]
+
+
+def union(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return _sorted_unique(np.sort(np.concatenate((a, b)), kind="stable"))
+
+
+def difference(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    if not len(a) or not len(b):
+        return a
+    return a[~_contains(b, a)]
+
+
+class PositionalIndex:
+    """BM25 の転置リスト（SparseBM25.term_doc_tf）に posting ごとの出現位置を足したインデックス
+
+    term_doc_tf の posting の順（単語ID順・文書ID順）に、出現回数の分だけ位置を昇順で並べます。
+    posting j の位置は positions[position_ptr[j]:position_ptr[j + 1]] です。
+    """
+
+    def __init__(self, bm25: SparseBM25, positions: np.ndarray):
+        self.bm25 = bm25
+        self.positions = positions
+        tf = bm25.term_doc_tf.data
+        self.position_ptr = np.zeros(len(tf) + 1, dtype=np.int64)
+        np.cumsum(tf, out=self.position_ptr[1:])
+        if self.position_ptr[-1] != len(positions):
+            raise ValueError("positions do not match the BM25 postings")
+
+    @classmethod
+    def from_documents(cls, bm25: SparseBM25, documents: Iterable[Sequence[str]]) -> "PositionalIndex":
+        """bm25 を作ったのと同じトークン列（文書順）から位置を集める"""
+        term_ids = bm25.term_ids
+        doc_terms = [np.fromiter((term_ids[token] for token in tokens), dtype=np.int32, count=len(tokens))
+                     for tokens in documents]
+        if not doc_terms:
+            return cls(bm25, np.empty(0, dtype=np.int32))
+        lengths = np.array([len(terms) for terms in doc_terms], dtype=np.int64)
+        terms = np.concatenate(doc_terms)
+        del doc_terms
+        # 文書内の位置（通し番号から文書の先頭の番号を引く）
+        starts = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+        positions = (np.arange(len(terms), dtype=np.int64) - np.repeat(starts, lengths)).astype(np.int32)
+        # 安定ソートなので、単語ごとに文書ID順・位置順のまま並ぶ（= term_doc_tf の posting の順）
+        order = np.argsort(terms, kind="stable")
+        return cls(bm25, positions[order])
+
+    def to_arrays(self, prefix: str = "positional") -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """スナップショット保存用の配列（転置リスト自体は BM25 の配列を共有するので位置だけ）"""
+        return {f"{prefix}_positions": self.positions}, {}
+
+    @classmethod
+    def from_arrays(cls, bm25: SparseBM25, arrays: Dict[str, np.ndarray], prefix: str = "positional") -> "PositionalIndex":
+        """to_arrays() 形式の配列から復元（配列はコピーしない）"""
+        return cls(bm25, arrays[f"{prefix}_positions"])
+
+    def __len__(self) -> int:
+        return self.bm25.corpus_size
+
+    @property
+    def nbytes(self) -> int:
+        return self.positions.nbytes + self.position_ptr.nbytes
+
+    def documents(self, term_id: int) -> np.ndarray:
+        """単語を含む文書ID（昇順）"""
+        tf = self.bm25.term_doc_tf
+        return tf.indices[tf.indptr[term_id]:tf.indptr[term_id + 1]].astype(np.int64)
+
+    def occurrences(self, term_id: int, docs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """単語を含む文書 docs（昇順）での出現を (文書ID, 位置) の組で返す（文書ID順・位置順）"""
+        tf = self.bm25.term_doc_tf
+        start, end = tf.indptr[term_id], tf.indptr[term_id + 1]
+        postings = start + np.searchsorted(tf.indices[start:end], docs)
+        counts = tf.data[postings].astype(np.int64)
+        # posting ごとの位置の範囲をつなげた添字
+        offsets = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=offsets[1:])
+        indices = np.repeat(self.position_ptr[postings] - offsets, counts) + np.arange(int(counts.sum()), dtype=np.int64)
+        return np.repeat(docs, counts), self.positions[indices].astype(np.int64)
+
+    def phrase_documents(self, tokens: Sequence[str]) -> np.ndarray:
+        """単語がこの順に連続して現れる文書ID（昇順。1語ならその語を含む文書）"""
+        term_ids = self.bm25.term_ids
+        if any(token not in term_ids for token in tokens):
+            return np.empty(0, dtype=np.int64)
+        ids = [term_ids[token] for token in tokens]
+        postings = sorted((self.documents(term_id) for term_id in set(ids)), key=len)
+        docs = postings[0]
+        for other in postings[1:]:
+            docs = intersect(docs, other)
+        if len(ids) == 1 or not len(docs):
+            return docs
+
+        # (文書, フレーズの開始位置) を1つの整数にして、出現の少ない単語から順に絞り込む
+        starts = None
+        for offset in sorted(range(len(ids)), key=lambda i: self.bm25.document_frequency(tokens[i])):
+            occurrence_docs, positions = self.occurrences(ids[offset], docs)
+            valid = positions >= offset
+            keys = (occurrence_docs[valid] << 32) | (positions[valid] - offset)
+            starts = keys if starts is None else starts[_contains(keys, starts)]
+            if not len(starts):
+                break
+            docs = _sorted_unique(starts >> 32)
+        return _sorted_unique(starts >> 32)
+
+    def match(self, node: Optional[tuple]) -> np.ndarray:
+        """式に一致する文書ID（昇順）"""
+        if node is None:
+            return np.empty(0, dtype=np.int64)
+        kind = node[0]
+        if kind == "phrase":
+            return self.phrase_documents(node[1])
+        if kind == "not":
+            return difference(np.arange(len(self), dtype=np.int64), self.match(node[1]))
+        if kind == "or":
+            docs = np.empty(0, dtype=np.int64)
+            for child in node[1]:
+                docs = union(docs, self.match(child))
+            return docs
+
+        # AND: 否定でない項を積にしてから、否定の項を差として除く（全文書の補集合は作らない）
+        positives = [child for child in node[1] if child[0] != "not"]
+        negatives = [child[1] for child in node[1] if child[0] == "not"]
+        if positives:
+            sets = sorted((self.match(child) for child in positives), key=len)
+            docs = sets[0]
+            for other in sets[1:]:
+                if not len(docs):
+                    break
+                docs = intersect(docs, other)
+        else:
+            docs = np.arange(len(self), dtype=np.int64)
+        for child in negatives:
+            if not len(docs):
+                break
+            docs = difference(docs, self.match(child))
+        return docs
@@ -0,0 +1,206 @@
+"""
+オンデマンドのサンプリングプロファイラーと低速クエリの記録
+
+再デプロイせずに稼働中の Pod を調べるためのデバッグ用機能です。
+
+- SamplingProfiler: 指定秒数だけ一定間隔で全スレッドのスタック（sys._current_frames）を採取し、
+  flamegraph.pl / speedscope などでそのまま読める collapsed stack 形式で返します。
+  採取中だけ専用スレッドが動き、それ以外の時間は何もしません。
+- SlowQueryLog: 閾値を超えた検索のクエリ・手法・段階ごとの所要時間を
+  固定長のリングバッファに残します（段階は metrics.stage_timer の区切り）。
+
+プロファイラーが見えるのはこのプロセスのスレッドだけです。
+SEARCH_EXECUTOR_MODE=process の場合、検索そのものは別プロセスで実行されるため
+プロファイルにも段階ごとの所要時間にも現れません。
+"""
+
+import collections
+import hmac
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+
+class ProfilerBusyError(Exception):
+    """別のプロファイル採取が実行中の場合の例外"""
+
+
+class SamplingProfiler:
+    """全スレッドのスタックを一定間隔で採取する統計的プロファイラー
+
+    Args:
+        interval: 採取間隔（秒）
+        max_depth: 1スタックあたりの最大フレーム数（深い再帰で膨らまないように）
+    """
+
+    def __init__(self, interval: float = 0.01, max_depth: int = 128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._running = threading.Lock()
+        # コードオブジェクト -> フレーム名（文字列の組み立てを採取ごとに繰り返さない）
+        self._labels = {}
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            name = getattr(code, "co_qualname", code.co_name)
+            # collapsed stack 形式では ";" がフレームの区切り、空白が件数の区切り
+            label = f"{module}:{name}".replace(";", ",").replace(" ", "_")
+            self._labels[code] = label
+        return label
+
+    def profile(self, seconds: float, interval: Optional[float] = None) -> Dict[str, Any]:
+        """seconds 秒間スタックを採取する
+
+        Returns:
+            stacks: "スレッド名;外側のフレーム;...;内側のフレーム" -> 採取回数
+            samples: 採取した回数
+            duration_seconds: 実際の採取時間
+
+        Raises:
+            ProfilerBusyError: 別の採取が実行中の場合
+        """
+        if not self._running.acquire(blocking=False):
+            raise ProfilerBusyError("another profile is already running")
+        try:
+            interval = interval or self.interval
+            own_thread = threading.get_ident()
+            stacks = collections.Counter()
+            thread_names = {}
+            samples = 0
+            start = time.monotonic()
+            deadline = start + seconds
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                frames = sys._current_frames()
+                if len(frames) != len(thread_names):
+                    thread_names = {thread.ident: thread.name.replace(" ", "_") for thread in threading.enumerate()}
+                for thread_id, frame in frames.items():
+                    if thread_id == own_thread:
+                        continue
+                    labels = []
+                    while frame is not None and len(labels) < self.max_depth:
+                        labels.append(self._label(frame.f_code))
+                        frame = frame.f_back
+                    labels.append(thread_names.get(thread_id, str(thread_id)))
+                    labels.reverse()
+                    stacks[";".join(labels)] += 1
+                samples += 1
+                del frames
+                time.sleep(max(0.0, interval - (time.monotonic() - now)))
+            return {"stacks": stacks, "samples": samples, "duration_seconds": time.monotonic() - start}
+        finally:
+            self._running.release()
+
+    @staticmethod
+    def collapse(stacks: Dict[str, int]) -> str:
+        """collapsed stack 形式のテキスト（多い順）"""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+
+class SlowQueryLog:
+    """閾値を超えた検索を新しい順に一定件数だけ保持するリングバッファ
+
+    Args:
+        threshold_ms: 記録する所要時間の下限（負の値で記録しない）
+        max_entries: 保持する件数
+    """
+
+    def __init__(self, threshold_ms: float = 500.0, max_entries: int = 100):
+        self.threshold_ms = threshold_ms
+        self.max_entries = max_entries
+        self.recorded = 0
+        self._entries = collections.deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, query: str, method: str, duration_ms: float,
+               stages: Dict[str, float], **details) -> bool:
+        """閾値以上なら記録する
+
+        Args:
+            stages: 段階名 -> 所要時間（秒）（metrics.collect_stages() の結果）
+            **details: 追加で残す値（trace_id・待ち時間・結果件数など）
+
+        Returns:
+            記録したかどうか
+        """
+        if self.threshold_ms < 0 or duration_ms < self.threshold_ms:
+            return False
+        entry = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "endpoint": endpoint,
+            "query": query,
+            "method": method,
+            "duration_ms": round(duration_ms, 3),
+            "stages_ms": {name: round(seconds * 1000, 3) for name, seconds in stages.items()},
+        }
+        entry.update(details)
+        with self._lock:
+            self._entries.append(entry)
+            self.recorded += 1
+        return True
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """記録済みの検索（新しい順）"""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"threshold_ms": self.threshold_ms, "max_entries": self.max_entries,
+                "recorded": self.recorded, "size": len(self._entries)}
+
+
+class DebugAccess:
+    """/debug エンドポイントの公開可否とトークン照合
+
+    Args:
+        enabled: エンドポイントを公開するか（False なら 404）
+        token: 設定されていれば X-Debug-Token ヘッダーとの一致を要求（不一致なら 403）
+    """
+
+    def __init__(self, enabled: bool = False, token: str = ""):
+        self.enabled = enabled
+        self.token = token
+
+    def authorized(self, provided_token: Optional[str]) -> bool:
+        if not self.token:
+            return True
+        return hmac.compare_digest(self.token.encode(), (provided_token or "").encode())
+
+
+def create_debug_access() -> DebugAccess:
+    """環境変数からデバッグ用エンドポイントのアクセス設定を作成
+
+    DEBUG_ENDPOINTS_ENABLED  "true" で /debug/* を公開（default: false）
+    DEBUG_TOKEN              設定すると X-Debug-Token ヘッダーの一致を要求し、
+                             DEBUG_ENDPOINTS_ENABLED がなくても公開する
+    """
+    token = os.getenv("DEBUG_TOKEN", "")
+    enabled = os.getenv("DEBUG_ENDPOINTS_ENABLED", "false").lower() == "true" or bool(token)
+    return DebugAccess(enabled=enabled, token=token)
+
+
+def create_profiler() -> SamplingProfiler:
+    """環境変数からプロファイラーを作成
+
+    DEBUG_PROFILE_INTERVAL_MS  採取間隔（default: 10）
+    """
+    return SamplingProfiler(interval=float(os.getenv("DEBUG_PROFILE_INTERVAL_MS", "10")) / 1000)
+
+
+def create_slow_query_log() -> SlowQueryLog:
+    """環境変数から低速クエリの記録を作成
+
+    SLOW_QUERY_THRESHOLD_MS  記録する所要時間の下限（default: 500、負の値で無効）
+    SLOW_QUERY_LOG_SIZE      保持する件数（default: 100）
+    """
+    return SlowQueryLog(
+        threshold_ms=float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "500")),
+        max_entries=int(os.getenv("SLOW_QUERY_LOG_SIZE", "100")),
+    )
@@ -0,0 +1,328 @@
+"""
+ブロック単位の最大スコアで枝刈りする BM25 の上位k件検索（block-max MaxScore）
+
+疎行列版（SparseBM25.get_scores）はクエリ単語を含む全文書を採点しますが、
+上位k件に入らない文書の採点はほとんどが無駄になります。
+単語ごとの転置リスト（文書IDの昇順）を BLOCK_SIZE 件ずつのブロックに分け、
+ブロックごとに「そのブロックの文書で単語が取りうるスコアの最大値」を持っておきます。
+
+検索:
+    1. 上限の大きいブロックから k 件分の文書を採点し、k番目のスコア（枝刈りの基準）の初期値を得る
+    2. MaxScore: 上限の小さい単語から合計しても基準に届かない単語を「非必須」とし、
+       必須の単語の posting だけから候補を集める（必須の単語でも、上限が基準に届かないブロックは読まない）
+    3. 候補ごとに、未採点の単語は候補を含むブロックの上限で見積もり、基準に届かなくなった候補は落とす。
+       残った候補を含むブロックだけを復元して引く
+
+文書のスコアは疎行列版と同じ式・同じ単語順で合計するので、値はビット単位で一致します。
+上限も同じ順序で合計するため（浮動小数点の丸めは単調）、上限が基準を下回る文書だけを除けば
+結果は全件採点した場合の上位k件と同じです（同点は文書ID順）。
+
+転置リストの圧縮:
+    文書IDはブロックの直前の文書IDからの差分、出現回数はそのまま、
+    それぞれブロックごとに値が収まる最小の幅（1・2・4バイト）で1本のバイト列に詰めます。
+    ブロックは使うときにだけ復元します。
+"""
+
+from collections import Counter
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from bm25_engine import SparseBM25
+
+BLOCK_SIZE = 128
+
+_WIDTH_DTYPES = {1: np.dtype("<u1"), 2: np.dtype("<u2"), 4: np.dtype("<u4")}
+
+
+def _byte_widths(block_max_values: np.ndarray) -> np.ndarray:
+    """ブロックごとの最大値が収まる最小のバイト幅（1・2・4）"""
+    widths = np.full(len(block_max_values), 4, dtype=np.uint8)
+    widths[block_max_values <= np.iinfo(np.uint16).max] = 2
+    widths[block_max_values <= np.iinfo(np.uint8).max] = 1
+    return widths
+
+
+def _unpack(stream: np.ndarray, offsets: np.ndarray, widths: np.ndarray, posting_blocks: np.ndarray,
+            ranks: np.ndarray) -> np.ndarray:
+    """_pack() で詰めた値のうち、(ブロック, ブロック内の位置) の分を取り出す"""
+    posting_widths = widths[posting_blocks].astype(np.int64)
+    positions = offsets[posting_blocks] + ranks * posting_widths
+    values = stream[positions].astype(np.int64)
+    for byte in range(1, 4):
+        wide = np.flatnonzero(posting_widths > byte)
+        if not len(wide):
+            break
+        values[wide] |= stream[positions[wide] + byte].astype(np.int64) << (8 * byte)
+    return values
+
+
+def _sorted_unique(values: np.ndarray) -> np.ndarray:
+    """昇順に並んだ配列から重複を除く（np.unique より速い）"""
+    if len(values) < 2:
+        return values
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+
+def _pack(values: np.ndarray, posting_blocks: np.ndarray, positions: np.ndarray,
+          widths: np.ndarray, block_counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """値をブロックごとの幅で1本のバイト列に詰める
+
+    Returns:
+        (バイト列, ブロックの開始オフセット)
+    """
+    block_bytes = block_counts.astype(np.int64) * widths
+    offsets = np.zeros(len(widths) + 1, dtype=np.int64)
+    np.cumsum(block_bytes, out=offsets[1:])
+    stream = np.zeros(int(offsets[-1]), dtype=np.uint8)
+    posting_widths = widths[posting_blocks]
+    for width, dtype in _WIDTH_DTYPES.items():
+        selected = np.flatnonzero(posting_widths == width)
+        if not len(selected):
+            continue
+        encoded = values[selected].astype(dtype).view(np.uint8).reshape(-1, width)
+        starts = offsets[posting_blocks[selected]] + positions[selected] * width
+        stream[starts[:, None] + np.arange(width)] = encoded
+    return stream, offsets[:-1]
+
+
+class BlockMaxBM25:
+    """ブロック単位の最大スコアを持つ圧縮転置インデックスによる BM25 の上位k件検索
+
+    スコアの式・IDF・文書長の正規化項は元の SparseBM25 のものを使います。
+    """
+
+    def __init__(self, bm25: SparseBM25, block_size: int = BLOCK_SIZE):
+        """SparseBM25 の単語×文書の出現回数（CSR）から構築"""
+        self.bm25 = bm25
+        self.block_size = block_size
+
+        tf = bm25.term_doc_tf
+        if not tf.has_sorted_indices:
+            tf = tf.sorted_indices()
+        doc_ids = tf.indices.astype(np.int64)
+        counts = tf.data.astype(np.int64)
+        document_frequency = np.diff(tf.indptr).astype(np.int64)
+        self.postings_count = int(len(doc_ids))
+
+        # 単語ごとのブロック範囲と、各出現（posting）が属するブロック・ブロック内の位置
+        blocks_per_term = (document_frequency + block_size - 1) // block_size
+        self.term_block_ptr = np.zeros(len(document_frequency) + 1, dtype=np.int64)
+        np.cumsum(blocks_per_term, out=self.term_block_ptr[1:])
+        term_of_posting = np.repeat(np.arange(len(document_frequency)), document_frequency)
+        rank_in_term = np.arange(len(doc_ids)) - np.repeat(tf.indptr[:-1].astype(np.int64), document_frequency)
+        posting_blocks = self.term_block_ptr[term_of_posting] + rank_in_term // block_size
+        positions = rank_in_term % block_size
+        block_count = int(self.term_block_ptr[-1])
+        block_starts = np.flatnonzero(positions == 0)
+        self.block_counts = np.diff(np.append(block_starts, len(doc_ids))).astype(np.int32)
+        block_ends = block_starts + self.block_counts - 1
+
+        # ブロックの最後の文書ID（文書を含むブロックの特定と、次のブロックの差分の基準）
+        self.block_last_doc = doc_ids[block_ends] if block_count else np.empty(0, dtype=np.int64)
+        # ブロックの直前の文書ID（単語の先頭ブロックは -1）
+        first_blocks = self.term_block_ptr[:-1][blocks_per_term > 0]
+        self.block_base = np.empty(block_count, dtype=np.int64)
+        if block_count:
+            self.block_base[1:] = self.block_last_doc[:-1]
+            self.block_base[first_blocks] = -1
+
+        # ブロック内で単語が取りうるスコアの最大値（IDF・クエリ内の回数を掛ける前の tf の項）
+        tf_values = counts.astype(np.float64)
+        parts = tf_values * (bm25.k1 + 1) / (tf_values + bm25.length_norm[doc_ids])
+        self.block_max_part = np.maximum.reduceat(parts, block_starts) if block_count else np.empty(0, dtype=np.float64)
+
+        # 文書IDの差分と出現回数を、ブロックごとの幅で詰める
+        previous = np.empty(len(doc_ids), dtype=np.int64)
+        previous[1:] = doc_ids[:-1]
+        previous[block_starts] = self.block_base
+        gaps = doc_ids - previous
+        self.gap_widths = _byte_widths(np.maximum.reduceat(gaps, block_starts)) if block_count else np.empty(0, dtype=np.uint8)
+        self.tf_widths = _byte_widths(np.maximum.reduceat(counts, block_starts)) if block_count else np.empty(0, dtype=np.uint8)
+        self.gap_stream, self.gap_offsets = _pack(gaps, posting_blocks, positions, self.gap_widths, self.block_counts)
+        self.tf_stream, self.tf_offsets = _pack(counts, posting_blocks, positions, self.tf_widths, self.block_counts)
+
+    @property
+    def block_count(self) -> int:
+        return int(self.term_block_ptr[-1])
+
+    @property
+    def nbytes(self) -> int:
+        """圧縮した転置リストとブロックごとの情報のバイト数"""
+        arrays = (self.gap_stream, self.tf_stream, self.gap_offsets, self.tf_offsets, self.gap_widths, self.tf_widths,
+                  self.block_counts, self.block_last_doc, self.block_base, self.block_max_part, self.term_block_ptr)
+        return int(sum(array.nbytes for array in arrays))
+
+    def decode_blocks(self, blocks: Sequence[int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """複数ブロックの (文書ID, 出現回数) をまとめて復元
+
+        Returns:
+            (文書ID, 出現回数, ブロックの境界。blocks[i] の分は [block_ptr[i], block_ptr[i + 1])）
+        """
+        blocks = np.asarray(blocks, dtype=np.int64)
+        counts = self.block_counts[blocks].astype(np.int64)
+        block_ptr = np.zeros(len(blocks) + 1, dtype=np.int64)
+        np.cumsum(counts, out=block_ptr[1:])
+        posting_blocks = np.repeat(blocks, counts)
+        ranks = np.arange(block_ptr[-1]) - np.repeat(block_ptr[:-1], counts)
+        gaps = _unpack(self.gap_stream, self.gap_offsets, self.gap_widths, posting_blocks, ranks)
+        tf = _unpack(self.tf_stream, self.tf_offsets, self.tf_widths, posting_blocks, ranks)
+        # ブロックごとの累積和（全体の累積和からブロックの手前までの分を引く）に基準の文書IDを足す
+        cumulative = np.cumsum(gaps)
+        before = cumulative[block_ptr[:-1]] - gaps[block_ptr[:-1]]
+        doc_ids = cumulative + np.repeat(self.block_base[blocks] - before, counts)
+        return doc_ids, tf.astype(np.float64), block_ptr
+
+    def top_k(self, query_tokens: Sequence[str], k: int, threshold: float = 0.0,
+              groups: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, Dict[str, Any]]:
+        """スコアが threshold を超える文書のうち上位k件（全件採点した select_top_k と同じ結果）
+
+        Args:
+            query_tokens: クエリのトークン列（重複した単語は回数分加算）
+            k: 返す件数
+            threshold: この値より大きいスコアのみを対象とする（クエリ単語を含まない文書は採点しないので0以上）
+            groups: 文書 -> グループ（書籍など）。指定するとグループごとに最高スコアの文書1件にまとめ、
+                    グループを順位付けする（同点はグループ番号順、グループ内は文書ID順）
+
+        Returns:
+            (上位k件の文書ID, そのスコア, 統計（読んだ posting 数・復元したブロック数など）)
+        """
+        if threshold < 0:
+            raise ValueError("threshold must be non-negative")
+        bm25 = self.bm25
+        counts = Counter(bm25.term_ids[token] for token in query_tokens if token in bm25.term_ids)
+        weights = [float(bm25.idf[term_id] * count) for term_id, count in counts.items()]
+        term_ranges = [(int(self.term_block_ptr[term_id]), int(self.term_block_ptr[term_id + 1])) for term_id in counts]
+        stats = {"postings_total": 0, "postings_visited": 0, "postings_decoded": 0, "blocks_total": 0,
+                 "blocks_skipped": 0, "blocks_decoded": 0, "essential_terms": 0, "documents_scored": 0}
+        if k <= 0 or not term_ranges:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), stats
+        stats["postings_total"] = int(sum(self.block_counts[start:end].sum() for start, end in term_ranges))
+        stats["blocks_total"] = sum(end - start for start, end in term_ranges)
+
+        # ブロック・単語ごとのスコアの上限（負の重みの単語は0。含まない文書では加算されないだけなので上限として正しい）
+        block_bounds = [weight * self.block_max_part[start:end] if weight > 0 else np.zeros(end - start)
+                        for (start, end), weight in zip(term_ranges, weights)]
+        term_bounds = [float(bounds.max()) for bounds in block_bounds]
+
+        best_docs = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float64)
+        kth_score = None
+
+        def prunable(bound):
+            """上限が閾値以下か、k番目のスコアに届かない（同点は文書ID順で入りうるので残す）"""
+            if kth_score is None:
+                return bound <= threshold
+            return (bound <= threshold) | (bound < kth_score)
+
+        def score(candidates: np.ndarray) -> np.ndarray:
+            """候補の文書（昇順）のスコア。枝刈りの対象になった文書は -inf
+
+            文書ごとに「採点済みの単語は実際の値、未採点の単語は候補の文書を含むブロックの上限」を単語順で合計し、
+            それが枝刈りの対象になった文書は残りの単語を引かずに落とします。
+            単語は上限の大きい順に、残った文書を含みうるブロックだけを復元して引きます。
+            残った文書のスコアは SparseBM25.get_scores と同じ式・同じ単語順の合計です（含まない単語は 0 を足す）。
+            """
+            values = np.zeros((len(weights), len(candidates)), dtype=np.float64)
+            candidate_blocks = []
+            for row, (start, end) in enumerate(term_ranges):
+                local = np.searchsorted(self.block_last_doc[start:end], candidates, side="left")
+                inside = local < end - start
+                values[row, inside] = block_bounds[row][local[inside]]
+                candidate_blocks.append(np.where(inside, start + local, -1))
+            alive = np.arange(len(candidates))
+            for row in sorted(range(len(weights)), key=lambda row: -term_bounds[row]):
+                totals = np.zeros(len(alive), dtype=np.float64)
+                for other in range(len(weights)):
+                    totals += values[other, alive]
+                alive = alive[~prunable(totals)]
+                values[row, alive] = 0.0
+                blocks = candidate_blocks[row][alive]
+                present = alive[blocks >= 0]
+                if not len(present):
+                    continue
+                doc_ids, tf = decode(_sorted_unique(blocks[blocks >= 0]))
+                found = np.searchsorted(doc_ids, candidates[present])
+                matched = found < len(doc_ids)
+                matched[matched] = doc_ids[found[matched]] == candidates[present[matched]]
+                tf, positions = tf[found[matched]], present[matched]
+                values[row, positions] = weights[row] * (tf * (bm25.k1 + 1) / (tf + bm25.length_norm[candidates[positions]]))
+            stats["documents_scored"] += len(alive)
+            scores = np.full(len(candidates), -np.inf)
+            totals = np.zeros(len(alive), dtype=np.float64)
+            for row in range(len(weights)):
+                totals += values[row, alive]
+            scores[alive] = totals
+            return scores
+
+        def decode(blocks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            doc_ids, tf, _ = self.decode_blocks(blocks)
+            stats["blocks_decoded"] += len(blocks)
+            stats["postings_decoded"] += len(doc_ids)
+            return doc_ids, tf
+
+        def merge(candidates: np.ndarray, scores: np.ndarray):
+            nonlocal best_docs, best_scores, kth_score
+            keep = ~prunable(scores)
+            if np.any(keep):
+                best_docs, best_scores = self._merge(best_docs, best_scores, candidates[keep], scores[keep], k, groups)
+                if len(best_docs) == k:
+                    kth_score = best_scores[-1]
+
+        # 1. 上限の大きいブロックから k 件分の文書を採点し、k番目のスコア（枝刈りの基準）の初期値を得る
+        all_blocks = np.concatenate([np.arange(start, end) for start, end in term_ranges])
+        seed_order = np.argsort(-np.concatenate(block_bounds), kind="stable")
+        seed_count = int(np.searchsorted(np.cumsum(self.block_counts[all_blocks[seed_order]]), k)) + 1
+        seed_blocks = np.sort(all_blocks[seed_order[:seed_count]])
+        seeds = _sorted_unique(np.sort(decode(seed_blocks)[0]))
+        stats["postings_visited"] += int(self.block_counts[seed_blocks].sum())
+        merge(seeds, score(seeds))
+
+        # 2. MaxScore: 上限の小さい単語から合計し（単語順で足す）、基準に届かない単語を非必須にする。
+        #    非必須の単語だけを含む文書は上位に入らないので、必須の単語の posting だけから候補を集める
+        non_essential = set()
+        for row in sorted(range(len(weights)), key=lambda row: term_bounds[row]):
+            partial = 0.0
+            for other, bound in enumerate(term_bounds):
+                if other in non_essential or other == row:
+                    partial += bound
+            if not prunable(partial):
+                break
+            non_essential.add(row)
+        stats["essential_terms"] = len(weights) - len(non_essential)
+
+        # 3. 必須の単語のブロックのうち「そのブロックの上限 + 他の単語の上限」が基準に届かないものは読まない
+        candidate_docs = []
+        for row, (start, end) in enumerate(term_ranges):
+            if row in non_essential:
+                continue
+            totals = np.zeros(end - start, dtype=np.float64)
+            for other, bound in enumerate(term_bounds):
+                totals += block_bounds[row] if other == row else bound
+            blocks = start + np.flatnonzero(~prunable(totals))
+            stats["blocks_skipped"] += end - start - len(blocks)
+            stats["postings_visited"] += int(self.block_counts[blocks].sum())
+            candidate_docs.append(decode(blocks)[0])
+        if candidate_docs:
+            candidates = _sorted_unique(np.sort(np.concatenate(candidate_docs)))
+            candidates = candidates[~np.isin(candidates, seeds, assume_unique=True)]
+            merge(candidates, score(candidates))
+
+        return best_docs, best_scores, stats
+
+    @staticmethod
+    def _merge(docs: np.ndarray, scores: np.ndarray, new_docs: np.ndarray, new_scores: np.ndarray, k: int,
+               groups: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """これまでの上位k件と新しい候補をまとめ、並べ替えて上位k件に絞る"""
+        docs = np.concatenate([docs, new_docs])
+        scores = np.concatenate([scores, new_scores])
+        if groups is None:
+            keys = docs
+        else:
+            # グループごとに最高スコア（同点は先の文書）の1件だけを残す
+            order = np.lexsort((docs, -scores))
+            _, first = np.unique(groups[docs[order]], return_index=True)
+            docs, scores = docs[order[first]], scores[order[first]]
+            keys = groups[docs]
+        order = np.lexsort((keys, -scores))[:k]
+        return docs[order], scores[order]
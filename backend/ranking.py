@@ -0,0 +1,43 @@
+"""
+検索結果の上位k件選択
+
+スコアベクトル全体をソートせず、部分選択（np.partition）で
+上位k件の文書インデックスだけを求めます。
+スニペットやメタデータの生成は返却するk件に対してのみ行えばよくなります。
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+
+def select_top_k(scores: np.ndarray, k: int, threshold: float) -> Tuple[np.ndarray, int]:
+    """閾値を超えるスコアのうち上位k件を選択
+
+    並び順は「スコア降順・同点は文書インデックス昇順」で、
+    全件を安定ソートしてから先頭k件を取る従来の処理と同じ結果になります。
+
+    Args:
+        scores: 文書ごとのスコア
+        k: 返す件数
+        threshold: この値より大きいスコアのみを対象とする
+
+    Returns:
+        (上位k件の文書インデックス, 閾値を超えた文書数)
+    """
+    scores = np.asarray(scores)
+    candidates = np.flatnonzero(scores > threshold)
+    total_matches = len(candidates)
+    if k <= 0 or total_matches == 0:
+        return np.empty(0, dtype=np.int64), total_matches
+
+    if total_matches > k:
+        candidate_scores = scores[candidates]
+        # k番目に大きいスコア。それより大きいものは全て、同点は文書順に残りを埋める
+        kth_score = np.partition(candidate_scores, total_matches - k)[total_matches - k]
+        above = candidates[candidate_scores > kth_score]
+        ties = candidates[candidate_scores == kth_score][:k - len(above)]
+        candidates = np.concatenate([above, ties])
+
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order], total_matches
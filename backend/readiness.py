@@ -0,0 +1,112 @@
+"""
+起動ジョブ（インデックスの構築・読み込みとウォームアップ）の進捗
+
+インデックスの準備はバックグラウンドで行い、アプリはその間もリクエストを受け付けます。
+各フェーズ（metrics.startup_phase で囲んだ処理）の開始・終了を記録し、
+/ready で進捗を返します。
+
+状態:
+    pending   起動ジョブの開始前
+    running   インデックスの準備中（index_ready になると検索を受け付ける）
+    warming   インデックスは使えるが、ウォームアップ中
+    ready     準備完了（/ready が 200 を返す）
+    failed    起動ジョブが失敗した
+"""
+
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class StartupProgress:
+    """起動ジョブのフェーズごとの状態・所要時間と、フェーズ内の進捗（件数）"""
+
+    def __init__(self):
+        self.state = "pending"
+        self.metadata_ready = False
+        self.index_ready = False
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self._phases = {}
+        self._current = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            self.state = "running"
+            self.metadata_ready = False
+            self.index_ready = False
+            self.error = None
+            self.started_at = time.time()
+            self.finished_at = None
+            self._phases = {}
+            self._current = None
+
+    def on_phase(self, phase: str, event: str, seconds: float = 0.0) -> None:
+        """metrics.startup_phase から呼ばれる（event は "start" / "end" / "error"）"""
+        with self._lock:
+            if event == "start":
+                self._phases[phase] = {"status": "running", "started_at": time.time()}
+                self._current = phase
+            else:
+                entry = self._phases.setdefault(phase, {})
+                entry["status"] = "done" if event == "end" else "failed"
+                entry["seconds"] = round(seconds, 3)
+                # フェーズは入れ子になりうる（スナップショット読み込み中の派生インデックス構築など）
+                self._current = next((name for name, other in reversed(self._phases.items())
+                                      if other.get("status") == "running"), None)
+
+    def advance(self, phase: str, done: int, total: int) -> None:
+        """フェーズ内の進捗（例: 読み込んだ書籍数 / 全書籍数）"""
+        with self._lock:
+            entry = self._phases.get(phase)
+            if entry is not None:
+                entry["done"] = done
+                entry["total"] = total
+
+    def mark_metadata_ready(self) -> None:
+        """書籍のメタデータを読み込んだ（/books を返せる）"""
+        self.metadata_ready = True
+
+    def mark_index_ready(self) -> None:
+        """インデックスが使えるようになった（検索を受け付け、ウォームアップを始める）"""
+        with self._lock:
+            self.index_ready = True
+            self.state = "warming"
+
+    def finish(self, error: Optional[str] = None) -> None:
+        with self._lock:
+            self.finished_at = time.time()
+            if error is None:
+                self.state = "ready"
+            else:
+                self.state = "failed"
+                self.error = error
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """/ready 用の進捗"""
+        with self._lock:
+            now = self.finished_at or time.time()
+            phases = {}
+            for phase, entry in self._phases.items():
+                phases[phase] = {key: value for key, value in entry.items() if key != "started_at"}
+                if entry.get("status") == "running":
+                    phases[phase]["seconds"] = round(time.time() - entry["started_at"], 3)
+            return {
+                "status": self.state,
+                "metadata_ready": self.metadata_ready,
+                "index_ready": self.index_ready,
+                "current_phase": self._current,
+                "elapsed_seconds": round(now - self.started_at, 3) if self.started_at else 0.0,
+                "phases": phases,
+                "error": self.error,
+            }
+
+    def stats(self) -> Dict[str, float]:
+        """/metrics 用（準備完了なら1）"""
+        return {"ready": int(self.ready), "index_ready": int(self.index_ready)}
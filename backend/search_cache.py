@@ -0,0 +1,210 @@
+"""
+検索結果キャッシュ
+
+前処理済みクエリ・検索手法・パラメータをキーに検索結果を保持します。
+プロセス内のLRU（件数上限・TTL付き）を一次キャッシュとし、
+任意でレプリカ間で共有する二次キャッシュ（Redis、またはそれを模した
+プロセス内のスタンドイン）を重ねられます。
+キーにはインデックスのバージョンを含めるため、インデックスが
+変わると古いエントリは参照されなくなります。
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+
+class LocalLRUCache:
+    """件数上限とTTLを持つスレッドセーフなLRU"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class InMemorySharedBackend:
+    """共有キャッシュのスタンドイン
+
+    Redis と同じ get/set(ttl) インターフェースで、値はJSON文字列として保持します。
+    開発環境や単体での動作確認で RedisSharedBackend の代わりに使います。
+    """
+
+    def __init__(self):
+        self._store = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._store[key]
+                return None
+            return value
+
+    def set(self, key: str, value: str, ttl_seconds: float) -> None:
+        with self._lock:
+            self._store[key] = (time.time() + ttl_seconds, value)
+
+
+class RedisSharedBackend:
+    """Redis による共有キャッシュ（redis パッケージが必要）"""
+
+    def __init__(self, url: str):
+        import redis  # 任意依存のため使用時にのみ import
+        self._client = redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.05)
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._client.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key: str, value: str, ttl_seconds: float) -> None:
+        self._client.set(key, value, ex=max(1, int(ttl_seconds)))
+
+
+class SearchCache:
+    """検索結果キャッシュ（ヒット・ミス・追い出しを計数）"""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300.0, enabled: bool = True, shared_backend=None):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.local = LocalLRUCache(max_entries, ttl_seconds)
+        self.shared = shared_backend
+        self.index_version = "0"
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.shared_errors = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def make_key(self, method: str, processed_query: str, query_terms: List[str], params: Dict[str, Any]) -> str:
+        """キャッシュキーを作成
+
+        Args:
+            method: 検索手法
+            processed_query: 前処理済みクエリ（スコアを決める）
+            query_terms: クエリの単語（スニペットを決める）
+            params: 検索パラメータ（max_results など）
+        """
+        payload = [self.index_version, method, processed_query, sorted(set(query_terms)), sorted(params.items())]
+        return "search:" + json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        if not self.enabled:
+            return None
+        value = self.local.get(key)
+        if value is not None:
+            self._count("hits")
+            return value
+
+        if self.shared is not None:
+            try:
+                encoded = self.shared.get(key)
+            except Exception:
+                self._count("shared_errors")
+                encoded = None
+            if encoded is not None:
+                value = json.loads(encoded)
+                self.local.set(key, value)
+                self._count("hits")
+                self._count("shared_hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    def put(self, key: str, results: List[Dict[str, Any]]) -> None:
+        if not self.enabled:
+            return
+        self.local.set(key, results)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, json.dumps(results, ensure_ascii=False), self.ttl_seconds)
+            except Exception:
+                self._count("shared_errors")
+
+    def invalidate(self, index_version: str) -> None:
+        """インデックスが変わったときに呼ぶ（ローカルは破棄、共有側はキーが変わる）"""
+        self.index_version = index_version
+        self.local.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.local.evictions,
+            "expirations": self.local.expirations,
+            "shared_errors": self.shared_errors,
+            "size": len(self.local),
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def create_search_cache() -> SearchCache:
+    """環境変数から検索結果キャッシュを作成
+
+    SEARCH_CACHE_ENABLED        true/false（default: true）
+    SEARCH_CACHE_MAX_ENTRIES    ローカルLRUの件数上限（default: 1024）
+    SEARCH_CACHE_TTL_SECONDS    TTL秒（default: 300）
+    SEARCH_CACHE_SHARED_BACKEND ""（なし） / "memory"（スタンドイン） / "redis"
+    SEARCH_CACHE_REDIS_URL      redis 使用時の接続URL
+    """
+    shared_backend = None
+    backend_name = os.getenv("SEARCH_CACHE_SHARED_BACKEND", "").lower()
+    if backend_name == "memory":
+        shared_backend = InMemorySharedBackend()
+    elif backend_name == "redis":
+        try:
+            shared_backend = RedisSharedBackend(os.getenv("SEARCH_CACHE_REDIS_URL", "redis://localhost:6379/0"))
+        except ImportError:
+            print("⚠️  redis パッケージが無いため共有キャッシュを無効化します")
+
+    return SearchCache(
+        max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1024")),
+        ttl_seconds=float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300")),
+        enabled=os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true",
+        shared_backend=shared_backend,
+    )
@@ -0,0 +1,125 @@
+"""
+検索処理用のワーカープール
+
+CPUを使う検索処理を asyncio のイベントループから切り離して
+スレッドプール（またはプロセスプール）で実行します。
+実行中＋待機中の件数に上限を設け、超えた分は即座に
+SearchOverloadedError で拒否します（API側で 503/429 を返す）。
+待ち行列の深さと待ち時間を呼び出し側に返し、スパン属性にできます。
+"""
+
+import asyncio
+import contextvars
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Tuple
+
+
+class SearchOverloadedError(Exception):
+    """ワーカープールが飽和していて検索を受け付けられない場合の例外"""
+
+
+def _timed_call(submitted_at: float, func: Callable, args: tuple, kwargs: dict) -> Tuple[float, Any]:
+    """ワーカー上で実行され、投入から実行開始までの待ち時間と結果を返す
+
+    time.monotonic はプロセス間で共通の時計なのでプロセスプールでも使えます。
+    """
+    wait_seconds = time.monotonic() - submitted_at
+    return wait_seconds, func(*args, **kwargs)
+
+
+class SearchExecutor:
+    """上限付きの待ち行列を持つ検索ワーカープール
+
+    mode="thread": 呼び出し元のコンテキスト（トレースの親スパン）を引き継いで実行
+    mode="process": fork したプロセスで実行（インデックスは fork 時点のものを共有。
+                    子プロセス内のスパンはエクスポートされません）
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, mode: str = "thread", overload_status: int = 503):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.mode = mode
+        self.overload_status = overload_status
+        self.capacity = max_workers + max_queue
+        self.in_flight = 0
+        self.rejected = 0
+        self.completed = 0
+        self._lock = threading.Lock()
+        if mode == "process":
+            context = multiprocessing.get_context("fork")
+            self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search-worker")
+
+    async def run(self, func: Callable, *args, **kwargs) -> Tuple[Any, Dict[str, Any]]:
+        """func をワーカーで実行して (結果, 実行情報) を返す
+
+        実行情報:
+            queue_depth: 投入時点で待機していた件数（自分を含まない）
+            in_flight: 投入時点の実行中＋待機中の件数（自分を含む）
+            wait_ms: 投入から実行開始までの待ち時間
+
+        Raises:
+            SearchOverloadedError: 実行中＋待機中が上限に達している場合
+        """
+        with self._lock:
+            if self.in_flight >= self.capacity:
+                self.rejected += 1
+                raise SearchOverloadedError(
+                    f"search executor saturated: {self.in_flight}/{self.capacity} in flight"
+                )
+            self.in_flight += 1
+            in_flight = self.in_flight
+        queue_depth = max(0, in_flight - 1 - self.max_workers)
+
+        submitted_at = time.monotonic()
+        try:
+            if self.mode == "process":
+                future = self._executor.submit(_timed_call, submitted_at, func, args, kwargs)
+            else:
+                context = contextvars.copy_context()
+                future = self._executor.submit(_timed_call, submitted_at, context.run, (func,) + args, kwargs)
+            wait_seconds, result = await asyncio.wrap_future(future)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+
+        return result, {
+            "queue_depth": queue_depth,
+            "in_flight": in_flight,
+            "wait_ms": round(wait_seconds * 1000, 3),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+            "completed": self.completed,
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_search_executor() -> SearchExecutor:
+    """環境変数から検索ワーカープールを作成
+
+    SEARCH_EXECUTOR_MODE         thread / process（default: thread）
+    SEARCH_EXECUTOR_WORKERS      ワーカー数（default: CPUコア数、最低2）
+    SEARCH_EXECUTOR_QUEUE_SIZE   ワーカー待ちの上限件数（default: 32）
+    SEARCH_OVERLOAD_STATUS_CODE  飽和時に返すHTTPステータス 503 / 429（default: 503）
+    """
+    return SearchExecutor(
+        max_workers=int(os.getenv("SEARCH_EXECUTOR_WORKERS", str(max(2, os.cpu_count() or 1)))),
+        max_queue=int(os.getenv("SEARCH_EXECUTOR_QUEUE_SIZE", "32")),
+        mode=os.getenv("SEARCH_EXECUTOR_MODE", "thread").lower(),
+        overload_status=int(os.getenv("SEARCH_OVERLOAD_STATUS_CODE", "503")),
+    )
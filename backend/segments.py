@@ -0,0 +1,506 @@
+"""
+セグメント単位の増分インデックス
+
+起動時に構築（またはスナップショットから読み込み）したインデックスを「ベース」とし、
+/admin/books で追加された書籍は小さな不変のセグメントとして後ろに足します。
+検索はベースと全セグメントを同じコーパス統計で採点し、1つの順位にまとめます。
+
+- 追加: 新しい書籍だけを解析してセグメントを1つ作る（既存のセグメントには触れない）
+- 削除: 書籍に削除済みの印を付ける（トゥームストーン）。スコアは0になり、コーパス統計からも除く
+- 統計: 文書数・文書頻度・総文書長はセグメントごとの値の和から削除済みの分を引いて求め、
+  IDF と平均文書長はクエリ時にクエリの単語の分だけ計算する
+- マージ: 追加でセグメント数が上限を超えたら、バックグラウンドで小さいセグメントから
+  まとめて1つにする（削除済みの書籍はここで物理的に取り除く）
+
+インデックスの状態（セグメント・削除済みの書籍）は IndexGeneration にまとめ、
+変更のたびに新しい世代を作って参照を差し替えます。検索は開始時点の世代を最後まで使うため、
+追加・削除・マージの最中も止まらずに処理されます。
+
+近似している点:
+- TF-IDF の語彙はベースの学習時のもので固定（ベースにない語はセグメントでも無視）。
+  文書ベクトルはセグメントを作った時点の IDF で正規化し、クエリ側は最新の IDF で重み付けする
+- BM25 の負の IDF を置き換える epsilon * 平均IDF の平均IDFはベース構築時の値を使う
+追加・削除がない間（世代がベースのみ）は従来と同じ計算で、スコアも変わりません。
+追加・削除はこのプロセスのメモリ上だけのもので、再起動するとコーパスから作り直したベースに戻ります。
+"""
+
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from bm25_engine import SparseBM25
+from book_store import BookStore, BookStoreBuilder
+from positional_index import PositionalIndex, difference
+from profiler import DebugAccess
+from snippets import SnippetIndex, index_book_sentences
+from text_processing import preprocess_text
+
+BASE_SEGMENT_ID = 0
+
+
+class DuplicateBookError(ValueError):
+    """同じIDの書籍が既にインデックスにある場合の例外"""
+
+
+class IngestUnavailableError(Exception):
+    """インデックスが未構築などで書籍を追加・削除できない場合の例外"""
+
+
+class DeletedDocument:
+    """削除済みの書籍がコーパス統計に寄与していた分"""
+
+    __slots__ = ("terms", "length", "tfidf_columns")
+
+    def __init__(self, terms: Tuple[str, ...], length: int, tfidf_columns: np.ndarray):
+        self.terms = terms
+        self.length = length
+        self.tfidf_columns = tfidf_columns
+
+
+class Segment:
+    """不変のセグメント（書籍ストア・TF-IDF 行列・BM25・スニペット用インデックス）
+
+    ベース以外のセグメントはマージのために前処理済みテキストと文インデックスも持ちます
+    （マージ時にアナライザーを再実行しないため）。
+    ブール検索用の位置インデックスは、ベースは起動時に作ったもの、それ以外は初回の検索時に前処理済みテキストから作ります。
+    """
+
+    def __init__(self, segment_id: int, store: BookStore, tfidf_matrix: csr_matrix, bm25: SparseBM25,
+                 snippets: SnippetIndex, processed_texts: Optional[List[str]] = None,
+                 sentences: Optional[List[Tuple[np.ndarray, np.ndarray, Dict[str, int]]]] = None,
+                 positions: Optional[PositionalIndex] = None):
+        self.segment_id = segment_id
+        self.store = store
+        self.tfidf_matrix = csr_matrix(tfidf_matrix)
+        self.bm25 = bm25
+        self.snippets = snippets
+        self.processed_texts = processed_texts
+        self.sentences = sentences
+        # TF-IDF の語ごとの文書頻度と総文書長（世代ごとの統計はこれらの和で求める）
+        self.tfidf_df = np.bincount(self.tfidf_matrix.indices, minlength=self.tfidf_matrix.shape[1])
+        self.total_length = int(bm25.doc_len.sum())
+        self._doc_term_tf = None
+        self._positions = positions
+
+    @classmethod
+    def base(cls, store: BookStore, tfidf_matrix: csr_matrix, bm25: SparseBM25, snippets: SnippetIndex,
+             positions: Optional[PositionalIndex] = None) -> "Segment":
+        """起動時に構築したインデックスをベースのセグメントにする（マージの対象にしない）"""
+        return cls(BASE_SEGMENT_ID, store, tfidf_matrix, bm25, snippets, positions=positions)
+
+    @classmethod
+    def build(cls, segment_id: int, books: Sequence[Dict[str, Any]], processed_texts: List[str],
+              sentences: List[Tuple[np.ndarray, np.ndarray, Dict[str, int]]], vectorizer: TfidfVectorizer,
+              tfidf_idf: np.ndarray, bm25_params: Dict[str, float]) -> "Segment":
+        """解析済みの書籍からセグメントを作る
+
+        Args:
+            books: id・title・author・text を持つ書籍（この順がセグメント内の位置）
+            processed_texts: 書籍ごとの前処理済みテキスト
+            sentences: 書籍ごとの index_book_sentences() の結果
+            vectorizer: ベースの TF-IDF ベクトライザー（語彙とTFの扱いだけを使う）
+            tfidf_idf: 文書ベクトルの重み付けに使う現在の IDF
+            bm25_params: k1・b・epsilon
+        """
+        builder = BookStoreBuilder()
+        for book in books:
+            builder.add(book['id'], book['title'], book['author'], len(book['text'].split()), book['text'])
+
+        return cls(segment_id, builder.build(), tfidf_vectors(vectorizer, processed_texts, tfidf_idf),
+                   SparseBM25.from_documents((text.split() for text in processed_texts), **bm25_params),
+                   SnippetIndex.from_books(sentences), list(processed_texts), list(sentences))
+
+    @classmethod
+    def merge(cls, segment_id: int, segments: Sequence["Segment"], deleted: Dict[Tuple[int, int], DeletedDocument],
+              vectorizer: TfidfVectorizer, tfidf_idf: np.ndarray,
+              bm25_params: Dict[str, float]) -> Tuple["Segment", Dict[Tuple[int, int], int]]:
+        """複数のセグメントを1つにまとめる（削除済みの書籍は除く）
+
+        Returns:
+            (まとめたセグメント, (元のセグメントID, 元の位置) -> 新しい位置)
+        """
+        books, processed_texts, sentences, positions = [], [], [], {}
+        for segment in segments:
+            for local in range(len(segment)):
+                if (segment.segment_id, local) in deleted:
+                    continue
+                metadata = segment.store.metadata(local)
+                positions[(segment.segment_id, local)] = len(books)
+                books.append({'id': metadata['id'], 'title': metadata['title'], 'author': metadata['author'],
+                              'text': segment.store.text(local)})
+                processed_texts.append(segment.processed_texts[local])
+                sentences.append(segment.sentences[local])
+        merged = cls.build(segment_id, books, processed_texts, sentences, vectorizer, tfidf_idf, bm25_params)
+        return merged, positions
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    @property
+    def mergeable(self) -> bool:
+        return self.segment_id != BASE_SEGMENT_ID
+
+    def positional_index(self) -> Optional[PositionalIndex]:
+        """ブール検索用の位置インデックス（ベースで無効にしている場合は None）"""
+        if self._positions is None and self.processed_texts is not None:
+            # 同時に作られても結果は同じなので、ロックはかけない
+            self._positions = PositionalIndex.from_documents(self.bm25, (text.split() for text in self.processed_texts))
+        return self._positions
+
+    def deleted_document(self, local: int) -> DeletedDocument:
+        """書籍 local を削除するときにコーパス統計から引く分"""
+        if self._doc_term_tf is None:
+            # 文書×単語の向きは削除のときにしか使わないので、最初の削除で作る
+            self._doc_term_tf = self.bm25.term_doc_tf.T.tocsr()
+        doc_term = self._doc_term_tf
+        vocabulary = self.bm25.vocabulary
+        terms = tuple(vocabulary[j] for j in doc_term.indices[doc_term.indptr[local]:doc_term.indptr[local + 1]])
+        tfidf = self.tfidf_matrix
+        columns = np.array(tfidf.indices[tfidf.indptr[local]:tfidf.indptr[local + 1]])
+        return DeletedDocument(terms, int(self.bm25.doc_len[local]), columns)
+
+
+def tfidf_vectors(vectorizer: TfidfVectorizer, processed_texts: Sequence[str], idf: np.ndarray) -> csr_matrix:
+    """学習済みの語彙で出現回数を数え、与えた IDF で重み付けして正規化した行列（vectorizer.transform と同じ形）"""
+    counts = CountVectorizer.transform(vectorizer, processed_texts).astype(np.float64)
+    if vectorizer.sublinear_tf:
+        np.log(counts.data, counts.data)
+        counts.data += 1
+    counts.data *= idf[counts.indices]
+    if vectorizer.norm:
+        counts = normalize(counts, norm=vectorizer.norm, copy=False)
+    return counts
+
+
+class IndexGeneration:
+    """ある時点のインデックス（不変。変更は新しい世代を作る）
+
+    文書の位置は全セグメントを順に並べた通し番号で、セグメント i の書籍 local は
+    offsets[i] + local です。
+    """
+
+    def __init__(self, number: int, segments: Sequence[Segment], deleted: Dict[Tuple[int, int], DeletedDocument],
+                 vectorizer: TfidfVectorizer, bm25_params: Dict[str, float], average_idf: float):
+        self.number = number
+        self.segments = tuple(segments)
+        self.deleted = deleted
+        self.vectorizer = vectorizer
+        self.bm25_params = bm25_params
+        self.average_idf = average_idf
+
+        self.offsets = np.zeros(len(self.segments) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(segment) for segment in self.segments])
+        self.size = int(self.offsets[-1])
+        self.document_count = self.size - len(deleted)
+        self.total_length = sum(segment.total_length for segment in self.segments) - sum(doc.length for doc in deleted.values())
+        self.avgdl = self.total_length / self.document_count if self.document_count else 0.0
+        # ベースだけで削除もなければ、ベースの事前計算済みの統計をそのまま使える
+        self.changed = len(self.segments) > 1 or bool(deleted)
+
+        segment_offsets = {segment.segment_id: int(offset) for segment, offset in zip(self.segments, self.offsets)}
+        self.deleted_positions = np.array(sorted(segment_offsets[segment_id] + local for segment_id, local in deleted),
+                                          dtype=np.int64)
+        self._removed_df = None
+        self._tfidf_idf = None
+
+    def replace(self, segments: Optional[Sequence[Segment]] = None,
+                deleted: Optional[Dict[Tuple[int, int], DeletedDocument]] = None) -> "IndexGeneration":
+        """セグメントまたは削除済みの書籍を差し替えた次の世代"""
+        return IndexGeneration(self.number + 1, self.segments if segments is None else segments,
+                               self.deleted if deleted is None else deleted,
+                               self.vectorizer, self.bm25_params, self.average_idf)
+
+    # --- 書籍の位置 ---
+
+    def locate(self, position: int) -> Tuple[Segment, int]:
+        """通し番号 -> (セグメント, セグメント内の位置)"""
+        index = int(np.searchsorted(self.offsets, position, side="right")) - 1
+        return self.segments[index], position - int(self.offsets[index])
+
+    def find(self, book_id: str) -> Optional[Tuple[Segment, int]]:
+        """削除されていない書籍を探す"""
+        for segment in self.segments:
+            if book_id in segment.store:
+                local = segment.store.position(book_id)
+                if (segment.segment_id, local) not in self.deleted:
+                    return segment, local
+        return None
+
+    def iter_metadata(self) -> Iterator[Dict[str, Any]]:
+        for segment in self.segments:
+            for local in range(len(segment)):
+                if (segment.segment_id, local) not in self.deleted:
+                    yield segment.store.metadata(local)
+
+    def deleted_base_positions(self) -> np.ndarray:
+        """削除済みのベースの書籍の位置（パッセージ単位の検索から除くため）"""
+        return np.array(sorted(local for segment_id, local in self.deleted if segment_id == BASE_SEGMENT_ID), dtype=np.int64)
+
+    # --- コーパス統計 ---
+
+    def _removed_document_frequency(self) -> Dict[str, int]:
+        if self._removed_df is None:
+            removed = {}
+            for doc in self.deleted.values():
+                for term in doc.terms:
+                    removed[term] = removed.get(term, 0) + 1
+            self._removed_df = removed
+        return self._removed_df
+
+    def bm25_idf(self, terms: Sequence[str]) -> Dict[str, float]:
+        """単語ごとの BM25 の IDF（BM25Okapi と同じ式。負の値は epsilon * ベースの平均IDF に置き換え）"""
+        removed = self._removed_document_frequency()
+        eps = self.bm25_params["epsilon"] * self.average_idf
+        idf = {}
+        for term in set(terms):
+            freq = sum(segment.bm25.document_frequency(term) for segment in self.segments) - removed.get(term, 0)
+            value = math.log(self.document_count - freq + 0.5) - math.log(freq + 0.5)
+            idf[term] = value if value >= 0 else eps
+        return idf
+
+    def tfidf_idf(self) -> np.ndarray:
+        """TF-IDF の語彙ごとの IDF（TfidfVectorizer と同じ式。初回に計算して世代ごとに使い回す）"""
+        if self._tfidf_idf is None:
+            df = sum(segment.tfidf_df for segment in self.segments).astype(np.float64)
+            for doc in self.deleted.values():
+                df[doc.tfidf_columns] -= 1
+            smooth = int(self.vectorizer.smooth_idf)
+            self._tfidf_idf = np.log((self.document_count + smooth) / (df + smooth)) + 1
+        return self._tfidf_idf
+
+    # --- ブール検索 ---
+
+    def boolean_matches(self, node: Optional[tuple]) -> Optional[np.ndarray]:
+        """式に一致する書籍の通し番号（昇順。削除済みは除く）。位置インデックスがなければ None"""
+        indexes = [segment.positional_index() for segment in self.segments]
+        if any(index is None for index in indexes):
+            return None
+        matches = np.concatenate([index.match(node) + offset for index, offset in zip(indexes, self.offsets)])
+        return difference(matches, self.deleted_positions)
+
+    # --- 採点 ---
+
+    def _drop_deleted(self, scores: np.ndarray) -> np.ndarray:
+        if len(self.deleted_positions):
+            scores[..., self.deleted_positions] = 0.0
+        return scores
+
+    def bm25_scores(self, query_tokens: Sequence[str]) -> np.ndarray:
+        """全書籍（通し番号順）の BM25 スコア。削除済みは0"""
+        idf = self.bm25_idf(query_tokens)
+        scores = np.concatenate([segment.bm25.get_scores_with_stats(query_tokens, idf, self.avgdl)
+                                 for segment in self.segments])
+        return self._drop_deleted(scores)
+
+    def tfidf_query_vectors(self, processed_queries: Sequence[str]) -> csr_matrix:
+        """前処理済みクエリを現在の IDF でベクトル化（行がクエリ）"""
+        return tfidf_vectors(self.vectorizer, processed_queries, self.tfidf_idf())
+
+    def tfidf_scores(self, query_vectors: csr_matrix) -> np.ndarray:
+        """クエリ×全書籍（通し番号順）のコサイン類似度（どちらのベクトルも正規化済み）。削除済みは0"""
+        query_columns = query_vectors.T.tocsc()
+        scores = np.hstack([(segment.tfidf_matrix @ query_columns).T.toarray() for segment in self.segments])
+        return self._drop_deleted(scores)
+
+
+class SegmentedIndex:
+    """現在の世代を持ち、書籍の追加・削除とセグメントのマージを行う
+
+    書き込み（世代の差し替え）は1つずつ行い、読み出しは current を参照するだけです。
+    書籍の解析とマージの本体はロックの外で行うため、書き込みの待ちは短く、検索は止まりません。
+
+    Args:
+        merge_threshold: ベース以外のセグメント数がこれを超えたらマージする
+        merge_factor: 1回のマージでまとめるセグメント数（小さい順）
+        on_change: 世代が変わるたびに (世代, 理由) で呼ばれる関数
+    """
+
+    def __init__(self, merge_threshold: int = 8, merge_factor: int = 4,
+                 on_change: Optional[Callable[[IndexGeneration, str], None]] = None):
+        self.merge_threshold = merge_threshold
+        self.merge_factor = max(2, merge_factor)
+        self.on_change = on_change
+        self.current = None
+        self.ingested = 0
+        self.removed = 0
+        self.merges = 0
+        self.last_merge_seconds = 0.0
+        self._next_segment_id = BASE_SEGMENT_ID + 1
+        self._write_lock = threading.Lock()
+        self._merging = threading.Lock()
+
+    def _publish(self, generation: IndexGeneration, reason: str) -> None:
+        self.current = generation
+        if self.on_change is not None:
+            self.on_change(generation, reason)
+
+    def reset(self, base: Segment, vectorizer: TfidfVectorizer, bm25_params: Dict[str, float], average_idf: float) -> None:
+        """起動時のインデックスをベースにして世代をやり直す（追加・削除した書籍は破棄）"""
+        with self._write_lock:
+            self._publish(IndexGeneration(0, [base], {}, vectorizer, dict(bm25_params), average_idf), "reset")
+
+    def add_books(self, books: Sequence[Dict[str, Any]]) -> Tuple[IndexGeneration, Segment]:
+        """書籍を新しいセグメントとして追加する
+
+        解析（前処理・文インデックス）は追加する書籍の分だけで、既存のインデックスの大きさに依存しません。
+
+        Raises:
+            DuplicateBookError: 既にある、またはリクエスト内で重複したIDがある場合
+            IngestUnavailableError: インデックスが未構築の場合
+        """
+        ids = [book['id'] for book in books]
+        if len(set(ids)) != len(ids):
+            raise DuplicateBookError("duplicate book id in request")
+        processed_texts = [preprocess_text(book['text']) for book in books]
+        sentences = [index_book_sentences(book['text']) for book in books]
+
+        with self._write_lock:
+            generation = self.current
+            if generation is None:
+                raise IngestUnavailableError("index is not ready")
+            existing = [book_id for book_id in ids if generation.find(book_id) is not None]
+            if existing:
+                raise DuplicateBookError(f"book already indexed: {', '.join(existing)}")
+            segment = Segment.build(self._next_segment_id, books, processed_texts, sentences,
+                                    generation.vectorizer, generation.tfidf_idf(), generation.bm25_params)
+            self._next_segment_id += 1
+            generation = generation.replace(segments=generation.segments + (segment,))
+            self.ingested += len(books)
+            self._publish(generation, "add")
+
+        self.schedule_merge()
+        return generation, segment
+
+    def remove_book(self, book_id: str) -> Optional[IndexGeneration]:
+        """書籍を削除済みにする（見つからなければ None）"""
+        with self._write_lock:
+            generation = self.current
+            found = generation.find(book_id) if generation is not None else None
+            if found is None:
+                return None
+            segment, local = found
+            deleted = dict(generation.deleted)
+            deleted[(segment.segment_id, local)] = segment.deleted_document(local)
+            generation = generation.replace(deleted=deleted)
+            self.removed += 1
+            self._publish(generation, "remove")
+            return generation
+
+    def pending_merge(self, generation: IndexGeneration) -> List[Segment]:
+        """マージすべきセグメント（上限以下なら空）。小さいものから merge_factor 個"""
+        candidates = [segment for segment in generation.segments if segment.mergeable]
+        if len(candidates) <= self.merge_threshold:
+            return []
+        return sorted(candidates, key=len)[:self.merge_factor]
+
+    def schedule_merge(self) -> bool:
+        """マージが必要ならバックグラウンドのスレッドで開始する（実行中なら何もしない）"""
+        if self.current is None or not self.pending_merge(self.current) or self._merging.locked():
+            return False
+        threading.Thread(target=self.merge, name="segment-merge", daemon=True).start()
+        return True
+
+    def merge(self) -> bool:
+        """小さいセグメントを1つにまとめる（マージ中も検索・追加・削除はそのまま行える）
+
+        Returns:
+            マージしたかどうか
+        """
+        if not self._merging.acquire(blocking=False):
+            return False
+        merged_any = False
+        try:
+            while True:
+                start = time.perf_counter()
+                generation = self.current
+                targets = self.pending_merge(generation) if generation is not None else []
+                if not targets:
+                    return merged_any
+                with self._write_lock:
+                    segment_id = self._next_segment_id
+                    self._next_segment_id += 1
+
+                # 重い処理（行列の再構築）はロックの外で、マージ開始時点の世代から行う
+                merged, positions = Segment.merge(segment_id, targets, generation.deleted, generation.vectorizer,
+                                                  generation.tfidf_idf(), generation.bm25_params)
+
+                with self._write_lock:
+                    current = self.current
+                    target_ids = {segment.segment_id for segment in targets}
+                    current_ids = [segment.segment_id for segment in current.segments]
+                    if not target_ids.issubset(current_ids):
+                        # マージ中に reset() された
+                        return merged_any
+                    # まとめたセグメントは対象のうち最初のものの位置に置く
+                    segments = [segment for segment in current.segments if segment.segment_id not in target_ids]
+                    segments.insert(min(current_ids.index(target_id) for target_id in target_ids), merged)
+                    # マージ開始前に削除済みだった書籍は取り除かれた。マージ中に削除された書籍は新しい位置で削除済みにする
+                    deleted = {}
+                    for (owner, local), doc in current.deleted.items():
+                        if owner not in target_ids:
+                            deleted[(owner, local)] = doc
+                        elif (owner, local) in positions:
+                            deleted[(merged.segment_id, positions[(owner, local)])] = doc
+                    self.merges += 1
+                    self.last_merge_seconds = time.perf_counter() - start
+                    self._publish(current.replace(segments=segments, deleted=deleted), "merge")
+                    merged_any = True
+        finally:
+            self._merging.release()
+
+    def describe(self) -> List[Dict[str, Any]]:
+        """セグメントごとの書籍数・削除済みの数"""
+        generation = self.current
+        if generation is None:
+            return []
+        deleted_counts = {}
+        for segment_id, _ in generation.deleted:
+            deleted_counts[segment_id] = deleted_counts.get(segment_id, 0) + 1
+        return [{"id": segment.segment_id, "base": not segment.mergeable, "documents": len(segment),
+                 "deleted": deleted_counts.get(segment.segment_id, 0)} for segment in generation.segments]
+
+    def stats(self) -> Dict[str, Any]:
+        generation = self.current
+        return {
+            "generation": generation.number if generation is not None else 0,
+            "segments": len(generation.segments) if generation is not None else 0,
+            "documents": generation.document_count if generation is not None else 0,
+            "deleted": len(generation.deleted) if generation is not None else 0,
+            "ingested": self.ingested,
+            "removed": self.removed,
+            "merges": self.merges,
+            "merging": self._merging.locked(),
+            "last_merge_seconds": round(self.last_merge_seconds, 4),
+        }
+
+
+def create_segmented_index(on_change: Optional[Callable[[IndexGeneration, str], None]] = None) -> SegmentedIndex:
+    """環境変数から増分インデックスを作成
+
+    SEGMENT_MERGE_THRESHOLD  ベース以外のセグメント数がこれを超えたらマージ（default: 8）
+    SEGMENT_MERGE_FACTOR     1回のマージでまとめるセグメント数（default: 4）
+    """
+    return SegmentedIndex(
+        merge_threshold=int(os.getenv("SEGMENT_MERGE_THRESHOLD", "8")),
+        merge_factor=int(os.getenv("SEGMENT_MERGE_FACTOR", "4")),
+        on_change=on_change,
+    )
+
+
+def create_admin_access() -> DebugAccess:
+    """環境変数から /admin エンドポイントのアクセス設定を作成
+
+    ADMIN_ENDPOINTS_ENABLED  "true" で /admin/* を公開（default: false）
+    ADMIN_TOKEN              設定すると X-Admin-Token ヘッダーの一致を要求し、
+                             ADMIN_ENDPOINTS_ENABLED がなくても公開する
+    """
+    token = os.getenv("ADMIN_TOKEN", "")
+    enabled = os.getenv("ADMIN_ENDPOINTS_ENABLED", "false").lower() == "true" or bool(token)
+    return DebugAccess(enabled=enabled, token=token)
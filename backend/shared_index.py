@@ -0,0 +1,159 @@
+"""
+インデックス配列の共有メモリ公開
+
+複数の uvicorn ワーカープロセスで配信する場合、各ワーカーが startup_event で
+インデックスを構築・読み込むと、ワーカー数の分だけメモリを使います。
+親プロセスで1回だけ構築（またはスナップショットから読み込み）し、
+スナップショットと同じ配列（CSR行列・文書長・本文バッファなど）を1つの共有メモリブロックに書き込みます。
+ワーカーはブロック名（環境変数 INDEX_SHARED_MEMORY）で接続し、
+配列を読み取り専用のビューとしてコピーせずに使います。
+
+ブロックの構成:
+    先頭8バイト   ヘッダーJSONのバイト長（リトルエンディアン）
+    ヘッダーJSON  配列ごとの dtype・shape・オフセット、メタデータ（語彙など）、コーパス指紋
+    配列データ    各配列を ALIGNMENT バイト境界に並べたもの
+
+語彙の辞書などの Python オブジェクトは共有できないので、各ワーカーがメタデータから作ります。
+共有メモリは /dev/shm に置かれるため、コンテナではその大きさ（Docker は既定で 64MB）に注意してください。
+"""
+
+import json
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+SHARED_MEMORY_ENV = "INDEX_SHARED_MEMORY"
+
+ALIGNMENT = 64
+HEADER_LENGTH = struct.Struct("<Q")
+
+
+class SharedIndexError(Exception):
+    """共有メモリのブロックが存在しない・形式が違う場合の例外"""
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _open_untracked(name: str) -> shared_memory.SharedMemory:
+    """既存のブロックに接続（このプロセスの終了時にブロックを削除させない）"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Python 3.12 以前は接続しただけのプロセスも resource_tracker に登録される。
+    # multiprocessing で起動されたワーカーは親の resource_tracker を引き継いでおり、登録は親の分と重なるだけ
+    # （ここで登録を外すと親の登録まで消える）。独自の resource_tracker を持つ無関係なプロセスでは、
+    # 終了時にブロックごと削除されてしまうので登録を外す
+    inherited_tracker = getattr(resource_tracker._resource_tracker, "_fd", None) is not None
+    shm = shared_memory.SharedMemory(name=name)
+    if not inherited_tracker:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class SharedIndex:
+    """共有メモリ上のインデックス配列とメタデータ
+
+    配列は共有メモリのバッファを指す読み取り専用の numpy 配列で、
+    使用中（プロセスの終了まで）はブロックを閉じないでください。
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any],
+                 fingerprint: str, owner: bool):
+        self.shm = shm
+        self.arrays = arrays
+        self.metadata = metadata
+        self.fingerprint = fingerprint
+        self.owner = owner
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def nbytes(self) -> int:
+        return self.shm.size
+
+    @classmethod
+    def publish(cls, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any], fingerprint: str,
+                name: Optional[str] = None) -> "SharedIndex":
+        """配列とメタデータを新しい共有メモリブロックに書き込む（呼び出したプロセスが所有者）
+
+        Args:
+            arrays: 配列名 -> numpy配列（スナップショットと同じもの）
+            metadata: JSONで表現できるメタデータ
+            fingerprint: コーパス指紋（ワーカーの検索結果キャッシュのバージョンになる）
+            name: ブロック名（省略時は自動で決める）
+        """
+        layout = {}
+        offset = 0
+        for array_name, array in arrays.items():
+            array = np.asarray(array)
+            layout[array_name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset = _align(offset + array.nbytes)
+        header = json.dumps({"arrays": layout, "metadata": metadata, "fingerprint": fingerprint},
+                            ensure_ascii=False).encode("utf-8")
+        data_start = _align(HEADER_LENGTH.size + len(header))
+
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, data_start + offset))
+        try:
+            HEADER_LENGTH.pack_into(shm.buf, 0, len(header))
+            shm.buf[HEADER_LENGTH.size:HEADER_LENGTH.size + len(header)] = header
+            for array_name, array in arrays.items():
+                entry = layout[array_name]
+                target = np.ndarray(entry["shape"], dtype=np.dtype(entry["dtype"]), buffer=shm.buf,
+                                    offset=data_start + entry["offset"])
+                target[...] = array
+                del target
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        # 所有者は配列を持たない（書き込んだ後は参照しないので、ブロックを閉じられるようにする）
+        return cls(shm, {}, metadata, fingerprint, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedIndex":
+        """既存のブロックに接続し、配列を読み取り専用のビューとして取り出す
+
+        Raises:
+            SharedIndexError: ブロックが存在しない・ヘッダーが読めない場合
+        """
+        try:
+            shm = _open_untracked(name)
+        except FileNotFoundError:
+            raise SharedIndexError(f"shared memory not found: {name}")
+
+        try:
+            (header_length,) = HEADER_LENGTH.unpack_from(shm.buf, 0)
+            header = json.loads(bytes(shm.buf[HEADER_LENGTH.size:HEADER_LENGTH.size + header_length]).decode("utf-8"))
+            layout, metadata, fingerprint = header["arrays"], header["metadata"], header["fingerprint"]
+        except (struct.error, ValueError, KeyError, TypeError) as e:
+            shm.close()
+            raise SharedIndexError(f"shared memory unreadable: {e}")
+
+        data_start = _align(HEADER_LENGTH.size + header_length)
+        arrays = {}
+        for array_name, entry in layout.items():
+            array = np.ndarray(entry["shape"], dtype=np.dtype(entry["dtype"]), buffer=shm.buf,
+                               offset=data_start + entry["offset"])
+            array.flags.writeable = False
+            arrays[array_name] = array
+        return cls(shm, arrays, metadata, fingerprint, owner=False)
+
+    def close(self) -> None:
+        """ブロックを閉じる（所有者は続けて unlink() で削除する）"""
+        self.arrays = {}
+        self.shm.close()
+
+    def unlink(self) -> None:
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
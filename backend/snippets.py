@@ -0,0 +1,209 @@
+"""
+スニペット生成用の文インデックス
+
+書籍ごとの文境界（UTF-8 のバイトオフセット）と、単語 -> (書籍, 最初に出現する文ID)
+のポスティングをインデックス構築時に一度だけ計算します。
+検索時は該当する文へ直接ジャンプし、その文のバイト列だけをデコードするため、
+本文全体を sent_tokenize し直したり str として保持したりする必要がありません。
+単語は検索と同じテキストアナライザーで正規化（語幹化など）して照合します。
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from nltk.tokenize import sent_tokenize
+
+from text_processing import get_analyzer
+
+# 文中の単語の抽出パターン（クエリ側も同じパターンで分割する）
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def split_terms(text: str) -> List[str]:
+    """小文字化して単語に分割"""
+    return WORD_PATTERN.findall(text.lower())
+
+
+def index_book_sentences(text: str) -> Tuple[np.ndarray, np.ndarray, Dict[str, int]]:
+    """1冊分の文境界と、各単語が最初に現れる文IDを計算
+
+    コーパス読み込みのワーカープロセスから呼ばれます。
+
+    Returns:
+        (文の開始バイトオフセット, 文の終了バイトオフセット, 単語 -> 最初の文ID)
+    """
+    sentences = sent_tokenize(text)
+    normalize_term = get_analyzer().normalize_term
+    starts = np.empty(len(sentences), dtype=np.int64)
+    ends = np.empty(len(sentences), dtype=np.int64)
+    first_sentence = {}
+
+    position = 0
+    byte_position = 0
+    for sentence_id, sentence in enumerate(sentences):
+        # sent_tokenize の結果は本文の部分文字列なので順に検索すればオフセットが求まる
+        start = text.find(sentence, position)
+        if start < 0:
+            start = position
+        end = start + len(sentence)
+        # 本文は UTF-8 のバッファで保持するのでバイト単位のオフセットに変換する
+        byte_start = byte_position + len(text[position:start].encode("utf-8"))
+        byte_end = byte_start + len(sentence.encode("utf-8"))
+        starts[sentence_id] = byte_start
+        ends[sentence_id] = byte_end
+        position = end
+        byte_position = byte_end
+
+        for word in WORD_PATTERN.findall(sentence.lower()):
+            term = normalize_term(word)
+            if term not in first_sentence:
+                first_sentence[term] = sentence_id
+
+    return starts, ends, first_sentence
+
+
+class SnippetIndex:
+    """全書籍の文オフセットと単語ポスティング
+
+    配列はすべてCSR形式:
+        sentence_indptr[b]:sentence_indptr[b+1] が書籍 b の文
+        term_indptr[t]:term_indptr[t+1] が単語 t のポスティング（書籍順）
+    """
+
+    def __init__(self, vocabulary: List[str], sentence_starts: np.ndarray, sentence_ends: np.ndarray,
+                 sentence_indptr: np.ndarray, term_indptr: np.ndarray,
+                 posting_books: np.ndarray, posting_sentences: np.ndarray):
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.sentence_starts = sentence_starts
+        self.sentence_ends = sentence_ends
+        self.sentence_indptr = sentence_indptr
+        self.term_indptr = term_indptr
+        self.posting_books = posting_books
+        self.posting_sentences = posting_sentences
+
+    @classmethod
+    def from_books(cls, books: Sequence[Tuple[np.ndarray, np.ndarray, Dict[str, int]]]) -> "SnippetIndex":
+        """index_book_sentences() の結果（書籍順）からインデックスを構築"""
+        postings = {}
+        for book_index, (_, _, first_sentence) in enumerate(books):
+            for term, sentence_id in first_sentence.items():
+                postings.setdefault(term, []).append((book_index, sentence_id))
+
+        vocabulary = list(postings.keys())
+        term_indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        term_indptr[1:] = np.cumsum([len(postings[term]) for term in vocabulary])
+        posting_books = np.empty(term_indptr[-1], dtype=np.int32)
+        posting_sentences = np.empty(term_indptr[-1], dtype=np.int32)
+        for term_id, term in enumerate(vocabulary):
+            entries = postings[term]
+            start = term_indptr[term_id]
+            posting_books[start:start + len(entries)] = [book for book, _ in entries]
+            posting_sentences[start:start + len(entries)] = [sentence for _, sentence in entries]
+
+        sentence_indptr = np.zeros(len(books) + 1, dtype=np.int64)
+        sentence_indptr[1:] = np.cumsum([len(starts) for starts, _, _ in books])
+        if books:
+            sentence_starts = np.concatenate([starts for starts, _, _ in books])
+            sentence_ends = np.concatenate([ends for _, ends, _ in books])
+        else:
+            sentence_starts = np.empty(0, dtype=np.int64)
+            sentence_ends = np.empty(0, dtype=np.int64)
+
+        return cls(vocabulary, sentence_starts, sentence_ends, sentence_indptr,
+                   term_indptr, posting_books, posting_sentences)
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """スナップショット保存用の配列とメタデータ"""
+        arrays = {
+            "snippet_sentence_starts": self.sentence_starts,
+            "snippet_sentence_ends": self.sentence_ends,
+            "snippet_sentence_indptr": self.sentence_indptr,
+            "snippet_term_indptr": self.term_indptr,
+            "snippet_posting_books": self.posting_books,
+            "snippet_posting_sentences": self.posting_sentences,
+        }
+        return arrays, {"snippet_vocabulary": self.vocabulary}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]) -> "SnippetIndex":
+        """スナップショットの配列から復元（配列はコピーしない）"""
+        return cls(
+            metadata["snippet_vocabulary"],
+            arrays["snippet_sentence_starts"],
+            arrays["snippet_sentence_ends"],
+            arrays["snippet_sentence_indptr"],
+            arrays["snippet_term_indptr"],
+            arrays["snippet_posting_books"],
+            arrays["snippet_posting_sentences"],
+        )
+
+    def query_term_ids(self, query: str) -> List[int]:
+        """クエリの単語をインデックスの単語IDに変換（未知語は除外）"""
+        normalize_term = get_analyzer().normalize_term
+        terms = dict.fromkeys(normalize_term(word) for word in split_terms(query))
+        return [self.term_ids[term] for term in terms if term in self.term_ids]
+
+    def first_match(self, book_index: int, term_ids: Sequence[int]) -> Optional[int]:
+        """書籍内でいずれかの単語を含む最初の文IDを返す（なければ None）"""
+        best = None
+        for term_id in term_ids:
+            start, end = self.term_indptr[term_id], self.term_indptr[term_id + 1]
+            books = self.posting_books[start:end]
+            position = int(np.searchsorted(books, book_index))
+            if position < len(books) and books[position] == book_index:
+                sentence_id = int(self.posting_sentences[start + position])
+                if best is None or sentence_id < best:
+                    best = sentence_id
+        return best
+
+    def sentence(self, text: bytes, book_index: int, sentence_id: int) -> str:
+        """書籍の本文（UTF-8 のバイト列）から文を切り出してデコードする"""
+        row = self.sentence_indptr[book_index] + sentence_id
+        return bytes(text[self.sentence_starts[row]:self.sentence_ends[row]]).decode("utf-8", errors="replace")
+
+    def sentence_count(self, book_index: int) -> int:
+        return int(self.sentence_indptr[book_index + 1] - self.sentence_indptr[book_index])
+
+    def get_snippet(self, text: bytes, book_index: int, query: str, term_ids: Optional[Sequence[int]] = None,
+                    context_length: int = 25) -> str:
+        """検索クエリを含むスニペットを取得
+
+        main.get_snippet と同じ切り出し規則ですが、文の分割と
+        単語の検索はインデックスを使います（単語単位で一致を判定）。
+
+        Args:
+            text: 書籍の本文（UTF-8 のバイト列。BookStore.text_bytes() のビューなど）
+            book_index: インデックス上の書籍の位置
+            query: 検索クエリ
+            term_ids: query_term_ids() の結果（複数書籍で使い回す場合に指定）
+            context_length: 前後に含める単語数
+        """
+        if term_ids is None:
+            term_ids = self.query_term_ids(query)
+        sentence_id = self.first_match(book_index, term_ids)
+
+        if sentence_id is not None:
+            sentence = self.sentence(text, book_index, sentence_id)
+            words = sentence.split()
+            if len(words) <= context_length * 2:
+                return sentence
+
+            # クエリワードの位置を特定して前後を切り出す
+            query_words = [self.vocabulary[term_id] for term_id in term_ids]
+            for i, word in enumerate(words):
+                if any(qword in word.lower() for qword in query_words):
+                    start = max(0, i - context_length)
+                    end = min(len(words), i + context_length)
+                    return ' '.join(words[start:end])
+
+        # 見つからない場合は最初の文の一部を返す
+        if self.sentence_count(book_index):
+            first_sentence = self.sentence(text, book_index, 0)
+        else:
+            first_sentence = bytes(text[:200]).decode("utf-8", errors="ignore")
+        words = first_sentence.split()
+        if len(words) > context_length:
+            return ' '.join(words[:context_length]) + "..."
+        return first_sentence
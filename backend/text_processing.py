@@ -0,0 +1,137 @@
+"""
+テキスト前処理
+
+インデックス構築・検索クエリ・スニペットの単語照合で共通に使用する
+テキストアナライザーを提供します。ストップワード集合や句読点の変換テーブルは
+アナライザーの生成時に一度だけ作り、呼び出しごとには作り直しません。
+コーパス読み込みのワーカープロセスからも import されるため、
+トレースやWebアプリの初期化には依存しません。
+"""
+
+import os
+import re
+import string
+from functools import lru_cache
+from typing import Any, Callable, Dict, FrozenSet, List, Optional
+
+from nltk.corpus import stopwords
+from nltk.tokenize import NLTKWordTokenizer
+
+TOKENIZERS = ("nltk", "regex", "whitespace")
+STEMMERS = ("", "porter", "snowball")
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def _make_stemmer(name: str) -> Optional[Callable[[str], str]]:
+    """語幹化関数を作成（同じ単語は何度も現れるので結果をキャッシュ）"""
+    if not name:
+        return None
+    if name == "porter":
+        from nltk.stem import PorterStemmer
+        stemmer = PorterStemmer()
+    elif name == "snowball":
+        from nltk.stem import SnowballStemmer
+        stemmer = SnowballStemmer("english")
+    else:
+        raise ValueError(f"Unsupported stemmer: {name}. Available stemmers: {STEMMERS}")
+    return lru_cache(maxsize=65536)(stemmer.stem)
+
+
+class TextAnalyzer:
+    """小文字化・句読点除去・トークン化・ストップワード除去・語幹化を行うアナライザー
+
+    tokenizer:
+        "nltk"       NLTKの単語トークナイザー（従来の preprocess_text と同じ結果）
+        "regex"      \\w+ による分割（高速）
+        "whitespace" 空白による分割（最も高速）
+
+    句読点はトークン化の前に除去済みなので、"nltk" でも文分割（punkt）は行いません。
+    """
+
+    def __init__(self, tokenizer: str = "nltk", stop_words: Optional[FrozenSet[str]] = None,
+                 min_length: int = 3, stemmer: str = ""):
+        """
+        Args:
+            tokenizer: トークナイザー名（TOKENIZERS のいずれか）
+            stop_words: 除去する単語の集合（None の場合は NLTK の英語ストップワード）
+            min_length: この文字数未満のトークンは除去
+            stemmer: 語幹化の方式（"" は語幹化なし）
+        """
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f"Unsupported tokenizer: {tokenizer}. Available tokenizers: {TOKENIZERS}")
+        self.tokenizer = tokenizer
+        self.stop_words = frozenset(stopwords.words('english')) if stop_words is None else frozenset(stop_words)
+        self.min_length = min_length
+        self.stemmer = stemmer
+        self._stem = _make_stemmer(stemmer)
+        self._punctuation_table = str.maketrans('', '', string.punctuation)
+        if tokenizer == "nltk":
+            self._split = NLTKWordTokenizer().tokenize
+        elif tokenizer == "regex":
+            self._split = _WORD_PATTERN.findall
+        else:
+            self._split = str.split
+
+    def tokenize(self, text: str) -> List[str]:
+        """テキストを正規化済みトークンのリストに変換"""
+        # 小文字化と句読点の除去
+        text = text.lower().translate(self._punctuation_table)
+        # トークン化とストップワード・短い語の除去
+        stop_words = self.stop_words
+        min_length = self.min_length
+        tokens = [token for token in self._split(text) if len(token) >= min_length and token not in stop_words]
+        if self._stem is not None:
+            tokens = [self._stem(token) for token in tokens]
+        return tokens
+
+    def analyze(self, text: str) -> str:
+        """正規化済みトークンを空白区切りで連結した文字列を返す（インデックスとクエリで共通）"""
+        return ' '.join(self.tokenize(text))
+
+    def normalize_term(self, word: str) -> str:
+        """スニペット照合用に1単語を正規化（小文字化と語幹化。ストップワードは除去しない）"""
+        word = word.lower()
+        return self._stem(word) if self._stem is not None else word
+
+    def config(self) -> Dict[str, Any]:
+        """インデックスの指紋に含める設定値"""
+        return {
+            "tokenizer": self.tokenizer,
+            "min_length": self.min_length,
+            "stemmer": self.stemmer,
+            "stop_words": sorted(self.stop_words),
+        }
+
+
+def create_text_analyzer() -> TextAnalyzer:
+    """環境変数からテキストアナライザーを作成
+
+    TEXT_ANALYZER_TOKENIZER   nltk / regex / whitespace（default: nltk）
+    TEXT_ANALYZER_MIN_LENGTH  トークンの最小文字数（default: 3）
+    TEXT_ANALYZER_STEMMER     "" / porter / snowball（default: ""）
+    TEXT_ANALYZER_STOPWORDS   english / none（default: english）
+    """
+    stop_words = frozenset() if os.getenv("TEXT_ANALYZER_STOPWORDS", "english").lower() == "none" else None
+    return TextAnalyzer(
+        tokenizer=os.getenv("TEXT_ANALYZER_TOKENIZER", "nltk").lower(),
+        stop_words=stop_words,
+        min_length=int(os.getenv("TEXT_ANALYZER_MIN_LENGTH", "3")),
+        stemmer=os.getenv("TEXT_ANALYZER_STEMMER", "").lower(),
+    )
+
+
+_default_analyzer = None
+
+
+def get_analyzer() -> TextAnalyzer:
+    """プロセス共通のアナライザー（初回呼び出し時に環境変数から作成）"""
+    global _default_analyzer
+    if _default_analyzer is None:
+        _default_analyzer = create_text_analyzer()
+    return _default_analyzer
+
+
+def preprocess_text(text: str) -> str:
+    """テキストの前処理（プロセス共通のアナライザーで正規化）"""
+    return get_analyzer().analyze(text)
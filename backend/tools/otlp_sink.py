@@ -0,0 +1,93 @@
+"""
+ローカル確認用の OTLP/HTTP 受信サーバー
+
+コレクター（otel-collector-config.yaml）を起動せずにトレースの送信を確認するための
+最小限のスタンドインです。POST /v1/traces を受け取り、gzip を展開して
+protobuf をデコードし、リクエスト数・スパン数・受信バイト数を表示します。
+
+    python tools/otlp_sink.py --port 4318
+    OTEL_EXPORTER_OTLP_ENDPOINT=http://localhost:4318 TRACE_EXPORTERS=otlp python main.py
+
+--fail-rate を指定すると一定の割合で 503 を返し、送信失敗の計数を確認できます。
+"""
+
+import argparse
+import gzip
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceRequest
+
+
+class SinkStats:
+    def __init__(self):
+        self.requests = 0
+        self.spans = 0
+        self.bytes = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+
+def make_handler(stats: SinkStats, fail_rate: float, verbose: bool):
+    class OTLPSinkHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/v1/traces":
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if random.random() < fail_rate:
+                with stats.lock:
+                    stats.failed += 1
+                self.send_response(503)
+                self.end_headers()
+                return
+
+            payload = gzip.decompress(body) if self.headers.get("Content-Encoding") == "gzip" else body
+            request = ExportTraceServiceRequest()
+            request.ParseFromString(payload)
+            span_names = [span.name
+                          for resource_spans in request.resource_spans
+                          for scope_spans in resource_spans.scope_spans
+                          for span in scope_spans.spans]
+
+            with stats.lock:
+                stats.requests += 1
+                stats.spans += len(span_names)
+                stats.bytes += len(body)
+                print(f"📥 {len(span_names)} spans, {len(body)} bytes "
+                      f"({self.headers.get('Content-Encoding', 'identity')}) "
+                      f"total: requests={stats.requests} spans={stats.spans} bytes={stats.bytes} failed={stats.failed}")
+            if verbose:
+                print(f"   {span_names}")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-protobuf")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return OTLPSinkHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimal OTLP/HTTP trace receiver")
+    parser.add_argument("--port", type=int, default=4318)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="503 を返す割合（0.0〜1.0）")
+    parser.add_argument("--verbose", action="store_true", help="受信したスパン名を表示")
+    args = parser.parse_args()
+
+    stats = SinkStats()
+    server = ThreadingHTTPServer(("0.0.0.0", args.port), make_handler(stats, args.fail_rate, args.verbose))
+    print(f"🚀 OTLP sink listening on :{args.port}/v1/traces")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+OpenTelemetryトレースの設定
+
+TracerProvider・エクスポーターの初期化に加えて、次の3つでトレースの負荷を調整します。
+
+エクスポート:
+    OTLP（HTTP または gRPC、gzip 圧縮）へ BatchSpanProcessor でまとめて送信し、
+    コンソール出力は開発環境でのみ有効にする。送信成功・失敗・キュー溢れで
+    捨てたスパン数を export_stats() で参照できます。
+
+サンプリング:
+    親スパンのサンプリング判定に従い、ルートではトレースIDの比率でサンプリングする
+    （ParentBased + TraceIdRatioBased）。比率は TRACE_SAMPLE_RATIO で指定します。
+    OTEL_TRACES_SAMPLER が設定されている場合は OpenTelemetry 標準の環境変数に従います。
+
+スパンの詳細度（TRACE_SPAN_LEVEL）:
+    request   リクエスト・検索全体のスパンのみ
+    stage     前処理・ベクトル化・スコア計算などの段階ごとのスパンも作る
+    document  書籍ごとのスパン（generate_snippet など）も作る（default）
+    無効な詳細度のスパンは作らず、何もしない INVALID_SPAN を返します。
+"""
+
+import os
+from contextlib import nullcontext
+from typing import Dict, Tuple
+
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, Sampler, TraceIdRatioBased
+from opentelemetry.sdk.resources import Resource
+
+SPAN_LEVEL_REQUEST = 0
+SPAN_LEVEL_STAGE = 1
+SPAN_LEVEL_DOCUMENT = 2
+SPAN_LEVEL_NAMES = {SPAN_LEVEL_REQUEST: "request", SPAN_LEVEL_STAGE: "stage", SPAN_LEVEL_DOCUMENT: "document"}
+SPAN_LEVELS = {name: level for level, name in SPAN_LEVEL_NAMES.items()}
+
+
+def _span_level_from_env() -> int:
+    name = os.getenv("TRACE_SPAN_LEVEL", "document").lower()
+    if name not in SPAN_LEVELS:
+        print(f"⚠️  TRACE_SPAN_LEVEL={name} は無効です（{list(SPAN_LEVELS)}）。document を使用します")
+        return SPAN_LEVEL_DOCUMENT
+    return SPAN_LEVELS[name]
+
+
+_span_level = _span_level_from_env()
+
+
+def set_span_level(name: str) -> None:
+    """スパンの詳細度を変更（ベンチマークやデバッグ用）"""
+    global _span_level
+    _span_level = SPAN_LEVELS[name]
+
+
+def get_span_level() -> str:
+    return SPAN_LEVEL_NAMES[_span_level]
+
+
+def span_enabled(level: int) -> bool:
+    """指定した詳細度のスパンを作るかどうか"""
+    return level <= _span_level
+
+
+def start_span(tracer: trace.Tracer, name: str, level: int = SPAN_LEVEL_STAGE, **kwargs):
+    """詳細度が有効ならスパンを開始し、無効なら何もしないスパンを返すコンテキストマネージャー
+
+    どちらの場合も `with start_span(...) as span: span.set_attribute(...)` の形で使えます。
+    """
+    if level > _span_level:
+        return nullcontext(trace.INVALID_SPAN)
+    return tracer.start_as_current_span(name, **kwargs)
+
+
+def create_sampler() -> Sampler:
+    """環境変数からサンプラーを作成
+
+    TRACE_SAMPLE_RATIO   ルートスパンをサンプリングする比率 0.0〜1.0（default: 1.0）
+    OTEL_TRACES_SAMPLER  設定されていれば SDK 標準の環境変数による設定を優先
+    """
+    if os.getenv("OTEL_TRACES_SAMPLER"):
+        from opentelemetry.sdk.trace.sampling import _get_from_env_or_default
+        return _get_from_env_or_default()
+    ratio = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+    ratio = min(1.0, max(0.0, ratio))
+    return ParentBased(root=TraceIdRatioBased(ratio))
+
+
+class SimpleConsoleSpanExporter(SpanExporter):
+    """簡易的なコンソール出力エクスポーター（開発環境用）"""
+    def export(self, spans):
+        for span in spans:
+            print(f"🔍 Span: {span.name}")
+            print(f"   Service: {span.resource.attributes.get('service.name', 'unknown')}")
+            print(f"   Trace ID: {format(span.context.trace_id, '032x')}")
+            print(f"   Span ID: {format(span.context.span_id, '016x')}")
+            print(f"   Duration: {(span.end_time - span.start_time) / 1_000_000:.2f} ms")
+            
+            # 分散トレース情報の表示
+            distributed_received = span.attributes.get('distributed.trace.received', False)
+            if distributed_received:
+                traceparent = span.attributes.get('distributed.trace.traceparent', '')
+                print(f"   🔗 Distributed Trace: Connected from Frontend")
+                print(f"   📡 Traceparent: {traceparent}")
+            
+            if span.attributes:
+                print(f"   Attributes: {dict(span.attributes)}")
+            print()
+        return SpanExportResult.SUCCESS
+    
+    def shutdown(self):
+        """エクスポーターのシャットダウン"""
+        print("🔍 Console Span Exporter shutdown")
+        return True
+
+class CountingSpanExporter(SpanExporter):
+    """送信成功・失敗したスパン数を数えるエクスポーターのラッパー"""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.exported = 0
+        self.failed = 0
+
+    def export(self, spans) -> SpanExportResult:
+        try:
+            result = self.exporter.export(spans)
+        except Exception:
+            self.failed += len(spans)
+            return SpanExportResult.FAILURE
+        if result == SpanExportResult.SUCCESS:
+            self.exported += len(spans)
+        else:
+            self.failed += len(spans)
+        return result
+
+    def shutdown(self):
+        return self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        flush = getattr(self.exporter, "force_flush", None)
+        return flush(timeout_millis) if flush is not None else True
+
+
+class CountingBatchSpanProcessor(BatchSpanProcessor):
+    """キューが満杯で捨てられたスパン数を数える BatchSpanProcessor
+
+    BatchSpanProcessor は満杯のキューに追加すると最も古いスパンを黙って捨てるため、
+    追加前にキューの長さを見て数えます。
+    """
+
+    def __init__(self, span_exporter, **kwargs):
+        super().__init__(span_exporter, **kwargs)
+        self.dropped = 0
+
+    def on_end(self, span) -> None:
+        if not self.done and span.context.trace_flags.sampled and len(self.queue) == self.max_queue_size:
+            self.dropped += 1
+        super().on_end(span)
+
+
+# 名前 -> (プロセッサー, 数えるエクスポーター)
+_export_pipelines = {}
+
+
+def export_stats() -> Dict[str, Dict[str, int]]:
+    """エクスポーターごとの送信成功・失敗・破棄・キュー内のスパン数"""
+    return {
+        name: {
+            "exported": exporter.exported,
+            "failed": exporter.failed,
+            "dropped": processor.dropped,
+            "queued": len(processor.queue),
+        }
+        for name, (processor, exporter) in _export_pipelines.items()
+    }
+
+
+def _batch_processor_params() -> Dict[str, int]:
+    """BatchSpanProcessor のパラメータ（OpenTelemetry 標準の環境変数。既定値は SDK と同じ）"""
+    max_queue_size = int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "2048"))
+    return {
+        "max_queue_size": max_queue_size,
+        "schedule_delay_millis": int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "5000")),
+        # バッチサイズはキューの上限以下でなければならない
+        "max_export_batch_size": min(max_queue_size, int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "512"))),
+        "export_timeout_millis": int(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "30000")),
+    }
+
+
+def create_otlp_exporter() -> Tuple[SpanExporter, str]:
+    """環境変数からOTLPエクスポーターを作成
+
+    OTEL_EXPORTER_OTLP_PROTOCOL      http/protobuf / grpc（default: http/protobuf）
+    OTEL_EXPORTER_OTLP_ENDPOINT      コレクターのURL（default: http://localhost:4318、grpc は :4317）
+    OTEL_EXPORTER_OTLP_TRACES_ENDPOINT  トレース用のURL（指定時は ENDPOINT より優先）
+    OTEL_EXPORTER_OTLP_COMPRESSION   gzip / none（default: gzip）
+    OTEL_EXPORTER_OTLP_TIMEOUT       送信タイムアウト秒（default: 10）
+
+    Returns:
+        (エクスポーター, 送信先URL)
+    """
+    protocol = os.getenv("OTEL_EXPORTER_OTLP_TRACES_PROTOCOL", os.getenv("OTEL_EXPORTER_OTLP_PROTOCOL", "http/protobuf")).lower()
+    compression = os.getenv("OTEL_EXPORTER_OTLP_COMPRESSION", "gzip").lower()
+    timeout = int(os.getenv("OTEL_EXPORTER_OTLP_TIMEOUT", "10"))
+    traces_endpoint = os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+
+    if protocol == "grpc":
+        import grpc
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter as GRPCOTLPSpanExporter
+        endpoint = traces_endpoint or os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4317")
+        exporter = GRPCOTLPSpanExporter(
+            endpoint=endpoint,
+            insecure=endpoint.startswith("http://"),
+            timeout=timeout,
+            compression=grpc.Compression.Gzip if compression == "gzip" else grpc.Compression.NoCompression,
+        )
+        return exporter, endpoint
+
+    from opentelemetry.exporter.otlp.proto.http import Compression
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter as HTTPOTLPSpanExporter
+    endpoint = traces_endpoint or f"{os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://localhost:4318')}/v1/traces"
+    exporter = HTTPOTLPSpanExporter(
+        endpoint=endpoint,
+        timeout=timeout,
+        compression=Compression.Gzip if compression == "gzip" else Compression.NoCompression,
+    )
+    return exporter, endpoint
+
+
+def setup_tracing(tracer_name: str = __name__):
+    """OpenTelemetryトレースの初期化
+
+    TRACE_EXPORTERS  使用するエクスポーターのカンマ区切り otlp / console / none
+                     （default: development 環境では otlp,console、それ以外は otlp）
+    エクスポーターごとに BatchSpanProcessor を作り、パラメータは OTEL_BSP_* で指定します。
+
+    Args:
+        tracer_name: 返すトレーサーの名前（計装スコープ名）
+    """
+    # 環境に応じたサービス名とリソース設定
+    service_name = os.getenv("OTEL_SERVICE_NAME", "gutenberg-search-api")
+    service_version = os.getenv("DD_VERSION", "1.0.0")
+    environment = os.getenv("DD_ENV", "development")
+    
+    # リソースの設定
+    resource = Resource.create({
+        "service.name": service_name,
+        "service.version": service_version,
+        "deployment.environment": environment
+    })
+    
+    # TracerProviderの設定
+    tracer_provider = TracerProvider(resource=resource, sampler=create_sampler())
+    trace.set_tracer_provider(tracer_provider)
+    
+    default_exporters = "otlp,console" if environment == "development" else "otlp"
+    exporter_names = [name.strip().lower() for name in os.getenv("TRACE_EXPORTERS", default_exporters).split(",") if name.strip()]
+    bsp_params = _batch_processor_params()
+    
+    print(f"🔧 OpenTelemetry Setup:")
+    print(f"   Service Name: {service_name}")
+    print(f"   Environment: {environment}")
+    print(f"   DD_TRACE_AGENT_URL: {os.getenv('DD_TRACE_AGENT_URL')}")
+    print(f"   Exporters: {exporter_names}")
+    print(f"   Batch Span Processor: {bsp_params}")
+    print(f"   Sampler: {tracer_provider.sampler.get_description()}")
+    print(f"   Span Level: {SPAN_LEVEL_NAMES[_span_level]}")
+    
+    _export_pipelines.clear()
+    for name in exporter_names:
+        if name == "none":
+            continue
+        try:
+            if name == "otlp":
+                exporter, endpoint = create_otlp_exporter()
+                print(f"✅ OTLP Exporter configured: {endpoint}")
+            elif name == "console":
+                # 簡易コンソール出力（開発・デバッグ用）
+                exporter = SimpleConsoleSpanExporter()
+                print(f"✅ Console Exporter configured")
+            else:
+                print(f"⚠️  未対応のエクスポーターを無視します: {name}")
+                continue
+        except Exception as e:
+            print(f"❌ {name} Exporter setup failed: {e}")
+            continue
+        counting_exporter = CountingSpanExporter(exporter)
+        processor = CountingBatchSpanProcessor(counting_exporter, **bsp_params)
+        tracer_provider.add_span_processor(processor)
+        _export_pipelines[name] = (processor, counting_exporter)
+    
+    return trace.get_tracer(tracer_name)